@@ -1,14 +1,29 @@
 import streamlit as st
-import time
 from typing import List, Dict
 import json
 from datetime import datetime
 
-from llm_handler_anthropic import anthropic_handler, MODELS
+from llm_handler_anthropic import AnthropicHandler, MODELS
+from client_pool import client_pool, hash_api_key
+from key_validation_cache import key_validation_cache
+from render_scheduler import RenderScheduler
+from response_buffer import ResponseAccumulator, TEXT, THINKING
+from context_manager import ContextWindowManager
+from file_processor import extract_document
+from retrieval import get_or_build_index, format_passages
+from fanout import FanOut
+from metrics import PrometheusSink, SpanSink, find_sink
+from cost_ledger import BUDGET_REFUSE, BUDGET_DOWNGRADE
+from response_cache import response_cache
+from conversation_store import conversation_store
+from message_renderer import message_render_cache, render_key, window_start
+from generation_worker import generation_worker
+from model_router import model_router, ROUTER_TARGETS
 from config import (
     PAGE_TITLE, PAGE_ICON, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, 
-    DEFAULT_BUDGET_TOKENS, CHAT_INPUT_PLACEHOLDER, MAX_HISTORY_LENGTH,
-    DEFAULT_SYSTEM_PROMPT, DEBUG, validate_api_key
+    DEFAULT_BUDGET_TOKENS, CHAT_INPUT_PLACEHOLDER,
+    DEFAULT_SYSTEM_PROMPT, DEBUG, ROUTER_TARGET, CONVERSATION_LIST_LIMIT,
+    CHAT_RENDER_WINDOW, CHAT_HISTORY_PAGE_SIZE, RENDER_INTERVAL_MS, validate_api_key
 )
 
 # Streamlit page configuration
@@ -32,11 +47,30 @@ def initialize_session_state():
             "budget_tokens": DEFAULT_BUDGET_TOKENS,
             "temperature": 0.7,
             "system_prompt": DEFAULT_SYSTEM_PROMPT,
-            "use_streaming": True
+            "use_streaming": True,
+            "show_thinking": True,
+            "compare_models": [],
+            "auto_route": False,
+            "route_target": ROUTER_TARGET
         }
     
-    if "chat_history" not in st.session_state:
-        st.session_state.chat_history = []
+    if "document" not in st.session_state:
+        st.session_state.document = None
+    
+    if "usage_totals" not in st.session_state:
+        st.session_state.usage_totals = {}
+    
+    # Hội thoại hiện tại trong conversation store (tạo khi có tin nhắn đầu tiên)
+    if "conversation_id" not in st.session_state:
+        st.session_state.conversation_id = None
+    
+    # ID các generation chạy nền mà phiên này đã nhận kết quả
+    if "received_generations" not in st.session_state:
+        st.session_state.received_generations = set()
+    
+    # Số trang tin nhắn cũ đang được mở thêm ngoài cửa sổ hiển thị
+    if "chat_window_pages" not in st.session_state:
+        st.session_state.chat_window_pages = 0
     
     # Initialize sync flags để tránh infinite loop
     if "sync_flags" not in st.session_state:
@@ -50,6 +84,18 @@ def initialize_session_state():
     
     if "api_key_valid" not in st.session_state:
         st.session_state.api_key_valid = False
+    
+    # Mỗi session có handler riêng để không ghi đè API key của nhau
+    if "handler" not in st.session_state:
+        st.session_state.handler = AnthropicHandler()
+    
+    # Context manager đóng gói lịch sử vào ngân sách token của model
+    if "context_manager" not in st.session_state:
+        st.session_state.context_manager = ContextWindowManager(MODELS)
+
+def get_handler() -> AnthropicHandler:
+    """Lấy handler của session hiện tại"""
+    return st.session_state.handler
 
 def handle_thinking_temperature_sync(thinking_enabled, current_thinking):
     """Xử lý đồng bộ temperature khi thinking mode thay đổi"""
@@ -93,13 +139,13 @@ def render_api_key_section():
             if st.session_state.api_key:
                 with st.spinner("Đang kiểm tra API key..."):
                     # Set API key vào handler
-                    success = anthropic_handler.set_api_key(st.session_state.api_key)
+                    success = get_handler().set_api_key(st.session_state.api_key)
                     if success:
                         # Test API key
-                        test_result = anthropic_handler.test_api_key()
+                        test_result = get_handler().test_api_key()
                         if test_result["success"]:
                             st.session_state.api_key_valid = True
-                            st.success("✅ API key hợp lệ!")
+                            st.success("✅ API key hợp lệ!" + (" (từ cache)" if test_result.get("cached") else ""))
                         else:
                             st.session_state.api_key_valid = False
                             st.error(f"❌ {test_result['error']}")
@@ -113,6 +159,9 @@ def render_api_key_section():
         if st.button("🗑️ Xóa API Key", use_container_width=True):
             st.session_state.api_key = ""
             st.session_state.api_key_valid = False
+            # Phiên cũ của ledger không còn được dùng, giải phóng ngay thay vì chờ hết hạn
+            get_handler().ledger.forget_session(get_handler().session_id)
+            st.session_state.handler = AnthropicHandler()
             st.info("🗑️ Đã xóa API key")
             st.rerun()
     
@@ -147,6 +196,40 @@ def render_api_key_section():
         - 🔄 Mỗi lần reload trang cần nhập lại
         """)
 
+def render_document_section():
+    """Render phần tải lên tài liệu để hỏi đáp"""
+    st.subheader("📎 Tài liệu")
+    uploaded_file = st.file_uploader(
+        "Tải lên PDF hoặc TXT:",
+        type=["pdf", "txt"],
+        help="Chỉ những đoạn liên quan đến câu hỏi mới được gửi lên API"
+    )
+    
+    if uploaded_file is None:
+        st.session_state.document = None
+        return
+    
+    file_key = (uploaded_file.name, uploaded_file.size)
+    document = st.session_state.document
+    if document is None or document["file_key"] != file_key:
+        with st.spinner("Đang xử lý tài liệu..."):
+            extracted = extract_document(uploaded_file)
+            if extracted is None:
+                st.session_state.document = None
+                st.error("❌ Không đọc được tài liệu này")
+                return
+            index = get_or_build_index(extracted["sha256"], extracted["pages"])
+            document = {
+                "file_key": file_key,
+                "name": uploaded_file.name,
+                "page_count": len(extracted["pages"]),
+                "index": index
+            }
+            st.session_state.document = document
+    
+    st.caption(f"📄 {document['name']}: {document['page_count']} trang, "
+               f"{len(document['index'].chunks)} đoạn")
+
 def render_sidebar():
     """Render sidebar với các tùy chọn cấu hình"""
     with st.sidebar:
@@ -167,7 +250,7 @@ def render_sidebar():
         st.subheader("🤖 Chọn Model")
         
         model_options = list(MODELS.keys())
-        model_labels = [anthropic_handler.format_model_display(model) for model in model_options]
+        model_labels = [get_handler().format_model_display(model) for model in model_options]
         
         selected_model_index = model_options.index(st.session_state.model_settings["model"]) if st.session_state.model_settings["model"] in model_options else 0
         
@@ -175,22 +258,22 @@ def render_sidebar():
             "Model:",
             options=model_options,
             index=selected_model_index,
-            format_func=lambda x: anthropic_handler.format_model_display(x),
+            format_func=lambda x: get_handler().format_model_display(x),
             key="model_selector"
         )
         
         st.session_state.model_settings["model"] = selected_model
         
         # Model Information
-        model_info = anthropic_handler.get_model_info(selected_model)
+        model_info = get_handler().get_model_info(selected_model)
         if model_info:
             with st.expander("ℹ️ Thông tin Model", expanded=False):
                 col1, col2 = st.columns(2)
                 with col1:
-                    st.write(f"**Input:** {model_info['price']['input']}")
+                    st.write(f"**Input:** ${model_info['price']['input']:g} / MTok")
                     st.write(f"**Context:** {model_info['context_window']}")
                 with col2:
-                    st.write(f"**Output:** {model_info['price']['output']}")
+                    st.write(f"**Output:** ${model_info['price']['output']:g} / MTok")
                     st.write(f"**Max Output:** {model_info['max_output']}")
         
         st.divider()
@@ -295,6 +378,11 @@ def render_sidebar():
         
         st.divider()
         
+        # Tài liệu đính kèm
+        render_document_section()
+        
+        st.divider()
+        
         # Streaming
         st.subheader("🚀 Tùy chọn khác")
         use_streaming = st.checkbox(
@@ -304,11 +392,84 @@ def render_sidebar():
         )
         st.session_state.model_settings["use_streaming"] = use_streaming
         
+        show_thinking = st.checkbox(
+            "Hiển thị thinking",
+            value=st.session_state.model_settings["show_thinking"],
+            help="Hiển thị quá trình thinking của model (thinking vẫn được lưu khi ẩn)"
+        )
+        st.session_state.model_settings["show_thinking"] = show_thinking
+        
+        # So sánh nhiều model cùng lúc
+        compare_models = st.multiselect(
+            "🔀 So sánh model:",
+            options=list(MODELS.keys()),
+            default=st.session_state.model_settings["compare_models"],
+            format_func=lambda x: MODELS[x]["display_name"],
+            help="Chọn từ 2 model trở lên để gửi cùng một câu hỏi tới tất cả và so sánh song song"
+        )
+        st.session_state.model_settings["compare_models"] = compare_models
+        
+        # Tự động chọn model theo câu hỏi
+        auto_route = st.checkbox(
+            "🧭 Tự động chọn model",
+            value=st.session_state.model_settings["auto_route"],
+            help="Chọn model rẻ/nhanh nhất phù hợp với từng câu hỏi; chuyển lên model mạnh hơn nếu câu trả lời bị cắt"
+        )
+        st.session_state.model_settings["auto_route"] = auto_route
+        if auto_route:
+            target_labels = {"cost": "Chi phí thấp", "latency": "Phản hồi nhanh", "quality": "Chất lượng"}
+            st.session_state.model_settings["route_target"] = st.selectbox(
+                "Ưu tiên:",
+                options=list(ROUTER_TARGETS),
+                index=list(ROUTER_TARGETS).index(st.session_state.model_settings["route_target"]),
+                format_func=lambda x: target_labels[x]
+            )
+        
+        # Ngân sách chi phí của phiên
+        handler = get_handler()
+        budget_limit, budget_action = handler.ledger.budget(handler.session_id)
+        col1, col2 = st.columns(2)
+        with col1:
+            budget_limit = st.number_input(
+                "💵 Ngân sách phiên (USD):",
+                min_value=0.0,
+                value=float(budget_limit),
+                step=0.5,
+                help="0 = không giới hạn"
+            )
+        with col2:
+            budget_action = st.selectbox(
+                "Khi vượt ngân sách:",
+                options=[BUDGET_REFUSE, BUDGET_DOWNGRADE],
+                index=[BUDGET_REFUSE, BUDGET_DOWNGRADE].index(budget_action),
+                format_func=lambda x: "Từ chối" if x == BUDGET_REFUSE else "Hạ cấp model"
+            )
+        handler.ledger.set_budget(handler.session_id, budget_limit, budget_action)
+        
         # Debug mode
         if DEBUG:
             st.subheader("🐛 Debug")
             if st.button("Hiển thị Session State"):
                 st.json(dict(st.session_state))
+            st.caption("Client pool")
+            st.json(client_pool.stats())
+            st.caption("API key validation cache")
+            st.json(key_validation_cache.stats())
+            st.caption("Message render cache")
+            st.json(message_render_cache.stats())
+            st.caption("Generation worker")
+            st.json(generation_worker.stats())
+            if get_handler().response_cache is not None:
+                st.caption("Response cache")
+                st.json(response_cache.stats())
+            prometheus_sink = find_sink(PrometheusSink)
+            if prometheus_sink is not None:
+                with st.expander("Metrics (Prometheus)"):
+                    st.code(prometheus_sink.exposition(), language="text")
+            span_sink = find_sink(SpanSink)
+            if span_sink is not None and span_sink.spans:
+                with st.expander("Span gần nhất"):
+                    st.json(span_sink.spans[-1])
         
         st.divider()
         
@@ -338,15 +499,11 @@ def render_sidebar():
         # Chat Management
         st.subheader("💬 Quản lý Chat")
         
-        col1, col2 = st.columns(2)
-        with col1:
-            if st.button("🗑️ Xóa Chat", use_container_width=True):
-                st.session_state.messages = []
-                st.rerun()
+        if st.button("➕ Chat mới", use_container_width=True):
+            start_new_conversation()
+            st.rerun()
         
-        with col2:
-            if st.button("💾 Lưu Chat", use_container_width=True):
-                save_chat_history()
+        render_conversation_history()
         
         # Chat Statistics
         if st.session_state.messages:
@@ -360,22 +517,114 @@ def render_sidebar():
                 st.metric("Tổng tin nhắn", total_messages)
             with col2:
                 st.metric("Của bạn", user_messages)
+            
+            # Prompt caching: tỷ lệ input token được đọc từ cache
+            usage = st.session_state.usage_totals
+            cache_read = usage.get("cache_read_input_tokens", 0)
+            cache_write = usage.get("cache_creation_input_tokens", 0)
+            total_input = usage.get("input_tokens", 0) + cache_read + cache_write
+            if total_input:
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.metric("Cache read", f"{cache_read:,}")
+                with col2:
+                    st.metric("Cache write", f"{cache_write:,}")
+                st.caption(f"💾 {cache_read / total_input:.0%} input tokens được đọc từ cache")
+            
+            handler = get_handler()
+            session_cost = handler.ledger.session_cost(handler.session_id)
+            if session_cost:
+                st.metric("Chi phí phiên", f"${session_cost:.4f}")
+                with st.expander("Chi phí theo model", expanded=False):
+                    for model_id, totals in handler.ledger.breakdown(handler.session_id).items():
+                        st.caption(f"{MODELS.get(model_id, {}).get('display_name', model_id)}: "
+                                   f"${totals['cost']:.4f} ({totals.get('output_tokens', 0):,} output tokens)")
 
-def save_chat_history():
-    """Lưu lịch sử chat"""
-    if st.session_state.messages:
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"chat_history_{timestamp}.json"
-        
-        chat_data = {
-            "timestamp": timestamp,
-            "model_settings": st.session_state.model_settings,
-            "messages": st.session_state.messages
-        }
+def start_new_conversation():
+    """Bắt đầu hội thoại mới (hội thoại cũ vẫn nằm trong conversation store)"""
+    st.session_state.messages = []
+    st.session_state.usage_totals = {}
+    st.session_state.conversation_id = None
+    st.session_state.chat_window_pages = 0
+
+def conversation_owner() -> str:
+    """Chủ sở hữu hội thoại trong conversation store: hash của API key đang dùng (None nếu chưa có key)"""
+    api_key = get_handler().api_key
+    return hash_api_key(api_key) if api_key else None
+
+def add_message(message: Dict, model: str = None):
+    """Thêm tin nhắn vào hội thoại hiện tại và ghi ngay vào conversation store"""
+    render_key(message)
+    st.session_state.messages.append(message)
+    try:
+        if st.session_state.conversation_id is None:
+            st.session_state.conversation_id = conversation_store.create_conversation(
+                conversation_owner(),
+                model=st.session_state.model_settings["model"],
+                settings=st.session_state.model_settings
+            )
+        conversation_store.append_message(st.session_state.conversation_id, message, model=model)
+    except Exception as e:
+        st.warning(f"⚠️ Không lưu được tin nhắn: {str(e)}")
+
+def open_conversation(conversation_id: str):
+    """Mở một hội thoại đã lưu (tin nhắn chỉ được đọc lúc này)"""
+    st.session_state.messages = conversation_store.load_messages(conversation_id)
+    st.session_state.usage_totals = {}
+    st.session_state.conversation_id = conversation_id
+    st.session_state.chat_window_pages = 0
+
+def render_conversation_history():
+    """Danh sách hội thoại đã lưu của API key hiện tại, mới nhất trước, có lọc theo model và phân trang"""
+    with st.expander("🗂️ Lịch sử hội thoại", expanded=False):
+        owner = conversation_owner()
+        if owner is None:
+            st.caption("Nhập API key để xem lịch sử hội thoại")
+            return
+        model_filter = st.selectbox(
+            "Model:",
+            options=[None] + list(MODELS.keys()),
+            format_func=lambda x: "Tất cả" if x is None else MODELS[x]["display_name"],
+            key="history_model_filter"
+        )
+        # Mỗi trang được xác định bởi (updated_at, id) của hội thoại cuối trang trước (keyset pagination)
+        if st.session_state.get("history_pages_filter", None) != (owner, model_filter) or "history_pages" not in st.session_state:
+            st.session_state.history_pages = [None]
+            st.session_state.history_pages_filter = (owner, model_filter)
+        pages = st.session_state.history_pages
+        conversations = conversation_store.list_conversations(
+            owner,
+            limit=CONVERSATION_LIST_LIMIT,
+            before=pages[-1],
+            model=model_filter
+        )
+        if not conversations:
+            st.caption("Chưa có hội thoại nào")
+        for conversation in conversations:
+            updated = datetime.fromtimestamp(conversation["updated_at"]).strftime("%d/%m %H:%M")
+            label = f"{conversation['title'] or 'Không có tiêu đề'} ({conversation['message_count']} tin, {updated})"
+            is_current = conversation["id"] == st.session_state.conversation_id
+            col_open, col_delete = st.columns([5, 1])
+            with col_open:
+                if st.button(label, key=f"conversation_{conversation['id']}", disabled=is_current, use_container_width=True):
+                    open_conversation(conversation["id"])
+                    st.rerun()
+            with col_delete:
+                if st.button("🗑️", key=f"delete_conversation_{conversation['id']}", help="Xóa hội thoại"):
+                    conversation_store.delete_conversation(conversation["id"], owner)
+                    if is_current:
+                        start_new_conversation()
+                    st.rerun()
         
-        # Trong môi trường thực tế, bạn có thể lưu vào file hoặc database
-        st.session_state.chat_history.append(chat_data)
-        st.success(f"✅ Đã lưu chat history: {filename}")
+        col1, col2 = st.columns(2)
+        with col1:
+            if len(pages) > 1 and st.button("← Mới hơn", use_container_width=True):
+                pages.pop()
+                st.rerun()
+        with col2:
+            if len(conversations) == CONVERSATION_LIST_LIMIT and st.button("Cũ hơn →", use_container_width=True):
+                pages.append((conversations[-1]["updated_at"], conversations[-1]["id"]))
+                st.rerun()
 
 def render_chat_interface():
     """Render giao diện chat chính"""
@@ -403,37 +652,77 @@ def render_chat_interface():
     
     # Hiển thị thông tin model hiện tại
     current_model = st.session_state.model_settings["model"]
-    model_display = anthropic_handler.format_model_display(current_model)
+    model_display = get_handler().format_model_display(current_model)
     
     st.info(f"🤖 Đang sử dụng: **{model_display}** | "
            f"Streaming: {'✅' if st.session_state.model_settings['use_streaming'] else '❌'} | "
            f"Thinking: {'🧠' if st.session_state.model_settings['thinking'] else '❌'} | "
            f"API: {'🟢 Ready' if st.session_state.api_key_valid else '🔴 Not Ready'}")
     
-    # Hiển thị lịch sử chat
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
+    render_chat_history()
+    
+    # Response đang được tạo nền cho hội thoại này (kể cả từ lượt chạy / tab khác)
+    generation = current_generation()
+    if generation is not None:
+        with st.chat_message("assistant"):
+            watch_generation(generation)
     
     # Input từ user - chỉ hiển thị khi có API key hợp lệ
-    if prompt := st.chat_input(CHAT_INPUT_PLACEHOLDER, disabled=not st.session_state.api_key_valid):
+    generating = generation is not None and not generation.finished
+    if prompt := st.chat_input(CHAT_INPUT_PLACEHOLDER, disabled=not st.session_state.api_key_valid or generating):
         # Đảm bảo API key vẫn còn hợp lệ trước khi xử lý
         if not st.session_state.api_key_valid:
             st.error("❌ API key không hợp lệ. Vui lòng kiểm tra lại trong sidebar.")
             return
             
-        # Giới hạn độ dài lịch sử
-        if len(st.session_state.messages) >= MAX_HISTORY_LENGTH:
-            st.session_state.messages = st.session_state.messages[-(MAX_HISTORY_LENGTH-2):]
-        
         # Thêm message của user
-        st.session_state.messages.append({"role": "user", "content": prompt})
+        add_message({"role": "user", "content": prompt})
         with st.chat_message("user"):
             st.markdown(prompt)
         
         # Tạo response từ assistant
-        with st.chat_message("assistant"):
-            generate_response()
+        if len(st.session_state.model_settings["compare_models"]) >= 2:
+            with st.chat_message("assistant"):
+                generate_fanout_response()
+        elif generate_response():
+            # Chỉ rerun khi generation đã được submit, để lỗi (st.error) không bị xóa
+            st.rerun()
+
+def render_chat_history():
+    """Hiển thị lịch sử chat theo cửa sổ: chỉ các tin nhắn cuối được render đầy đủ
+    
+    Chi phí mỗi lần rerun không phụ thuộc độ dài hội thoại; tin nhắn cũ hơn được
+    mở thêm theo trang, nội dung hiển thị được memo theo hash của tin nhắn.
+    """
+    messages = st.session_state.messages
+    model_names = {model_id: info["display_name"] for model_id, info in MODELS.items()}
+    start = window_start(len(messages), CHAT_RENDER_WINDOW, st.session_state.chat_window_pages, CHAT_HISTORY_PAGE_SIZE)
+    
+    if start:
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            with st.expander(f"📜 {start} tin nhắn cũ hơn", expanded=False):
+                # Chỉ tóm tắt một trang ngay trước cửa sổ
+                for message in messages[max(0, start - CHAT_HISTORY_PAGE_SIZE):start]:
+                    icon = "🧑" if message["role"] == "user" else "🤖"
+                    st.caption(f"{icon} {message_render_cache.get(message, model_names).preview}")
+        with col2:
+            if st.button("⬆️ Xem thêm", use_container_width=True):
+                st.session_state.chat_window_pages += 1
+                st.rerun()
+    if st.session_state.chat_window_pages and st.button("⬇️ Thu gọn lịch sử"):
+        st.session_state.chat_window_pages = 0
+        st.rerun()
+    
+    show_thinking = st.session_state.model_settings["show_thinking"]
+    for message in messages[start:]:
+        rendered = message_render_cache.get(message, model_names)
+        with st.chat_message(message["role"]):
+            if show_thinking:
+                render_thinking(rendered.thinking)
+            st.markdown(rendered.markdown)
+            if rendered.caption:
+                st.caption(f"🤖 {rendered.caption}")
 
 def sync_validated_parameters(validated_params):
     """Đồng bộ parameters đã được validate trở lại session state"""
@@ -441,13 +730,73 @@ def sync_validated_parameters(validated_params):
     st.session_state.model_settings["budget_tokens"] = validated_params["budget_tokens"] 
     st.session_state.model_settings["temperature"] = validated_params["temperature"]
 
-def generate_response():
-    """Tạo response từ AI"""
+def to_api_messages(messages: List[Dict]) -> List[Dict[str, str]]:
+    """Chỉ giữ role và content của mỗi tin nhắn để gửi lên API"""
+    return [{"role": m["role"], "content": m["content"]} for m in messages]
+
+def inject_document_passages(messages: List[Dict[str, str]]) -> List[Dict[str, str]]:
+    """Chèn các đoạn tài liệu liên quan nhất vào câu hỏi mới nhất (chỉ trong request gửi API)"""
+    document = st.session_state.document
+    if not document or not messages or not isinstance(messages[-1]["content"], str):
+        return messages
+    
+    question = messages[-1]["content"]
+    passages = document["index"].search(question)
+    if not passages:
+        return messages
+    
+    content = f"{format_passages(passages, document['name'])}\n\n{question}"
+    return messages[:-1] + [{**messages[-1], "content": content}]
+
+def build_context_messages(settings: Dict, validated: Dict) -> List[Dict[str, str]]:
+    """Chọn phần lịch sử vừa với context window của model đang dùng"""
+    messages = inject_document_passages(to_api_messages(st.session_state.messages))
+    return st.session_state.context_manager.fit(
+        messages,
+        model=settings["model"],
+        max_tokens=validated["max_tokens"],
+        thinking=settings["thinking"],
+        budget_tokens=validated["budget_tokens"],
+        system_prompt=settings["system_prompt"]
+    )
+
+def record_usage(usage: Dict[str, int]):
+    """Cộng dồn usage (kể cả cache read/write) của hội thoại hiện tại"""
+    totals = st.session_state.usage_totals
+    for field, value in usage.items():
+        totals[field] = totals.get(field, 0) + value
+
+def render_thinking(thinking: str):
+    """Hiển thị quá trình thinking trong expander riêng, tách khỏi câu trả lời"""
+    if thinking:
+        with st.expander("🤔 Thinking", expanded=False):
+            st.markdown(thinking)
+
+def build_assistant_message(accumulator: ResponseAccumulator, route) -> Dict:
+    """Tạo tin nhắn assistant từ kết quả (thinking lưu riêng, không gửi lại API)"""
+    message = {"role": "assistant", "content": accumulator.text}
+    if route is not None:
+        message["model"] = accumulator.model or route.model
+    if accumulator.has_thinking():
+        message["thinking"] = accumulator.thinking
+    render_key(message)
+    return message
+
+def generate_response() -> bool:
+    """Bắt đầu tạo response trong background worker
+    
+    Request chạy ngoài lượt chạy script nên không bị hủy hay gửi lại khi
+    Streamlit rerun; UI theo dõi tiến trình qua watch_generation().
+    
+    Returns:
+        True nếu generation đã được submit, False nếu lỗi (đã hiển thị st.error)
+    """
     settings = st.session_state.model_settings
     
     try:
         # Validate parameters trước khi gọi API
-        validated = anthropic_handler.validate_and_fix_parameters(
+        handler = get_handler()
+        validated = handler.validate_and_fix_parameters(
             settings["model"],
             settings["max_tokens"],
             settings["budget_tokens"],
@@ -458,53 +807,275 @@ def generate_response():
         # Đồng bộ parameters đã được validate
         sync_validated_parameters(validated)
         
-        # Hiển thị warnings nếu có
-        if validated["warnings"]:
-            warning_container = st.container()
-            with warning_container:
-                for warning in validated["warnings"]:
-                    st.warning(f"⚠️ {warning}")
-            time.sleep(1)  # Cho user đọc warnings
-        
-        if settings["use_streaming"]:
-            # Streaming response
-            response_placeholder = st.empty()
-            full_response = ""
-            
-            with st.spinner("🤔 Đang suy nghĩ..."):
-                for chunk in anthropic_handler.stream_response(
-                    model=settings["model"],
-                    messages=st.session_state.messages,
-                    system_prompt=settings["system_prompt"] if settings["system_prompt"].strip() else None,
+        context_messages = build_context_messages(settings, validated)
+        system_prompt = settings["system_prompt"] if settings["system_prompt"].strip() else None
+        
+        route = None
+        if settings["auto_route"]:
+            route = model_router.route(
+                context_messages,
+                system_prompt=system_prompt,
+                max_tokens=validated["max_tokens"],
+                thinking=settings["thinking"],
+                has_attachment=st.session_state.document is not None,
+                target=settings["route_target"],
+                fallback=settings["model"]
+            )
+        
+        request = {
+            "system_prompt": system_prompt,
+            "budget_tokens": validated["budget_tokens"],
+            "temperature": validated["temperature"]
+        }
+        # settings là dict sống của session (sidebar sửa tại chỗ ở lượt rerun sau),
+        # nên các giá trị worker cần được chụp lại ngay tại đây
+        model = settings["model"]
+        thinking = settings["thinking"]
+        streaming = settings["use_streaming"]
+        
+        def produce(accumulator: ResponseAccumulator):
+            # Chạy trong worker thread: chỉ dùng các giá trị đã chụp, không đọc st.session_state
+            if route is not None:
+                if streaming:
+                    yield from model_router.stream_channels(
+                        handler, route, context_messages, accumulator=accumulator,
+                        requested_max_tokens=validated["max_tokens"], **request
+                    )
+                else:
+                    model_router.respond(
+                        handler, route, context_messages, accumulator=accumulator,
+                        requested_max_tokens=validated["max_tokens"], **request
+                    )
+            elif streaming:
+                yield from handler.stream_channels(
+                    model=model,
+                    messages=context_messages,
                     max_tokens=validated["max_tokens"],
-                    thinking=settings["thinking"],
-                    budget_tokens=validated["budget_tokens"],
-                    temperature=validated["temperature"]
-                ):
-                    full_response += chunk
-                    # Thêm cursor effect
-                    response_placeholder.markdown(full_response + "▌")
-                    time.sleep(0.01)
-            
-            # Hiển thị response cuối cùng
-            response_placeholder.markdown(full_response)
+                    thinking=thinking,
+                    accumulator=accumulator,
+                    **request
+                )
+            else:
+                handler.get_response(
+                    model=model,
+                    messages=context_messages,
+                    max_tokens=validated["max_tokens"],
+                    thinking=thinking,
+                    accumulator=accumulator,
+                    **request
+                )
+        
+        conversation_id = st.session_state.conversation_id
+        
+        def on_complete(generation):
+            # Lưu câu trả lời ngay cả khi không còn phiên UI nào theo dõi
+            accumulator = generation.accumulator
+            if not accumulator.text:
+                return
+            message = build_assistant_message(accumulator, route)
+            generation.meta["message"] = message
+            if conversation_id is not None:
+                conversation_store.append_message(conversation_id, message, model=accumulator.model or model)
+        
+        generation_worker.submit(
+            generation_key(),
+            produce,
+            meta={
+                "model": model,
+                "route": route,
+                "streaming": streaming,
+                "warnings": validated["warnings"]
+            },
+            on_complete=on_complete
+        )
+        return True
+        
+    except Exception as e:
+        st.error(f"❌ Lỗi khi tạo response: {str(e)}")
+        return False
+
+def generation_key() -> str:
+    """Khóa generation: ID hội thoại (các tab cùng hội thoại xem chung), hoặc ID phiên nếu chưa lưu được"""
+    return st.session_state.conversation_id or get_handler().session_id
+
+def current_generation():
+    """Generation của hội thoại hiện tại mà phiên này chưa nhận kết quả"""
+    generation = generation_worker.get(generation_key())
+    if generation is None or generation.id in st.session_state.received_generations:
+        return None
+    return generation
+
+def watch_generation(generation):
+    """Hiển thị generation đang chạy nền, đọc tiếp từ bộ đệm sau mỗi lần rerun"""
+    accumulator = generation.accumulator
+    
+    # Warnings được giữ cùng generation thay vì chặn UI để người dùng đọc
+    for warning in generation.meta["warnings"]:
+        st.warning(f"⚠️ {warning}")
+    
+    show_thinking = st.session_state.model_settings["show_thinking"]
+    thinking_placeholder = st.empty()
+    response_placeholder = st.empty()
+    
+    if not generation.finished:
+        if st.button("⏹️ Dừng", key=f"stop_{generation.id}"):
+            generation.cancel()
+        
+        if generation.meta["streaming"]:
+            # Gộp các chunk để không render lại toàn bộ markdown sau mỗi token;
+            # mỗi kênh có scheduler riêng, kênh thinking chỉ được render khi bật hiển thị
+            schedulers = {
+                TEXT: RenderScheduler(
+                    render=lambda text: response_placeholder.markdown(text + "▌"),
+                    snapshot=accumulator.snapshot
+                )
+            }
+            if show_thinking:
+                schedulers[THINKING] = RenderScheduler(
+                    render=lambda text: thinking_placeholder.caption(f"🤔 {text}▌"),
+                    snapshot=lambda: accumulator.snapshot(THINKING)
+                )
+            for channel, scheduler in schedulers.items():
+                if accumulator.length(channel):
+                    scheduler.push("")
+            cursor = generation.buffer.next_seq
+            with st.spinner("🤔 Đang suy nghĩ..."):
+                while not generation.finished:
+                    if not generation.wait(cursor, timeout=RENDER_INTERVAL_MS / 1000):
+                        for scheduler in schedulers.values():
+                            scheduler.flush()
+                        continue
+                    items, cursor, _ = generation.buffer.read(cursor)
+                    for channel, chunk in items:
+                        scheduler = schedulers.get(channel)
+                        if scheduler is not None:
+                            scheduler.push(chunk)
             
+            render_stats = schedulers[TEXT].stats()
+            st.session_state.render_stats = render_stats
+            if DEBUG:
+                st.caption(f"🖼️ Render: {render_stats['renders']} lần, "
+                           f"bỏ qua {render_stats['skipped']}/{render_stats['chunks']} chunk")
         else:
-            # Non-streaming response
             with st.spinner("🤔 Đang tạo phản hồi..."):
-                full_response = anthropic_handler.get_response(
-                    model=settings["model"],
-                    messages=st.session_state.messages,
-                    system_prompt=settings["system_prompt"] if settings["system_prompt"].strip() else None,
-                    max_tokens=validated["max_tokens"],
-                    thinking=settings["thinking"],
-                    budget_tokens=validated["budget_tokens"],
-                    temperature=validated["temperature"]
+                while not generation.finished:
+                    generation.wait(0, timeout=0.5)
+    
+    # Hiển thị response cuối cùng
+    if show_thinking:
+        with thinking_placeholder.container():
+            render_thinking(accumulator.thinking)
+    else:
+        thinking_placeholder.empty()
+    response_placeholder.markdown(accumulator.text)
+    
+    if accumulator.cached:
+        st.caption("⚡ Phát lại từ response cache")
+    if accumulator.resumes:
+        st.caption(f"🔁 Kết nối bị ngắt, đã nối tiếp stream {accumulator.resumes} lần "
+                   f"(giữ lại ~{accumulator.salvaged_tokens} tokens)")
+    if generation.cancelled:
+        st.caption("⏹️ Đã dừng")
+    
+    route = generation.meta["route"]
+    requested_model = route.model if route is not None else generation.meta["model"]
+    if route is not None:
+        model_name = MODELS.get(route.model, {}).get("display_name", route.model)
+        st.caption(f"🧭 {model_name} (tier {route.tier}: {', '.join(route.reasons) or 'câu hỏi ngắn'})"
+                   + (" — đã chuyển lên model mạnh hơn vì câu trả lời bị cắt" if route.escalations else ""))
+    if accumulator.model and accumulator.model != requested_model:
+        st.caption(f"💵 Phiên đã vượt ngân sách, response được tạo bởi "
+                   f"{MODELS.get(accumulator.model, {}).get('display_name', accumulator.model)}")
+    
+    # Lỗi API chỉ được hiển thị, không lưu thành tin nhắn của assistant
+    if accumulator.error:
+        st.error(accumulator.error)
+    
+    # Mỗi phiên chỉ nhận kết quả một lần (tin nhắn đã được worker lưu vào store)
+    st.session_state.received_generations.add(generation.id)
+    record_usage(accumulator.usage)
+    messages = st.session_state.messages
+    conversation_id = st.session_state.conversation_id
+    if conversation_id is not None:
+        # Đọc lại phần cuối từ store: tab khác cùng hội thoại có thể chưa có tin nhắn của user
+        try:
+            tail = conversation_store.load_messages(conversation_id, start=len(messages))
+        except Exception as e:
+            tail = []
+            st.warning(f"⚠️ Không đọc được hội thoại đã lưu: {str(e)}")
+        if tail:
+            messages.extend(tail)
+            return
+    # Hội thoại chưa được lưu (hoặc ghi store lỗi): dùng tin nhắn worker giữ trong generation
+    message = generation.meta.get("message")
+    if message is not None and not (messages and messages[-1] == message):
+        messages.append(message)
+
+def generate_fanout_response():
+    """Gửi cùng câu hỏi tới nhiều model song song và hiển thị cạnh nhau"""
+    settings = st.session_state.model_settings
+    models = settings["compare_models"]
+    
+    try:
+        validated = get_handler().validate_and_fix_parameters(
+            settings["model"],
+            settings["max_tokens"],
+            settings["budget_tokens"],
+            settings["temperature"],
+            settings["thinking"]
+        )
+        context_messages = build_context_messages(settings, validated)
+        fanout = FanOut(get_handler(), models)
+        
+        columns = st.columns(len(models))
+        placeholders = {}
+        schedulers = {}
+        for column, model in zip(columns, models):
+            with column:
+                st.markdown(f"**{MODELS[model]['display_name']}**")
+                placeholder = st.empty()
+                placeholders[model] = placeholder
+                schedulers[model] = RenderScheduler(
+                    render=lambda text, p=placeholder: p.markdown(text + "▌"),
+                    snapshot=fanout.runs[model].accumulator.snapshot
                 )
-            st.markdown(full_response)
         
-        # Thêm response vào session state
-        st.session_state.messages.append({"role": "assistant", "content": full_response})
+        for model, chunk in fanout.stream(
+            messages=context_messages,
+            system_prompt=settings["system_prompt"] if settings["system_prompt"].strip() else None,
+            max_tokens=validated["max_tokens"],
+            thinking=settings["thinking"],
+            budget_tokens=validated["budget_tokens"],
+            temperature=validated["temperature"]
+        ):
+            schedulers[model].push(chunk)
+        
+        metrics = fanout.metrics()
+        for column, model in zip(columns, models):
+            run = fanout.runs[model]
+            placeholders[model].markdown(run.accumulator.text)
+            m = metrics[model]
+            with column:
+                if run.accumulator.error:
+                    st.error(run.accumulator.error)
+                ttft = f"{m['ttft']:.2f}s" if m["ttft"] is not None else "-"
+                latency = f"{m['latency']:.2f}s" if m["latency"] is not None else "-"
+                st.caption(f"⏱️ TTFT {ttft} | Tổng {latency} | "
+                           f"{m['output_tokens']} tokens | ${m['cost']:.4f}")
+            record_usage(run.accumulator.usage)
+        
+        st.caption(f"🔀 Thời gian thực tế: {fanout.wall_time():.2f}s "
+                   f"(tổng nếu chạy tuần tự: {sum(m['latency'] or 0 for m in metrics.values()):.2f}s)")
+        
+        # Lưu câu trả lời của model đang chọn (hoặc model đầu tiên) vào lịch sử
+        primary = settings["model"] if settings["model"] in models else models[0]
+        if not fanout.runs[primary].accumulator.text:
+            return
+        add_message({
+            "role": "assistant",
+            "content": fanout.runs[primary].accumulator.text,
+            "model": primary
+        })
         
     except Exception as e:
         st.error(f"❌ Lỗi khi tạo response: {str(e)}")
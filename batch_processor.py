@@ -0,0 +1,308 @@
+import argparse
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+import anthropic
+
+from config import (
+    BATCH_MAX_REQUESTS, BATCH_POLL_INTERVAL, BATCH_RECONCILE_WINDOW, DEFAULT_MAX_TOKENS, DEFAULT_SYSTEM_PROMPT
+)
+from llm_handler_anthropic import AnthropicHandler
+from response_buffer import ResponseAccumulator
+
+logger = logging.getLogger(__name__)
+
+
+def read_jsonl(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Đọc file JSONL, bỏ qua dòng trống và dòng cuối bị ghi dở
+
+    Byte UTF-8 không hợp lệ (ký tự bị cắt giữa chừng khi crash) được thay thế
+    thay vì làm hỏng cả file; dòng đó sau đó bị bỏ qua vì không phải JSON.
+
+    Args:
+        path: Đường dẫn file
+
+    Yields:
+        Từng object JSON
+    """
+    with open(path, encoding="utf-8", errors="replace") as f:
+        for line_number, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                logger.warning(f"Bỏ qua dòng {line_number} không hợp lệ trong {path}")
+
+
+def _terminate_last_line(path: str) -> None:
+    """Thêm newline nếu dòng cuối của file bị ghi dở (kiểm tra ở chế độ binary)"""
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return
+    with open(path, "rb+") as f:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+
+
+class BatchProcessor:
+    """Xử lý offline nhiều request qua Message Batches API, có thể resume sau khi crash
+
+    Trạng thái (các batch đã submit) được lưu cạnh file output; khi chạy lại,
+    các custom_id đã có trong output được bỏ qua và các batch đang chạy được
+    poll tiếp thay vì submit lại. Trước mỗi lần submit, các custom_id được ghi
+    thành marker "pending" để một lần crash giữa lúc tạo batch và lúc lưu trạng
+    thái không làm submit (và tính tiền) lại cả batch.
+    """
+
+    def __init__(
+        self,
+        handler: AnthropicHandler,
+        client: Any = None,
+        max_requests_per_batch: int = BATCH_MAX_REQUESTS,
+        poll_interval: float = BATCH_POLL_INTERVAL
+    ):
+        """
+        Khởi tạo
+
+        Args:
+            handler: Handler dùng để xây dựng parameters (và client nếu không truyền client)
+            client: Anthropic client (tùy chọn, ví dụ client trỏ tới stub server)
+            max_requests_per_batch: Số request tối đa trong một batch
+            poll_interval: Số giây giữa 2 lần poll trạng thái batch
+        """
+        self.handler = handler
+        self.client = client or handler.client
+        self.max_requests_per_batch = max_requests_per_batch
+        self.poll_interval = poll_interval
+
+    def build_request(self, item: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Chuyển một dòng input thành request của batch
+
+        Dòng input gồm "custom_id", "model" và "messages" (hoặc "prompt"), có thể
+        kèm "system_prompt", "max_tokens", "thinking", "budget_tokens", "temperature".
+
+        Args:
+            item: Dòng input
+
+        Returns:
+            Dictionary {"custom_id", "params"}
+        """
+        messages = item.get("messages") or [{"role": "user", "content": item["prompt"]}]
+        params = self.handler._build_request_params(
+            item["model"],
+            messages,
+            item.get("system_prompt", DEFAULT_SYSTEM_PROMPT),
+            item.get("max_tokens", DEFAULT_MAX_TOKENS),
+            item.get("thinking", False),
+            item.get("budget_tokens", 10000),
+            item.get("temperature", 0.7)
+        )
+        return {"custom_id": str(item["custom_id"]), "params": params}
+
+    @staticmethod
+    def _state_path(output_path: str) -> str:
+        return output_path + ".state.json"
+
+    def _load_state(self, output_path: str) -> Dict[str, Any]:
+        path = self._state_path(output_path)
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                return json.load(f)
+        return {"batches": []}
+
+    def _save_state(self, output_path: str, state: Dict[str, Any]) -> None:
+        path = self._state_path(output_path)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _request_total(batch: Any) -> int:
+        counts = batch.request_counts
+        return counts.processing + counts.succeeded + counts.errored + counts.canceled + counts.expired
+
+    def _reconcile_pending(self, output_path: str, state: Dict[str, Any]) -> None:
+        """
+        Đối chiếu marker "pending" của lần chạy trước với batches.list
+
+        Batch được nhận lại nếu được tạo sau khi ghi marker, chưa có trong trạng
+        thái và có cùng số request (batch đã kết thúc phải có cùng tập
+        custom_id). Nếu không tìm thấy, batch chưa được tạo và các request của
+        marker sẽ được submit lại.
+
+        Args:
+            output_path: File output (trạng thái được lưu cạnh file này)
+            state: Trạng thái đã đọc
+        """
+        marker = state.get("pending")
+        if not marker:
+            return
+        custom_ids = marker["custom_ids"]
+        known = {batch["id"] for batch in state["batches"]}
+        since = marker["started_at"] - BATCH_RECONCILE_WINDOW
+
+        for batch in self.client.messages.batches.list(limit=100):
+            # Danh sách được sắp xếp mới nhất trước
+            if batch.created_at.timestamp() < since:
+                break
+            if batch.id in known or self._request_total(batch) != len(custom_ids):
+                continue
+            if batch.processing_status == "ended":
+                if not batch.results_url:
+                    continue
+                result_ids = {entry.custom_id for entry in self.client.messages.batches.results(batch.id)}
+                if result_ids != set(custom_ids):
+                    continue
+            state["batches"].append({"id": batch.id, "custom_ids": custom_ids})
+            logger.info(f"Đã nhận lại batch {batch.id} được submit trước khi crash")
+            break
+        else:
+            logger.info(f"Không tìm thấy batch của {len(custom_ids)} request đang submit dở, sẽ submit lại")
+
+        del state["pending"]
+        self._save_state(output_path, state)
+
+    def _completed_ids(self, output_path: str) -> Set[str]:
+        if not os.path.exists(output_path):
+            return set()
+        return {str(row["custom_id"]) for row in read_jsonl(output_path) if "custom_id" in row}
+
+    def _result_row(self, entry: Any) -> Dict[str, Any]:
+        """Chuyển một kết quả của batch thành dòng output"""
+        result = entry.result
+        row = {"custom_id": entry.custom_id, "status": result.type}
+        if result.type == "succeeded":
+            accumulator = ResponseAccumulator()
+            self.handler._collect_content_blocks(result.message, accumulator)
+            row["text"] = accumulator.text
+            if accumulator.has_thinking():
+                row["thinking"] = accumulator.thinking
+            row["stop_reason"] = accumulator.stop_reason
+            row["usage"] = accumulator.usage
+        elif result.type == "errored":
+            row["error"] = str(getattr(result, "error", ""))
+        return row
+
+    def run(self, input_path: str, output_path: str) -> Dict[str, int]:
+        """
+        Submit các request chưa xử lý, poll đến khi xong và ghi kết quả ra JSONL
+
+        Args:
+            input_path: File JSONL chứa request
+            output_path: File JSONL nhận kết quả (ghi nối tiếp)
+
+        Returns:
+            Thống kê số request đã submit và số kết quả đã ghi
+        """
+        state = self._load_state(output_path)
+        self._reconcile_pending(output_path, state)
+        completed = self._completed_ids(output_path)
+        in_flight = {
+            custom_id
+            for batch in state["batches"] if not batch.get("done")
+            for custom_id in batch["custom_ids"]
+        }
+
+        pending: List[Dict[str, Any]] = []
+        submitted = 0
+
+        def submit():
+            nonlocal pending, submitted
+            custom_ids = [r["custom_id"] for r in pending]
+            # Marker được lưu trước khi tạo batch (xem _reconcile_pending)
+            state["pending"] = {"custom_ids": custom_ids, "started_at": time.time()}
+            self._save_state(output_path, state)
+            batch = self.client.messages.batches.create(requests=pending)
+            del state["pending"]
+            state["batches"].append({"id": batch.id, "custom_ids": custom_ids})
+            self._save_state(output_path, state)
+            logger.info(f"Đã submit batch {batch.id} với {len(pending)} request")
+            submitted += len(pending)
+            pending = []
+
+        for item in read_jsonl(input_path):
+            custom_id = str(item["custom_id"])
+            if custom_id in completed or custom_id in in_flight:
+                continue
+            pending.append(self.build_request(item))
+            if len(pending) >= self.max_requests_per_batch:
+                submit()
+        if pending:
+            submit()
+
+        written = self._collect(output_path, state, completed)
+        return {"submitted": submitted, "written": written}
+
+    def _collect(self, output_path: str, state: Dict[str, Any], completed: Set[str]) -> int:
+        """Poll các batch chưa xong và ghi kết quả của batch nào kết thúc trước"""
+        written = 0
+        # Dòng cuối có thể bị ghi dở nếu lần chạy trước bị crash
+        _terminate_last_line(output_path)
+        with open(output_path, "a", encoding="utf-8") as out:
+            while True:
+                active = [batch for batch in state["batches"] if not batch.get("done")]
+                if not active:
+                    return written
+
+                progressed = False
+                for batch in active:
+                    status = self.client.messages.batches.retrieve(batch["id"])
+                    if status.processing_status != "ended":
+                        continue
+
+                    for entry in self.client.messages.batches.results(batch["id"]):
+                        if entry.custom_id in completed:
+                            continue
+                        out.write(json.dumps(self._result_row(entry), ensure_ascii=False) + "\n")
+                        completed.add(entry.custom_id)
+                        written += 1
+                    out.flush()
+                    os.fsync(out.fileno())
+
+                    batch["done"] = True
+                    self._save_state(output_path, state)
+                    logger.info(f"Batch {batch['id']} đã xong")
+                    progressed = True
+
+                if not progressed:
+                    time.sleep(self.poll_interval)
+
+
+def main(argv: Optional[List[str]] = None):
+    """Chạy batch từ dòng lệnh"""
+    parser = argparse.ArgumentParser(description="Xử lý JSONL request qua Message Batches API")
+    parser.add_argument("input", help="File JSONL chứa request")
+    parser.add_argument("output", help="File JSONL nhận kết quả")
+    parser.add_argument("--api-key", default=os.getenv("ANTHROPIC_API_KEY"), help="Anthropic API key")
+    parser.add_argument("--base-url", default=None, help="URL của API (ví dụ stub server cục bộ)")
+    parser.add_argument("--poll-interval", type=float, default=BATCH_POLL_INTERVAL)
+    parser.add_argument("--batch-size", type=int, default=BATCH_MAX_REQUESTS)
+    args = parser.parse_args(argv)
+
+    if not args.api_key:
+        parser.error("Cần API key (--api-key hoặc biến môi trường ANTHROPIC_API_KEY)")
+
+    handler = AnthropicHandler(args.api_key)
+    client = anthropic.Anthropic(api_key=args.api_key, base_url=args.base_url) if args.base_url else None
+    processor = BatchProcessor(
+        handler,
+        client=client,
+        max_requests_per_batch=args.batch_size,
+        poll_interval=args.poll_interval
+    )
+    stats = processor.run(args.input, args.output)
+    print(f"Đã submit {stats['submitted']} request, ghi {stats['written']} kết quả vào {args.output}")
+
+
+if __name__ == "__main__":
+    main()
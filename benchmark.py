@@ -0,0 +1,352 @@
+import argparse
+import json
+import logging
+import platform
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import anthropic
+
+from config import (
+    DEFAULT_MODEL, MOCK_TTFT, MOCK_TOKENS_PER_SECOND, MOCK_OUTPUT_TOKENS,
+    BENCHMARK_OUTPUT, BENCHMARK_ITERATIONS, BENCHMARK_CONCURRENCY
+)
+from llm_handler_anthropic import AnthropicHandler
+from message_renderer import close_code_fences
+from metrics import percentile
+from mock_anthropic import MockAnthropicServer
+from render_scheduler import RenderScheduler
+from request_scheduler import RequestScheduler
+from response_buffer import ResponseAccumulator
+
+logger = logging.getLogger(__name__)
+
+MOCK_API_KEY = "sk-ant-mock-benchmark"
+
+# Các chỉ số càng lớn càng tốt (các chỉ số còn lại là thời gian: càng nhỏ càng tốt)
+_HIGHER_IS_BETTER = ("per_second", "speedup")
+
+_MESSAGES = [{"role": "user", "content": "Benchmark"}]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    """
+    Tóm tắt một dãy số đo (giây)
+
+    Args:
+        values: Các số đo
+
+    Returns:
+        Dictionary gồm mean, p50, p95, min, max
+    """
+    ordered = sorted(values)
+    return {
+        "mean": sum(ordered) / len(ordered) if ordered else None,
+        "p50": percentile(ordered, 0.50),
+        "p95": percentile(ordered, 0.95),
+        "min": ordered[0] if ordered else None,
+        "max": ordered[-1] if ordered else None
+    }
+
+
+def mock_handler(server: MockAnthropicServer, api_key: str = MOCK_API_KEY) -> AnthropicHandler:
+    """
+    Tạo handler gọi tới mock server, không bị giới hạn bởi quota của scheduler
+
+    Args:
+        server: Mock server đang chạy
+        api_key: API key gửi tới mock
+
+    Returns:
+        AnthropicHandler
+    """
+    handler = AnthropicHandler(api_key)
+    handler.client = anthropic.Anthropic(api_key=api_key, base_url=server.url)
+    handler.scheduler = RequestScheduler(requests_per_minute=10 ** 9, tokens_per_minute=10 ** 12)
+    handler.response_cache = None
+    return handler
+
+
+def _timed(func: Callable[[], Any], iterations: int) -> List[float]:
+    durations = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        func()
+        durations.append(time.perf_counter() - started)
+    return durations
+
+
+def bench_probe(server: MockAnthropicServer, iterations: int) -> Dict[str, Any]:
+    """Thời gian test_api_key (không dùng cache) với từng cách kiểm tra"""
+    handler = mock_handler(server)
+    return {
+        probe: summarize(_timed(lambda: handler.test_api_key(use_cache=False, probe=probe), iterations))
+        for probe in ("models", "messages")
+    }
+
+
+def bench_overhead(server: MockAnthropicServer, iterations: int, model: str = DEFAULT_MODEL) -> Dict[str, Any]:
+    """
+    Chi phí của handler so với gọi SDK trực tiếp (mock không chờ TTFT / token)
+
+    Args:
+        server: Mock server
+        iterations: Số request mỗi phép đo
+        model: Model ID
+
+    Returns:
+        Số đo của SDK, handler và chênh lệch p50 cho streaming và không streaming
+    """
+    server.configure(ttft=0.0, tokens_per_second=0.0)
+    handler = mock_handler(server)
+    client = handler.client.with_options(max_retries=0)
+    params = {"model": model, "messages": _MESSAGES, "max_tokens": 1024}
+
+    def sdk_stream():
+        with client.messages.create(**params, stream=True) as stream:
+            for _ in stream:
+                pass
+
+    def handler_stream():
+        for _ in handler.stream_response(model, _MESSAGES, max_tokens=1024, accumulator=ResponseAccumulator()):
+            pass
+
+    results = {}
+    for name, sdk_call, handler_call in (
+        ("streaming", sdk_stream, handler_stream),
+        ("non_streaming", lambda: client.messages.create(**params),
+         lambda: handler.get_response(model, _MESSAGES, max_tokens=1024, accumulator=ResponseAccumulator()))
+    ):
+        # Lượt đầu để mở kết nối, không tính vào kết quả
+        sdk_call()
+        handler_call()
+        sdk = summarize(_timed(sdk_call, iterations))
+        wrapped = summarize(_timed(handler_call, iterations))
+        results[name] = {"sdk": sdk, "handler": wrapped, "overhead_p50": wrapped["p50"] - sdk["p50"]}
+    return results
+
+
+def bench_render(server: MockAnthropicServer, iterations: int, model: str = DEFAULT_MODEL) -> Dict[str, Any]:
+    """
+    Vòng lặp streaming kiểu generate_response: render sau mỗi chunk so với RenderScheduler
+
+    Hàm render mô phỏng chi phí của Streamlit: chuẩn bị markdown và tuần tự
+    hóa toàn bộ nội dung hiện tại.
+
+    Args:
+        server: Mock server
+        iterations: Số response mỗi cách render
+        model: Model ID
+
+    Returns:
+        Số đo của từng cách render và tỷ lệ tăng tốc
+    """
+    server.configure(ttft=0.0, tokens_per_second=0.0)
+    handler = mock_handler(server)
+
+    def render(text: str) -> None:
+        json.dumps({"markdown": close_code_fences(text + "▌")})
+
+    def every_chunk():
+        accumulator = ResponseAccumulator()
+        renders = 0
+        for _ in handler.stream_response(model, _MESSAGES, max_tokens=1024, accumulator=accumulator):
+            render(accumulator.snapshot())
+            renders += 1
+        return accumulator, renders
+
+    def scheduled():
+        accumulator = ResponseAccumulator()
+        scheduler = RenderScheduler(render=render, snapshot=accumulator.snapshot)
+        for chunk in handler.stream_response(model, _MESSAGES, max_tokens=1024, accumulator=accumulator):
+            scheduler.push(chunk)
+        scheduler.flush()
+        return accumulator, scheduler.renders
+
+    results = {}
+    for name, loop in (("every_chunk", every_chunk), ("scheduled", scheduled)):
+        loop()
+        durations, renders, chunks = [], 0, 0
+        for _ in range(iterations):
+            started = time.perf_counter()
+            accumulator, count = loop()
+            durations.append(time.perf_counter() - started)
+            renders += count
+            chunks += accumulator.usage.get("output_tokens", 0)
+        total = sum(durations)
+        results[name] = {
+            "duration": summarize(durations),
+            "renders_per_response": renders / iterations,
+            "chunks_per_second": chunks / total if total else None
+        }
+    every, sched = results["every_chunk"]["duration"]["p50"], results["scheduled"]["duration"]["p50"]
+    results["speedup"] = every / sched if sched else None
+    return results
+
+
+def bench_concurrency(
+    server: MockAnthropicServer,
+    levels: List[int],
+    iterations: int,
+    ttft: float,
+    tokens_per_second: float,
+    model: str = DEFAULT_MODEL
+) -> Dict[str, Any]:
+    """
+    Thông lượng và độ trễ khi nhiều stream chạy đồng thời qua cùng một handler
+
+    Args:
+        server: Mock server
+        levels: Các mức request đồng thời
+        iterations: Số request ở mỗi mức (ít nhất bằng mức đồng thời)
+        ttft: TTFT của mock
+        tokens_per_second: Tốc độ token của mock
+        model: Model ID
+
+    Returns:
+        Số đo theo từng mức đồng thời
+    """
+    server.configure(ttft=ttft, tokens_per_second=tokens_per_second)
+    handler = mock_handler(server)
+
+    def one_request() -> Dict[str, Any]:
+        accumulator = ResponseAccumulator()
+        started = time.perf_counter()
+        first_token = None
+        for _ in handler.stream_response(model, _MESSAGES, max_tokens=1024, accumulator=accumulator):
+            if first_token is None:
+                first_token = time.perf_counter() - started
+        return {
+            "ttft": first_token,
+            "latency": time.perf_counter() - started,
+            "tokens": accumulator.usage.get("output_tokens", 0),
+            "error": accumulator.error is not None
+        }
+
+    results = {}
+    for level in levels:
+        count = max(iterations, level)
+        with ThreadPoolExecutor(max_workers=level) as executor:
+            started = time.perf_counter()
+            runs = list(executor.map(lambda _: one_request(), range(count)))
+            elapsed = time.perf_counter() - started
+        ok = [run for run in runs if not run["error"]]
+        results[str(level)] = {
+            "requests": count,
+            "errors": count - len(ok),
+            "requests_per_second": len(ok) / elapsed,
+            "tokens_per_second": sum(run["tokens"] for run in ok) / elapsed,
+            "ttft": summarize([run["ttft"] for run in ok if run["ttft"] is not None]),
+            "latency": summarize([run["latency"] for run in ok])
+        }
+    return results
+
+
+def flatten(data: Dict[str, Any], prefix: str = "") -> Dict[str, float]:
+    """Chuyển kết quả lồng nhau thành {"a.b.c": số}"""
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat.update(flatten(value, name + "."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = float(value)
+    return flat
+
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float) -> List[str]:
+    """
+    So sánh kết quả với lần chạy trước
+
+    Args:
+        baseline: Kết quả cũ (nội dung file JSON)
+        current: Kết quả mới
+        threshold: Tỷ lệ thay đổi tối thiểu được coi là regression (ví dụ 0.1 = 10%)
+
+    Returns:
+        Danh sách chỉ số bị regression
+    """
+    old, new = flatten(baseline["results"]), flatten(current["results"])
+    regressions = []
+    for name in sorted(old.keys() & new.keys()):
+        # min / max quá nhiễu để so sánh giữa các lần chạy
+        if not old[name] or name.endswith((".min", ".max")):
+            continue
+        change = (new[name] - old[name]) / abs(old[name])
+        worse = -change if any(marker in name for marker in _HIGHER_IS_BETTER) else change
+        flag = ""
+        if worse > threshold:
+            flag = "  ← regression"
+            regressions.append(name)
+        print(f"{name}: {old[name]:.6g} → {new[name]:.6g} ({change:+.1%}){flag}")
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None):
+    """Chạy benchmark từ dòng lệnh"""
+    scenarios = ("probe", "overhead", "render", "concurrency")
+    parser = argparse.ArgumentParser(description="Benchmark độ trễ end-to-end với mock Anthropic API")
+    parser.add_argument("--scenarios", default=",".join(scenarios), help=f"Các phép đo ({', '.join(scenarios)})")
+    parser.add_argument("--iterations", type=int, default=BENCHMARK_ITERATIONS)
+    parser.add_argument("--concurrency", default=",".join(str(level) for level in BENCHMARK_CONCURRENCY))
+    parser.add_argument("--ttft", type=float, default=MOCK_TTFT, help="TTFT của mock khi đo đồng thời")
+    parser.add_argument("--tokens-per-second", type=float, default=MOCK_TOKENS_PER_SECOND)
+    parser.add_argument("--output-tokens", type=int, default=MOCK_OUTPUT_TOKENS)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    parser.add_argument("--output", default=BENCHMARK_OUTPUT, help="File JSON nhận kết quả")
+    parser.add_argument("--compare", default=None, help="File JSON của lần chạy trước để so sánh")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Tỷ lệ thay đổi được coi là regression")
+    args = parser.parse_args(argv)
+
+    selected = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(selected) - set(scenarios)
+    if unknown:
+        parser.error(f"Phép đo không hợp lệ: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    results: Dict[str, Any] = {}
+    with MockAnthropicServer(output_tokens=args.output_tokens) as server:
+        for name in selected:
+            print(f"▶ {name}", file=sys.stderr)
+            if name == "probe":
+                results[name] = bench_probe(server, args.iterations)
+            elif name == "overhead":
+                results[name] = bench_overhead(server, args.iterations, args.model)
+            elif name == "render":
+                results[name] = bench_render(server, args.iterations, args.model)
+            else:
+                results[name] = bench_concurrency(
+                    server, levels, args.iterations, args.ttft, args.tokens_per_second, args.model
+                )
+
+    report = {
+        "meta": {
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "anthropic": anthropic.__version__,
+            "model": args.model,
+            "iterations": args.iterations,
+            "mock": {
+                "ttft": args.ttft,
+                "tokens_per_second": args.tokens_per_second,
+                "output_tokens": args.output_tokens
+            }
+        },
+        "results": results
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+    print(f"Đã ghi kết quả vào {args.output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if compare(baseline, report, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+import anthropic
+
+from config import CLIENT_POOL_MAX_SIZE, CLIENT_POOL_IDLE_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+
+def hash_api_key(api_key: str) -> str:
+    """
+    Tạo khóa định danh cho API key để không giữ key gốc làm khóa dictionary
+
+    Args:
+        api_key: API key
+
+    Returns:
+        SHA-256 hex digest của API key
+    """
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+
+class ClientPool:
+    """Pool các Anthropic client theo API key, có LRU eviction và idle timeout
+
+    Tất cả client trong pool dùng chung một HTTP client (connection pool), nên
+    các session khác nhau tái sử dụng được kết nối TLS đã mở sẵn.
+    """
+
+    def __init__(
+        self,
+        client_factory: Callable[..., Any],
+        http_client_factory: Optional[Callable[[], Any]] = None,
+        max_size: int = CLIENT_POOL_MAX_SIZE,
+        idle_timeout: float = CLIENT_POOL_IDLE_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Khởi tạo pool
+
+        Args:
+            client_factory: Hàm tạo client (anthropic.Anthropic hoặc anthropic.AsyncAnthropic)
+            http_client_factory: Hàm tạo HTTP client dùng chung (tùy chọn)
+            max_size: Số client tối đa giữ trong pool
+            idle_timeout: Số giây không dùng trước khi client bị loại khỏi pool
+            clock: Hàm lấy thời gian (dùng để test)
+        """
+        self.client_factory = client_factory
+        self.http_client_factory = http_client_factory
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._http_client = None
+        self._clients: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _shared_http_client(self):
+        if self._http_client is None and self.http_client_factory is not None:
+            self._http_client = self.http_client_factory()
+        return self._http_client
+
+    def _evict_idle(self, now: float) -> None:
+        # OrderedDict được sắp theo thời điểm dùng gần nhất nên chỉ cần xét từ đầu
+        while self._clients:
+            key, entry = next(iter(self._clients.items()))
+            if now - entry["last_used"] < self.idle_timeout:
+                break
+            del self._clients[key]
+            self.evictions += 1
+
+    def get(self, api_key: str) -> Any:
+        """
+        Lấy client cho API key, tạo mới nếu chưa có trong pool
+
+        Args:
+            api_key: API key
+
+        Returns:
+            Client tương ứng với API key
+        """
+        key = hash_api_key(api_key)
+        now = self._clock()
+
+        with self._lock:
+            self._evict_idle(now)
+
+            entry = self._clients.get(key)
+            if entry is not None:
+                entry["last_used"] = now
+                self._clients.move_to_end(key)
+                self.hits += 1
+                return entry["client"]
+
+            self.misses += 1
+            kwargs = {"api_key": api_key}
+            http_client = self._shared_http_client()
+            if http_client is not None:
+                kwargs["http_client"] = http_client
+            client = self.client_factory(**kwargs)
+
+            self._clients[key] = {"client": client, "last_used": now}
+            while len(self._clients) > self.max_size:
+                self._clients.popitem(last=False)
+                self.evictions += 1
+
+            logger.debug(f"Client pool: tạo client mới ({len(self._clients)}/{self.max_size})")
+            return client
+
+    def discard(self, api_key: str) -> None:
+        """
+        Loại client của API key khỏi pool
+
+        Args:
+            api_key: API key
+        """
+        with self._lock:
+            if self._clients.pop(hash_api_key(api_key), None) is not None:
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê hoạt động của pool
+
+        Returns:
+            Dictionary gồm kích thước, số hit, miss và eviction
+        """
+        with self._lock:
+            return {
+                "size": len(self._clients),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+    def close(self) -> None:
+        """Xóa toàn bộ client và đóng HTTP client dùng chung (đồng bộ)"""
+        with self._lock:
+            self._clients.clear()
+            http_client, self._http_client = self._http_client, None
+        if http_client is not None:
+            http_client.close()
+
+    async def aclose(self) -> None:
+        """Xóa toàn bộ client và đóng HTTP client dùng chung (bất đồng bộ)"""
+        with self._lock:
+            self._clients.clear()
+            http_client, self._http_client = self._http_client, None
+        if http_client is not None:
+            await http_client.aclose()
+
+
+# Pool dùng chung trong process cho client đồng bộ và bất đồng bộ
+client_pool = ClientPool(anthropic.Anthropic, anthropic.DefaultHttpxClient)
+async_client_pool = ClientPool(anthropic.AsyncAnthropic, anthropic.DefaultAsyncHttpxClient)
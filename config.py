@@ -13,7 +13,7 @@ PAGE_TITLE = "Claude AI Chat qua API cho rẻ hẹ hẹ hẹ"
 PAGE_ICON = "🤖"
 
 # Chat Configuration
-MAX_HISTORY_LENGTH = 10  # Giới hạn số tin nhắn trong lịch sử
+CONTEXT_SAFETY_MARGIN = 1024  # Số token chừa lại khi đóng gói lịch sử vào context window
 DEFAULT_SYSTEM_PROMPT = "You are a helpful assistant."
 
 # Model Configuration
@@ -23,6 +23,136 @@ DEFAULT_MODEL = "claude-3-haiku-20240307"
 SIDEBAR_WIDTH = 300
 CHAT_INPUT_PLACEHOLDER = "Nhập tin nhắn của bạn..."
 
+# Streaming render Configuration
+RENDER_INTERVAL_MS = 50  # Khoảng thời gian tối thiểu giữa 2 lần render lại
+RENDER_MAX_CHARS = 256  # Số ký tự tích lũy tối đa trước khi buộc render lại
+
+# Background generation Configuration
+GENERATION_MAX_WORKERS = 8  # Số response được tạo song song tối đa trong process
+GENERATION_BUFFER_CHUNKS = 1024  # Số chunk gần nhất được giữ trong bộ đệm vòng của mỗi generation
+GENERATION_RETENTION = 600  # Số giây giữ lại generation đã xong để UI lấy kết quả
+
+# Chat history rendering Configuration
+CHAT_RENDER_WINDOW = 20  # Số tin nhắn cuối luôn được hiển thị đầy đủ
+CHAT_HISTORY_PAGE_SIZE = 20  # Số tin nhắn cũ được mở thêm mỗi lần
+CHAT_RENDER_CACHE_SIZE = 2048  # Số tin nhắn tối đa được memo nội dung hiển thị
+CHAT_PREVIEW_CHARS = 80  # Độ dài tóm tắt của tin nhắn bị thu gọn
+
+# Client pool Configuration
+CLIENT_POOL_MAX_SIZE = 32  # Số client (API key) tối đa giữ trong pool
+CLIENT_POOL_IDLE_TIMEOUT = 900  # Số giây không dùng trước khi client bị loại khỏi pool
+
+# API key validation Configuration
+API_KEY_VALIDATION_TTL = 3600  # Thời gian cache kết quả API key hợp lệ (giây)
+API_KEY_NEGATIVE_TTL = 300  # Thời gian cache kết quả API key không hợp lệ (giây)
+API_KEY_CACHE_MAX_ENTRIES = 4096  # Số kết quả kiểm tra API key tối đa giữ trong cache (LRU)
+API_KEY_PROBE = os.getenv("API_KEY_PROBE", "models")  # "models" (miễn phí) hoặc "messages"
+
+# Token counting Configuration
+TOKEN_COUNT_CACHE_SIZE = 4096  # Số kết quả đếm token giữ trong LRU cache
+
+# Prompt caching Configuration
+PROMPT_CACHING = True  # Tự động gắn cache_control breakpoint cho request
+PROMPT_CACHE_DOCUMENT_FACTOR = 2  # Tin nhắn dài hơn (hệ số x độ dài cache tối thiểu) được xem là tài liệu
+
+# File processing Configuration
+PDF_MAX_WORKERS = min(4, os.cpu_count() or 1)  # Số process trích xuất PDF song song
+PDF_MAX_IN_FLIGHT = 16  # Số trang tối đa đang được trích xuất cùng lúc
+PDF_PARALLEL_MIN_PAGES = 20  # PDF ít trang hơn được trích xuất tuần tự
+
+# Document cache Configuration
+DOCUMENT_CACHE_DIR = os.getenv(
+    "DOCUMENT_CACHE_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "claude-chat", "documents")
+)
+DOCUMENT_CACHE_MEMORY_BYTES = 64 * 1024 * 1024  # Dung lượng tối đa của cache trong bộ nhớ
+DOCUMENT_CACHE_DISK_BYTES = 512 * 1024 * 1024  # Dung lượng tối đa của cache trên đĩa (đã nén)
+
+# Response cache Configuration (chỉ áp dụng cho request có temperature = 0)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "False").lower() == "true"
+RESPONSE_CACHE_PATH = os.getenv(
+    "RESPONSE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "claude-chat", "responses.sqlite3")
+)
+RESPONSE_CACHE_TTL = 24 * 3600  # Thời gian sống của response đã cache (giây)
+RESPONSE_CACHE_MEMORY_ENTRIES = 256  # Số response tối đa trong bộ nhớ
+RESPONSE_CACHE_DISK_BYTES = 64 * 1024 * 1024  # Dung lượng tối đa của SQLite cache (đã nén)
+RESPONSE_CACHE_CHUNK_CHARS = 24  # Kích thước chunk khi phát lại response đã cache
+
+# Conversation store Configuration
+CONVERSATION_DB_PATH = os.getenv(
+    "CONVERSATION_DB_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "claude-chat", "conversations.sqlite3")
+)
+CONVERSATION_TITLE_CHARS = 60  # Độ dài tối đa của tiêu đề hội thoại
+CONVERSATION_LIST_LIMIT = 20  # Số hội thoại hiển thị mỗi trang trong sidebar
+
+# Document retrieval Configuration
+RETRIEVAL_INDEX_DIR = os.getenv(
+    "RETRIEVAL_INDEX_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "claude-chat", "indexes")
+)
+RETRIEVAL_CHUNK_TOKENS = 400  # Kích thước mỗi đoạn tài liệu (token)
+RETRIEVAL_CHUNK_OVERLAP = 80  # Số token tối đa lặp lại giữa 2 đoạn liên tiếp
+RETRIEVAL_TOP_K = 6  # Số đoạn liên quan nhất được chèn vào mỗi câu hỏi
+RETRIEVAL_TOKEN_BUDGET = 3000  # Tổng số token tối đa của các đoạn được chèn
+
+# Batch processing Configuration
+BATCH_MAX_REQUESTS = 10000  # Số request tối đa trong một batch
+BATCH_POLL_INTERVAL = 30  # Số giây giữa 2 lần poll trạng thái batch
+BATCH_RECONCILE_WINDOW = 300  # Số giây lệch đồng hồ cho phép khi đối chiếu batch đang submit dở với batches.list
+
+# Request scheduler Configuration
+SCHEDULER_REQUESTS_PER_MINUTE = 50  # Số request tối đa mỗi phút cho mỗi API key
+SCHEDULER_TOKENS_PER_MINUTE = 40000  # Số input token tối đa mỗi phút cho mỗi API key
+SCHEDULER_MAX_RETRIES = 4  # Số lần thử lại tối đa với lỗi tạm thời (429, 529, lỗi kết nối)
+SCHEDULER_BACKOFF_BASE = 1.0  # Thời gian chờ cơ bản (giây) cho exponential backoff
+SCHEDULER_BACKOFF_MAX = 30.0  # Thời gian chờ tối đa (giây) giữa 2 lần thử
+
+# Stream resume Configuration
+STREAM_MAX_RESUMES = 2  # Số lần nối tiếp tối đa khi stream bị ngắt giữa chừng
+
+# Model routing Configuration
+ROUTER_TARGET = "cost"  # "cost", "latency" hoặc "quality"
+ROUTER_LONG_CONTEXT_TOKENS = 8000  # Context dài hơn mức này cần model từ tier 2
+ROUTER_LONG_PROMPT_TOKENS = 1500  # Câu hỏi dài hơn mức này cần model từ tier 2
+ROUTER_EXPECTED_OUTPUT_TOKENS = 500  # Số output token giả định khi ước tính chi phí
+ROUTER_MAX_ESCALATIONS = 2  # Số lần chuyển lên model mạnh hơn khi response bị cắt (max_tokens)
+
+# Cost budget Configuration
+SESSION_BUDGET_USD = float(os.getenv("SESSION_BUDGET_USD", "0"))  # Ngân sách mỗi phiên (USD), 0 = không giới hạn
+SESSION_BUDGET_ACTION = os.getenv("SESSION_BUDGET_ACTION", "refuse")  # "refuse" hoặc "downgrade" khi vượt ngân sách
+SESSION_BUDGET_DOWNGRADE_MODEL = "claude-3-5-haiku-20241022"  # Model dùng khi hạ cấp
+COST_LEDGER_MAX_SESSIONS = 4096  # Số phiên tối đa giữ trong sổ chi phí (phiên ít dùng nhất bị loại trước)
+COST_LEDGER_IDLE_TIMEOUT = 24 * 3600  # Số giây không hoạt động trước khi chi phí và ngân sách của phiên bị loại
+
+# Metrics Configuration
+METRICS_SINK = os.getenv("METRICS_SINK", "none")  # "none", "prometheus", "spans" (có thể kết hợp: "prometheus,spans")
+METRICS_MAX_SPANS = 1000  # Số span gần nhất được giữ trong bộ nhớ
+
+# HTTP gateway Configuration
+GATEWAY_HOST = os.getenv("GATEWAY_HOST", "127.0.0.1")  # Địa chỉ lắng nghe của gateway
+GATEWAY_PORT = int(os.getenv("GATEWAY_PORT", "8080"))  # Cổng lắng nghe của gateway
+GATEWAY_MAX_ACTIVE = 256  # Số request được xử lý đồng thời tối đa
+GATEWAY_QUEUE_TIMEOUT = 5.0  # Số giây request chờ chỗ trống trước khi bị trả về 503
+GATEWAY_KEY_CONCURRENCY = 8  # Số request đồng thời tối đa của mỗi API key (vượt quá trả về 429)
+GATEWAY_MAX_KEYS = 1024  # Số handler (theo API key) tối đa được giữ lại
+GATEWAY_MAX_BODY_BYTES = 10 * 1024 * 1024  # Kích thước body tối đa của request
+GATEWAY_HEADER_TIMEOUT = 30.0  # Số giây chờ tối đa để nhận xong header của request
+GATEWAY_WRITE_BUFFER_BYTES = 64 * 1024  # Ngưỡng bộ đệm ghi; stream tạm dừng đọc upstream khi client đọc chậm
+GATEWAY_STUB_TOKEN_DELAY = 0.01  # Số giây giữa 2 token của upstream giả lập (--stub)
+
+# Mock server và benchmark Configuration
+MOCK_HOST = "127.0.0.1"  # Địa chỉ lắng nghe của mock server
+MOCK_PORT = 8090  # Cổng mặc định của mock server (0 để chọn cổng trống)
+MOCK_TTFT = 0.2  # Số giây trước token đầu tiên
+MOCK_TOKENS_PER_SECOND = 100.0  # Tốc độ sinh token (0 = không chờ)
+MOCK_OUTPUT_TOKENS = 200  # Số token text của mỗi response (bị giới hạn bởi max_tokens)
+MOCK_THINKING_TOKENS = 100  # Số token thinking khi request bật thinking
+BENCHMARK_OUTPUT = "benchmark_results.json"  # File JSON nhận kết quả benchmark
+BENCHMARK_ITERATIONS = 20  # Số request mỗi phép đo
+BENCHMARK_CONCURRENCY = (1, 2, 4, 8, 16)  # Các mức request đồng thời được đo
+
 # Debug mode
 DEBUG = os.getenv("DEBUG", "False").lower() == "true"
 
@@ -0,0 +1,202 @@
+import logging
+import re
+from typing import Any, Callable, Dict, List, Optional
+
+from config import CONTEXT_SAFETY_MARGIN
+from token_counter import TokenCounter, token_counter, content_hash
+
+logger = logging.getLogger(__name__)
+
+_TOKEN_LIMIT_RE = re.compile(r"([\d.]+)\s*([KkMm]?)")
+
+SUMMARY_HEADER = "[Tóm tắt phần hội thoại trước]"
+
+
+def parse_token_limit(value: Any) -> int:
+    """
+    Chuyển giới hạn token dạng hiển thị ("200K", "32000 tokens") thành số nguyên
+
+    Args:
+        value: Giá trị trong MODELS
+
+    Returns:
+        Số token
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = _TOKEN_LIMIT_RE.search(str(value))
+    if not match:
+        raise ValueError(f"Không đọc được giới hạn token: {value!r}")
+    number, unit = float(match.group(1)), match.group(2).upper()
+    multiplier = {"": 1, "K": 1000, "M": 1000000}[unit]
+    return int(number * multiplier)
+
+
+def normalize_alternation(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Đảm bảo lịch sử bắt đầu bằng tin nhắn user và các role xen kẽ nhau
+
+    Tin nhắn assistant ở đầu bị bỏ, các tin nhắn liên tiếp cùng role được gộp lại.
+
+    Args:
+        messages: Danh sách tin nhắn
+
+    Returns:
+        Danh sách tin nhắn hợp lệ cho API
+    """
+    result: List[Dict[str, Any]] = []
+    for message in messages:
+        if not result and message["role"] != "user":
+            continue
+        if result and result[-1]["role"] == message["role"]:
+            previous = result[-1]
+            if isinstance(previous["content"], str) and isinstance(message["content"], str):
+                result[-1] = {**previous, "content": previous["content"] + "\n\n" + message["content"]}
+                continue
+            # Content dạng block: chỉ giữ tin nhắn mới hơn
+            result[-1] = message
+            continue
+        result.append(message)
+    return result
+
+
+class ContextWindowManager:
+    """Đóng gói lịch sử hội thoại vào ngân sách token của từng model"""
+
+    def __init__(
+        self,
+        models: Dict[str, Dict[str, Any]],
+        counter: TokenCounter = token_counter,
+        safety_margin: int = CONTEXT_SAFETY_MARGIN,
+        summarizer: Optional[Callable[[List[Dict[str, Any]]], str]] = None
+    ):
+        """
+        Khởi tạo context manager
+
+        Args:
+            models: Bảng thông tin model (MODELS)
+            counter: Token counter dùng để đếm tin nhắn
+            safety_margin: Số token chừa lại cho sai số của việc ước tính
+            summarizer: Hàm tóm tắt các lượt bị loại (tùy chọn); nếu không có thì các lượt cũ bị bỏ
+        """
+        self.models = models
+        self.counter = counter
+        self.safety_margin = safety_margin
+        self.summarizer = summarizer
+        self._summary_cache: Dict[str, str] = {}
+        self.last_stats: Dict[str, int] = {}
+
+    def budget(
+        self,
+        model: str,
+        max_tokens: int,
+        thinking: bool = False,
+        budget_tokens: int = 0,
+        system_prompt: Optional[str] = None
+    ) -> int:
+        """
+        Tính số token còn lại cho lịch sử hội thoại
+
+        Args:
+            model: Model ID
+            max_tokens: Số token tối đa cho response
+            thinking: Có bật extended thinking không
+            budget_tokens: Budget tokens cho thinking
+            system_prompt: System prompt (tùy chọn)
+
+        Returns:
+            Số token dành cho lịch sử
+        """
+        context_window = parse_token_limit(self.models.get(model, {}).get("context_window", "200K"))
+        reserved = max_tokens + self.safety_margin
+        if thinking:
+            reserved += budget_tokens
+        if system_prompt:
+            reserved += self.counter.count_text(system_prompt)
+        return max(0, context_window - reserved)
+
+    def fit(
+        self,
+        messages: List[Dict[str, Any]],
+        model: str,
+        max_tokens: int,
+        thinking: bool = False,
+        budget_tokens: int = 0,
+        system_prompt: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Chọn các lượt gần nhất vừa với ngân sách token của model
+
+        Duyệt từ tin nhắn mới nhất về cũ nhất; số token của mỗi tin nhắn được
+        cache theo hash nội dung nên mỗi lượt mới chỉ tốn công đếm tin nhắn mới.
+
+        Args:
+            messages: Toàn bộ lịch sử hội thoại (chỉ gồm role và content)
+            model: Model ID
+            max_tokens: Số token tối đa cho response
+            thinking: Có bật extended thinking không
+            budget_tokens: Budget tokens cho thinking
+            system_prompt: System prompt (tùy chọn)
+
+        Returns:
+            Danh sách tin nhắn gửi lên API
+        """
+        budget = self.budget(model, max_tokens, thinking, budget_tokens, system_prompt)
+
+        used = 0
+        start = len(messages)
+        while start > 0:
+            cost = self.counter.count_message(messages[start - 1])
+            # Luôn giữ tin nhắn mới nhất dù vượt ngân sách
+            if used + cost > budget and start < len(messages):
+                break
+            used += cost
+            start -= 1
+
+        if used > budget:
+            logger.warning(f"Tin nhắn mới nhất ({used} tokens) vượt ngân sách context ({budget} tokens)")
+
+        # Lượt được giữ phải bắt đầu bằng tin nhắn user
+        while start < len(messages) - 1 and messages[start]["role"] != "user":
+            used -= self.counter.count_message(messages[start])
+            start += 1
+
+        kept = normalize_alternation(messages[start:])
+        evicted = messages[:start]
+
+        if evicted and kept and self.summarizer is not None:
+            kept = self._prepend_summary(evicted, kept, budget - used)
+
+        self.last_stats = {
+            "budget": budget,
+            "used": used,
+            "kept": len(kept),
+            "evicted": len(evicted)
+        }
+        return kept
+
+    def _prepend_summary(
+        self,
+        evicted: List[Dict[str, Any]],
+        kept: List[Dict[str, Any]],
+        remaining: int
+    ) -> List[Dict[str, Any]]:
+        # Tóm tắt được cache theo phần lịch sử bị loại để không gọi lại mỗi lượt
+        key = content_hash([m["content"] for m in evicted])
+        summary = self._summary_cache.get(key)
+        if summary is None:
+            try:
+                summary = self.summarizer(evicted)
+            except Exception as e:
+                logger.warning(f"Không tóm tắt được lịch sử cũ: {str(e)}")
+                return kept
+            self._summary_cache = {key: summary}
+
+        first = kept[0]
+        if not summary or not isinstance(first["content"], str):
+            return kept
+        if self.counter.count_text(summary) > remaining:
+            return kept
+
+        first = {**first, "content": f"{SUMMARY_HEADER}\n{summary}\n\n{first['content']}"}
+        return [first] + kept[1:]
@@ -0,0 +1,276 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from config import CONVERSATION_DB_PATH, CONVERSATION_TITLE_CHARS
+
+logger = logging.getLogger(__name__)
+
+# Các trường của tin nhắn có cột riêng; các trường khác được lưu trong "extra"
+_MESSAGE_COLUMNS = ("role", "content", "thinking", "model")
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS conversations ("
+    "id TEXT PRIMARY KEY, owner TEXT, title TEXT NOT NULL DEFAULT '', model TEXT, settings TEXT, "
+    "created_at REAL NOT NULL, updated_at REAL NOT NULL, message_count INTEGER NOT NULL DEFAULT 0)",
+    "CREATE TABLE IF NOT EXISTS messages ("
+    "conversation_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, "
+    "thinking TEXT, model TEXT, extra TEXT, created_at REAL NOT NULL, "
+    "PRIMARY KEY (conversation_id, seq)) WITHOUT ROWID"
+)
+
+# Chỉ mục được tạo sau khi cột owner đã có (file cũ được bổ sung cột trong _connection)
+_INDEXES = (
+    "DROP INDEX IF EXISTS conversations_updated_at",
+    "DROP INDEX IF EXISTS conversations_model_updated_at",
+    "CREATE INDEX IF NOT EXISTS conversations_owner_updated_at ON conversations (owner, updated_at, id)",
+    "CREATE INDEX IF NOT EXISTS conversations_owner_model_updated_at "
+    "ON conversations (owner, model, updated_at, id)"
+)
+
+
+class ConversationStore:
+    """Lưu hội thoại trong SQLite (WAL), mỗi tin nhắn là một lần ghi
+
+    Tin nhắn chỉ được thêm vào (append-only); danh sách hội thoại được đánh
+    chỉ mục theo chủ sở hữu, thời gian cập nhật và model, tin nhắn chỉ được
+    đọc khi mở hội thoại. Chủ sở hữu là một chuỗi định danh không chứa bí mật
+    (ví dụ hash của API key); mỗi chủ sở hữu chỉ thấy hội thoại của mình.
+    """
+
+    def __init__(self, db_path: str = CONVERSATION_DB_PATH, clock: Callable[[], float] = time.time):
+        """
+        Khởi tạo store (kết nối được mở khi dùng lần đầu)
+
+        Args:
+            db_path: File SQLite (":memory:" để chỉ dùng bộ nhớ)
+            clock: Hàm lấy thời gian
+        """
+        self.db_path = db_path
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        """Mở kết nối và tạo schema khi cần (gọi khi đang giữ lock)"""
+        if self._db is None:
+            if self.db_path != ":memory:":
+                os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            db = sqlite3.connect(self.db_path, check_same_thread=False)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            for statement in _SCHEMA:
+                db.execute(statement)
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(conversations)")}
+            if "owner" not in columns:
+                # Hội thoại tạo trước khi có cột owner không thuộc về ai và không được liệt kê
+                db.execute("ALTER TABLE conversations ADD COLUMN owner TEXT")
+            for statement in _INDEXES:
+                db.execute(statement)
+            db.commit()
+            self._db = db
+        return self._db
+
+    def create_conversation(
+        self,
+        owner: Optional[str],
+        title: str = "",
+        model: Optional[str] = None,
+        settings: Optional[Dict[str, Any]] = None
+    ) -> str:
+        """
+        Tạo hội thoại mới
+
+        Args:
+            owner: Định danh chủ sở hữu (ví dụ hash của API key)
+            title: Tiêu đề (mặc định lấy từ tin nhắn đầu tiên của user)
+            model: Model đang dùng
+            settings: Cài đặt model của hội thoại
+
+        Returns:
+            ID hội thoại
+        """
+        conversation_id = uuid.uuid4().hex
+        now = self._clock()
+        with self._lock:
+            db = self._connection()
+            with db:
+                db.execute(
+                    "INSERT INTO conversations (id, owner, title, model, settings, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (conversation_id, owner, title, model, json.dumps(settings or {}, ensure_ascii=False), now, now)
+                )
+        return conversation_id
+
+    def append_message(self, conversation_id: str, message: Dict[str, Any], model: Optional[str] = None) -> int:
+        """
+        Thêm một tin nhắn vào cuối hội thoại
+
+        Args:
+            conversation_id: ID hội thoại
+            message: Tin nhắn ("role", "content", có thể kèm "thinking", "model", ...)
+            model: Model đang dùng (cập nhật model của hội thoại, tùy chọn)
+
+        Returns:
+            Số thứ tự của tin nhắn trong hội thoại
+        """
+        extra = {k: v for k, v in message.items() if k not in _MESSAGE_COLUMNS}
+        model = model or message.get("model")
+        now = self._clock()
+        with self._lock:
+            db = self._connection()
+            with db:
+                row = db.execute(
+                    "SELECT message_count, title FROM conversations WHERE id = ?", (conversation_id,)
+                ).fetchone()
+                if row is None:
+                    raise KeyError(f"Không tìm thấy hội thoại {conversation_id}")
+                seq = row["message_count"]
+                db.execute(
+                    "INSERT INTO messages (conversation_id, seq, role, content, thinking, model, extra, created_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        conversation_id, seq, message["role"], message["content"],
+                        message.get("thinking"), message.get("model"),
+                        json.dumps(extra, ensure_ascii=False) if extra else None, now
+                    )
+                )
+                title = row["title"]
+                if not title and message["role"] == "user":
+                    title = " ".join(message["content"].split())[:CONVERSATION_TITLE_CHARS]
+                db.execute(
+                    "UPDATE conversations SET message_count = ?, updated_at = ?, title = ?, "
+                    "model = COALESCE(?, model) WHERE id = ?",
+                    (seq + 1, now, title, model, conversation_id)
+                )
+        return seq
+
+    def list_conversations(
+        self,
+        owner: str,
+        limit: int = 20,
+        before: Optional[Tuple[float, str]] = None,
+        model: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Liệt kê hội thoại mới cập nhật nhất của một chủ sở hữu (chỉ metadata)
+
+        Thứ tự là (updated_at, id) giảm dần nên các hội thoại có cùng
+        updated_at không bị bỏ sót hay lặp lại giữa các trang.
+
+        Args:
+            owner: Định danh chủ sở hữu
+            limit: Số hội thoại tối đa
+            before: Cặp (updated_at, id) của hội thoại cuối trang trước (phân trang)
+            model: Lọc theo model (tùy chọn)
+
+        Returns:
+            Danh sách {"id", "title", "model", "created_at", "updated_at", "message_count"}
+        """
+        query = "SELECT id, title, model, created_at, updated_at, message_count FROM conversations WHERE owner = ?"
+        args: List[Any] = [owner]
+        if model is not None:
+            query += " AND model = ?"
+            args.append(model)
+        if before is not None:
+            query += " AND (updated_at, id) < (?, ?)"
+            args.extend(before)
+        query += " ORDER BY updated_at DESC, id DESC LIMIT ?"
+        args.append(limit)
+        with self._lock:
+            rows = self._connection().execute(query, args).fetchall()
+        return [dict(row) for row in rows]
+
+    def get_conversation(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy metadata và cài đặt của hội thoại
+
+        Args:
+            conversation_id: ID hội thoại
+
+        Returns:
+            Dictionary metadata (kèm "settings"), hoặc None
+        """
+        with self._lock:
+            row = self._connection().execute(
+                "SELECT * FROM conversations WHERE id = ?", (conversation_id,)
+            ).fetchone()
+        if row is None:
+            return None
+        conversation = dict(row)
+        conversation["settings"] = json.loads(conversation["settings"] or "{}")
+        return conversation
+
+    def load_messages(
+        self,
+        conversation_id: str,
+        start: int = 0,
+        limit: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Đọc tin nhắn của hội thoại theo thứ tự
+
+        Args:
+            conversation_id: ID hội thoại
+            start: Số thứ tự tin nhắn bắt đầu
+            limit: Số tin nhắn tối đa (None để đọc hết)
+
+        Returns:
+            Danh sách tin nhắn
+        """
+        with self._lock:
+            rows = self._connection().execute(
+                "SELECT role, content, thinking, model, extra FROM messages "
+                "WHERE conversation_id = ? AND seq >= ? ORDER BY seq LIMIT ?",
+                (conversation_id, start, -1 if limit is None else limit)
+            ).fetchall()
+
+        messages = []
+        for row in rows:
+            message = {"role": row["role"], "content": row["content"]}
+            if row["thinking"]:
+                message["thinking"] = row["thinking"]
+            if row["model"]:
+                message["model"] = row["model"]
+            if row["extra"]:
+                message.update(json.loads(row["extra"]))
+            messages.append(message)
+        return messages
+
+    def delete_conversation(self, conversation_id: str, owner: str) -> bool:
+        """
+        Xóa hội thoại và toàn bộ tin nhắn
+
+        Args:
+            conversation_id: ID hội thoại
+            owner: Định danh chủ sở hữu (hội thoại của người khác không bị xóa)
+
+        Returns:
+            True nếu hội thoại đã bị xóa
+        """
+        with self._lock:
+            db = self._connection()
+            with db:
+                deleted = db.execute(
+                    "DELETE FROM conversations WHERE id = ? AND owner = ?", (conversation_id, owner)
+                ).rowcount
+                if deleted:
+                    db.execute("DELETE FROM messages WHERE conversation_id = ?", (conversation_id,))
+        return bool(deleted)
+
+    def close(self) -> None:
+        """Đóng kết nối"""
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+
+# Store dùng chung trong process
+conversation_store = ConversationStore()
@@ -0,0 +1,306 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Tuple
+
+from client_pool import hash_api_key
+from config import (
+    SESSION_BUDGET_USD, SESSION_BUDGET_ACTION, SESSION_BUDGET_DOWNGRADE_MODEL,
+    COST_LEDGER_MAX_SESSIONS, COST_LEDGER_IDLE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+# Trường usage -> khóa giá tương ứng trong MODELS[...]["price"] (USD / triệu token)
+USAGE_PRICE_FIELDS = (
+    ("input_tokens", "input"),
+    ("output_tokens", "output"),
+    ("cache_creation_input_tokens", "cache_write"),
+    ("cache_read_input_tokens", "cache_read")
+)
+
+BUDGET_REFUSE = "refuse"
+BUDGET_DOWNGRADE = "downgrade"
+
+
+class BudgetExceededError(Exception):
+    """Phiên đã dùng hết ngân sách và request bị từ chối"""
+
+
+def usage_cost(usage: Dict[str, int], price: Dict[str, float]) -> float:
+    """
+    Tính chi phí (USD) của usage theo bảng giá của model
+
+    Args:
+        usage: Dictionary usage (input, output, cache write, cache read)
+        price: Bảng giá USD / triệu token
+
+    Returns:
+        Chi phí USD
+    """
+    total = 0.0
+    for field, price_key in USAGE_PRICE_FIELDS:
+        tokens = usage.get(field)
+        if tokens:
+            total += tokens * price.get(price_key, 0.0)
+    return total / 1_000_000
+
+
+class CostTracker:
+    """Ghi usage của một request vào ledger theo từng phần tăng thêm
+
+    Usage trong stream là số cộng dồn (message_delta), nên tracker chỉ ghi
+    phần chênh lệch so với lần cập nhật trước; mỗi lần cập nhật chỉ tốn vài
+    phép cộng.
+    """
+
+    __slots__ = ("_ledger", "_key", "_price", "_last", "cost")
+
+    def __init__(self, ledger: "CostLedger", key: Tuple[str, str, str], price: Dict[str, float]):
+        self._ledger = ledger
+        self._key = key
+        self._price = price
+        self._last: Dict[str, int] = {}
+        # Tổng chi phí (USD) đã ghi cho request
+        self.cost = 0.0
+
+    def update(self, usage: Dict[str, int], new_message: bool = False) -> None:
+        """
+        Ghi nhận usage cộng dồn mới nhất của request
+
+        Args:
+            usage: Usage hiện tại (cộng dồn trong một message)
+            new_message: True khi usage thuộc một message mới (ví dụ stream được
+                nối tiếp), phần đã ghi của message trước được giữ nguyên
+        """
+        if new_message:
+            self._last = {}
+        delta = {}
+        for field, _ in USAGE_PRICE_FIELDS:
+            value = usage.get(field)
+            if value is None:
+                continue
+            increase = value - self._last.get(field, 0)
+            if increase > 0:
+                delta[field] = increase
+                self._last[field] = value
+        if delta:
+            cost = usage_cost(delta, self._price)
+            self.cost += cost
+            self._ledger.add(self._key, delta, cost)
+
+
+class CostLedger:
+    """Sổ chi phí theo phiên, API key và model, kèm ngân sách cho từng phiên
+
+    Phiên không hoạt động quá idle_timeout giây, hoặc ít dùng nhất khi vượt
+    max_sessions, bị loại khỏi sổ (giống client_pool) vì không biết được khi
+    nào một phiên Streamlit kết thúc.
+    """
+
+    def __init__(
+        self,
+        default_budget: float = SESSION_BUDGET_USD,
+        default_action: str = SESSION_BUDGET_ACTION,
+        downgrade_model: str = SESSION_BUDGET_DOWNGRADE_MODEL,
+        max_sessions: int = COST_LEDGER_MAX_SESSIONS,
+        idle_timeout: float = COST_LEDGER_IDLE_TIMEOUT,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Khởi tạo
+
+        Args:
+            default_budget: Ngân sách mặc định mỗi phiên (USD, 0 = không giới hạn)
+            default_action: Hành động khi vượt ngân sách ("refuse" / "downgrade")
+            downgrade_model: Model rẻ hơn dùng khi hạ cấp
+            max_sessions: Số phiên tối đa giữ trong sổ
+            idle_timeout: Số giây không hoạt động trước khi phiên bị loại
+            clock: Hàm lấy thời gian (dùng để test)
+        """
+        self.default_budget = default_budget
+        self.default_action = default_action
+        self.downgrade_model = downgrade_model
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._lock = threading.Lock()
+        # session_id -> (hash API key, model) -> usage và "cost"
+        self._entries: Dict[str, Dict[Tuple[str, str], Dict[str, float]]] = {}
+        self._session_costs: Dict[str, float] = {}
+        self._budgets: Dict[str, Tuple[float, str]] = {}
+        # Thời điểm hoạt động gần nhất của mỗi phiên, sắp theo thứ tự dùng
+        self._last_active: "OrderedDict[str, float]" = OrderedDict()
+        self.evictions = 0
+
+    def _touch(self, session_id: str) -> None:
+        """Ghi nhận phiên vừa hoạt động và loại các phiên cũ (gọi khi đang giữ _lock)"""
+        now = self._clock()
+        self._last_active[session_id] = now
+        self._last_active.move_to_end(session_id)
+        while self._last_active:
+            oldest, last_active = next(iter(self._last_active.items()))
+            if len(self._last_active) <= self.max_sessions and now - last_active < self.idle_timeout:
+                break
+            self._forget(oldest)
+            self.evictions += 1
+
+    def _forget(self, session_id: str) -> None:
+        self._entries.pop(session_id, None)
+        self._session_costs.pop(session_id, None)
+        self._budgets.pop(session_id, None)
+        self._last_active.pop(session_id, None)
+
+    def tracker(self, session_id: str, api_key: str, model: str, price: Dict[str, float]) -> CostTracker:
+        """
+        Tạo tracker ghi usage của một request
+
+        Args:
+            session_id: ID phiên
+            api_key: API key (chỉ lưu dạng hash)
+            model: Model ID
+            price: Bảng giá của model
+
+        Returns:
+            CostTracker
+        """
+        return CostTracker(self, (session_id, hash_api_key(api_key or ""), model), price)
+
+    def add(self, key: Tuple[str, str, str], usage: Dict[str, int], cost: float) -> None:
+        """
+        Cộng usage và chi phí vào ledger
+
+        Args:
+            key: (session_id, hash API key, model)
+            usage: Số token tăng thêm
+            cost: Chi phí tăng thêm (USD)
+        """
+        session_id = key[0]
+        with self._lock:
+            self._touch(session_id)
+            entries = self._entries.setdefault(session_id, {})
+            entry = entries.get(key[1:])
+            if entry is None:
+                entry = entries[key[1:]] = {"cost": 0.0}
+            entry["cost"] += cost
+            for field, value in usage.items():
+                entry[field] = entry.get(field, 0) + value
+            self._session_costs[session_id] = self._session_costs.get(session_id, 0.0) + cost
+
+    def session_cost(self, session_id: str) -> float:
+        """Tổng chi phí (USD) của phiên"""
+        return self._session_costs.get(session_id, 0.0)
+
+    def totals(
+        self,
+        session_id: Optional[str] = None,
+        api_key: Optional[str] = None,
+        model: Optional[str] = None
+    ) -> Dict[str, float]:
+        """
+        Tổng usage và chi phí theo bộ lọc
+
+        Args:
+            session_id: Lọc theo phiên (tùy chọn)
+            api_key: Lọc theo API key (tùy chọn)
+            model: Lọc theo model (tùy chọn)
+
+        Returns:
+            Dictionary tổng số token từng loại và "cost"
+        """
+        key_hash = hash_api_key(api_key) if api_key else None
+        result: Dict[str, float] = {"cost": 0.0}
+        with self._lock:
+            sessions = [self._entries.get(session_id, {})] if session_id is not None else list(self._entries.values())
+            for entries in sessions:
+                for (entry_key, entry_model), entry in entries.items():
+                    if key_hash is not None and entry_key != key_hash:
+                        continue
+                    if model is not None and entry_model != model:
+                        continue
+                    for field, value in entry.items():
+                        result[field] = result.get(field, 0) + value
+        return result
+
+    def breakdown(self, session_id: str) -> Dict[str, Dict[str, float]]:
+        """
+        Chi phí của phiên theo từng model
+
+        Args:
+            session_id: ID phiên
+
+        Returns:
+            Dictionary model ID -> usage và "cost"
+        """
+        result: Dict[str, Dict[str, float]] = {}
+        with self._lock:
+            for (_, entry_model), entry in self._entries.get(session_id, {}).items():
+                totals = result.setdefault(entry_model, {"cost": 0.0})
+                for field, value in entry.items():
+                    totals[field] = totals.get(field, 0) + value
+        return result
+
+    def set_budget(self, session_id: str, limit: float, action: str = BUDGET_REFUSE) -> None:
+        """
+        Đặt ngân sách cho phiên
+
+        Args:
+            session_id: ID phiên
+            limit: Ngân sách USD (0 = không giới hạn)
+            action: "refuse" để từ chối, "downgrade" để chuyển sang model rẻ hơn
+        """
+        if action not in (BUDGET_REFUSE, BUDGET_DOWNGRADE):
+            raise ValueError(f"Hành động ngân sách không hợp lệ: {action}")
+        with self._lock:
+            self._touch(session_id)
+            self._budgets[session_id] = (limit, action)
+
+    def budget(self, session_id: str) -> Tuple[float, str]:
+        """Ngân sách (USD) và hành động khi vượt ngân sách của phiên"""
+        return self._budgets.get(session_id, (self.default_budget, self.default_action))
+
+    def check_budget(self, session_id: str, model: str) -> str:
+        """
+        Kiểm tra ngân sách trước khi gửi request
+
+        Args:
+            session_id: ID phiên
+            model: Model được yêu cầu
+
+        Returns:
+            Model sẽ được dùng (model rẻ hơn nếu phiên bị hạ cấp)
+
+        Raises:
+            BudgetExceededError: Phiên đã vượt ngân sách và hành động là "refuse"
+        """
+        with self._lock:
+            self._touch(session_id)
+        limit, action = self.budget(session_id)
+        spent = self.session_cost(session_id)
+        if not limit or spent < limit:
+            return model
+        if action == BUDGET_DOWNGRADE and self.downgrade_model:
+            if model != self.downgrade_model:
+                logger.info(f"Phiên vượt ngân sách ${spent:.4f}/${limit:.2f}, chuyển {model} -> {self.downgrade_model}")
+            return self.downgrade_model
+        raise BudgetExceededError(f"Phiên đã dùng ${spent:.4f}, vượt ngân sách ${limit:.2f}")
+
+    def reset_session(self, session_id: str) -> None:
+        """Xóa chi phí đã ghi của phiên (giữ ngân sách)"""
+        with self._lock:
+            self._entries.pop(session_id, None)
+            self._session_costs.pop(session_id, None)
+
+    def forget_session(self, session_id: str) -> None:
+        """Xóa mọi dữ liệu của phiên (chi phí và ngân sách), ví dụ khi phiên bị thay handler"""
+        with self._lock:
+            self._forget(session_id)
+
+    def session_count(self) -> int:
+        """Số phiên đang được giữ trong sổ"""
+        return len(self._last_active)
+
+
+# Ledger dùng chung trong process
+cost_ledger = CostLedger()
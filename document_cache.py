@@ -0,0 +1,209 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from config import DOCUMENT_CACHE_DIR, DOCUMENT_CACHE_MEMORY_BYTES, DOCUMENT_CACHE_DISK_BYTES
+
+logger = logging.getLogger(__name__)
+
+_HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file_obj) -> str:
+    """
+    Tính SHA-256 của nội dung file theo từng khối, không đọc toàn bộ vào bộ nhớ
+
+    Args:
+        file_obj: File-like object (con trỏ được đưa về đầu file sau khi tính)
+
+    Returns:
+        Hex digest
+    """
+    file_obj.seek(0)
+    digest = hashlib.sha256()
+    for block in iter(lambda: file_obj.read(_HASH_CHUNK_SIZE), b""):
+        digest.update(block)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+def page_offsets(pages: List[str]) -> List[int]:
+    """
+    Tính vị trí bắt đầu của mỗi trang trong văn bản đã nối
+
+    Args:
+        pages: Văn bản từng trang
+
+    Returns:
+        Danh sách offset (ký tự)
+    """
+    offsets = []
+    position = 0
+    for page in pages:
+        offsets.append(position)
+        position += len(page)
+    return offsets
+
+
+class DocumentCache:
+    """Cache văn bản trích xuất theo SHA-256 của file, gồm tầng bộ nhớ và tầng đĩa
+
+    Mỗi entry lưu văn bản từng trang và offset của trang. Trên đĩa, entry được
+    nén bằng zlib; cả 2 tầng đều bị giới hạn kích thước và loại bỏ theo LRU.
+    """
+
+    def __init__(
+        self,
+        cache_dir: Optional[str] = DOCUMENT_CACHE_DIR,
+        memory_bytes: int = DOCUMENT_CACHE_MEMORY_BYTES,
+        disk_bytes: int = DOCUMENT_CACHE_DISK_BYTES
+    ):
+        """
+        Khởi tạo cache
+
+        Args:
+            cache_dir: Thư mục của tầng đĩa (None để tắt tầng đĩa)
+            memory_bytes: Dung lượng tối đa của tầng bộ nhớ (ước tính theo byte văn bản)
+            disk_bytes: Dung lượng tối đa của tầng đĩa (byte đã nén)
+        """
+        self.cache_dir = cache_dir
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._memory: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._memory_size = 0
+        self._lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _entry_size(entry: Dict[str, Any]) -> int:
+        return sum(len(page) for page in entry["pages"]) * 2
+
+    def _disk_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"{digest}.json.z")
+
+    def _remember(self, digest: str, entry: Dict[str, Any]) -> None:
+        size = self._entry_size(entry)
+        if size > self.memory_bytes:
+            return
+        with self._lock:
+            previous = self._memory.pop(digest, None)
+            if previous is not None:
+                self._memory_size -= self._entry_size(previous)
+            self._memory[digest] = entry
+            self._memory_size += size
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= self._entry_size(evicted)
+
+    def get(self, digest: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy văn bản đã trích xuất theo digest
+
+        Args:
+            digest: SHA-256 của file
+
+        Returns:
+            Dictionary gồm "pages" và "offsets", hoặc None nếu chưa có
+        """
+        with self._lock:
+            entry = self._memory.get(digest)
+            if entry is not None:
+                self._memory.move_to_end(digest)
+                self.memory_hits += 1
+                return entry
+
+        if self.cache_dir:
+            path = self._disk_path(digest)
+            try:
+                with open(path, "rb") as f:
+                    entry = json.loads(zlib.decompress(f.read()).decode("utf-8"))
+                os.utime(path)  # Cập nhật thời điểm dùng cho LRU trên đĩa
+            except FileNotFoundError:
+                entry = None
+            except (OSError, ValueError, zlib.error) as e:
+                logger.warning(f"Không đọc được document cache {digest[:12]}: {str(e)}")
+                entry = None
+            if entry is not None:
+                with self._lock:
+                    self.disk_hits += 1
+                self._remember(digest, entry)
+                return entry
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, digest: str, pages: List[str]) -> Dict[str, Any]:
+        """
+        Lưu văn bản từng trang vào cache
+
+        Args:
+            digest: SHA-256 của file
+            pages: Văn bản từng trang
+
+        Returns:
+            Entry đã lưu
+        """
+        entry = {"pages": list(pages), "offsets": page_offsets(pages)}
+        self._remember(digest, entry)
+
+        if self.cache_dir:
+            try:
+                os.makedirs(self.cache_dir, exist_ok=True)
+                data = zlib.compress(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+                tmp_path = self._disk_path(digest) + ".tmp"
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._disk_path(digest))
+                self._evict_disk()
+            except OSError as e:
+                logger.warning(f"Không ghi được document cache: {str(e)}")
+        return entry
+
+    def _evict_disk(self) -> None:
+        """Xóa các entry dùng lâu nhất khi tầng đĩa vượt dung lượng"""
+        files = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json.z"):
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Thống kê cache
+
+        Returns:
+            Dictionary gồm số hit từng tầng, miss và tỷ lệ hit
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_bytes": self._memory_size,
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+# Cache dùng chung trong process
+document_cache = DocumentCache()
@@ -0,0 +1,173 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from context_manager import parse_token_limit
+from response_buffer import ResponseAccumulator, TEXT
+from stream_events import ERROR
+
+logger = logging.getLogger(__name__)
+
+# Đánh dấu một model đã stream xong trong hàng đợi sự kiện
+_DONE = object()
+
+
+class ModelRun:
+    """Kết quả và số đo thời gian của một model trong lần fan-out"""
+
+    def __init__(self, model: str):
+        """
+        Khởi tạo
+
+        Args:
+            model: Model ID
+        """
+        self.model = model
+        self.accumulator = ResponseAccumulator()
+        self.started_at: Optional[float] = None
+        self.first_token_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    def metrics(self) -> Dict[str, Any]:
+        """
+        Tính TTFT, tổng thời gian, số token và chi phí
+
+        Returns:
+            Dictionary số đo
+        """
+        usage = self.accumulator.usage
+        input_tokens = usage.get("input_tokens", 0)
+        output_tokens = usage.get("output_tokens", 0)
+
+        def elapsed(end):
+            if end is None or self.started_at is None:
+                return None
+            return end - self.started_at
+
+        return {
+            "ttft": elapsed(self.first_token_at),
+            "latency": elapsed(self.finished_at),
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "cost": self.accumulator.cost
+        }
+
+
+class FanOut:
+    """Gửi cùng một hội thoại tới nhiều model song song qua stream_channels"""
+
+    def __init__(self, handler: Any, models: List[str]):
+        """
+        Khởi tạo
+
+        Args:
+            handler: AnthropicHandler đã có API key
+            models: Danh sách model ID
+        """
+        self.handler = handler
+        self.models = list(models)
+        self.runs: Dict[str, ModelRun] = {model: ModelRun(model) for model in self.models}
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._cancelled = threading.Event()
+
+    def _model_params(self, model: str, max_tokens: int, thinking: bool) -> Dict[str, Any]:
+        """Điều chỉnh max_tokens và thinking theo khả năng của từng model"""
+        model_info = self.handler.get_model_info(model)
+        model_max = parse_token_limit(model_info.get("max_output", max_tokens))
+        thinking = thinking and model_info.get("extended_thinking", False)
+        return {"max_tokens": min(max_tokens, model_max), "thinking": thinking}
+
+    def _run(self, model: str, events: "queue.Queue", request: Dict[str, Any]) -> None:
+        run = self.runs[model]
+        run.started_at = time.perf_counter()
+        try:
+            params = {**request, **self._model_params(model, request["max_tokens"], request["thinking"])}
+            for channel, chunk in self.handler.stream_channels(model=model, accumulator=run.accumulator, **params):
+                # Thông báo lỗi không phải token: model lỗi sớm không được tính là nhanh nhất
+                if channel != ERROR and run.first_token_at is None:
+                    run.first_token_at = time.perf_counter()
+                # Chỉ text và lỗi được hiển thị (thinking vẫn nằm trong accumulator)
+                if channel == TEXT or channel == ERROR:
+                    events.put((model, chunk))
+                if self._cancelled.is_set():
+                    break
+        except Exception as e:
+            logger.error(f"Fan-out lỗi với model {model}: {str(e)}")
+        finally:
+            run.finished_at = time.perf_counter()
+            events.put((model, _DONE))
+
+    def stream(
+        self,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7
+    ) -> Generator[Tuple[str, str], None, None]:
+        """
+        Stream response của tất cả model, các chunk xen kẽ theo thứ tự đến
+
+        Tổng thời gian bằng thời gian của model chậm nhất, không phải tổng các model.
+
+        Args:
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+            max_tokens: Số token tối đa
+            thinking: Bật extended thinking (chỉ với model hỗ trợ)
+            budget_tokens: Budget tokens cho thinking
+            temperature: Temperature
+
+        Yields:
+            Cặp (model ID, chunk text)
+        """
+        request = {
+            "messages": messages,
+            "system_prompt": system_prompt,
+            "max_tokens": max_tokens,
+            "thinking": thinking,
+            "budget_tokens": budget_tokens,
+            "temperature": temperature
+        }
+        events: "queue.Queue" = queue.Queue()
+        self.started_at = time.perf_counter()
+
+        executor = ThreadPoolExecutor(max_workers=len(self.models), thread_name_prefix="fanout")
+        try:
+            for model in self.models:
+                executor.submit(self._run, model, events, request)
+
+            remaining = len(self.models)
+            while remaining:
+                model, chunk = events.get()
+                if chunk is _DONE:
+                    remaining -= 1
+                    continue
+                yield model, chunk
+        finally:
+            self._cancelled.set()
+            executor.shutdown(wait=False)
+            self.finished_at = time.perf_counter()
+
+    def wall_time(self) -> Optional[float]:
+        """Tổng thời gian của lần fan-out (giây)"""
+        if self.started_at is None or self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def metrics(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Số đo của từng model
+
+        Returns:
+            Dictionary model ID -> số đo
+        """
+        return {
+            model: run.metrics()
+            for model, run in self.runs.items()
+        }
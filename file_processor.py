@@ -1,7 +1,173 @@
-import io
+import os
+import shutil
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Generator, Optional
+
 import pypdf
 
-def process_uploaded_file(uploaded_file):
+from config import PDF_MAX_WORKERS, PDF_MAX_IN_FLIGHT, PDF_PARALLEL_MIN_PAGES
+from token_counter import token_counter
+from document_cache import document_cache, file_sha256, page_offsets
+
+# Kích thước mỗi khối khi ghi file upload ra file tạm
+_SPOOL_CHUNK_SIZE = 1024 * 1024
+
+# PdfReader riêng của mỗi process con (mở một lần trong initializer)
+_worker_reader = None
+
+
+def _init_worker(path):
+    """Mở file PDF một lần cho mỗi process con"""
+    global _worker_reader
+    _worker_reader = pypdf.PdfReader(path)
+
+
+def _extract_page(index):
+    """Trích xuất văn bản của một trang trong process con"""
+    return _worker_reader.pages[index].extract_text() or ""
+
+
+def _spool_to_tempfile(uploaded_file):
+    """Ghi tệp upload ra file tạm theo từng khối để các process con tự mở"""
+    uploaded_file.seek(0)
+    fd, path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        shutil.copyfileobj(uploaded_file, f, _SPOOL_CHUNK_SIZE)
+    return path
+
+
+def iter_pdf_pages(
+    uploaded_file,
+    max_workers: int = PDF_MAX_WORKERS,
+    max_in_flight: int = PDF_MAX_IN_FLIGHT,
+    token_budget: Optional[int] = None
+) -> Generator[str, None, None]:
+    """
+    Trích xuất văn bản PDF theo từng trang, trả về ngay khi mỗi trang xong
+
+    PDF nhỏ được xử lý tuần tự; PDF lớn được chia cho process pool với số
+    trang đang xử lý đồng thời bị giới hạn. Dừng sớm khi đạt token_budget,
+    hoặc khi caller ngừng duyệt generator.
+
+    Args:
+        uploaded_file: File-like object của tệp PDF
+        max_workers: Số process tối đa
+        max_in_flight: Số trang tối đa đang được xử lý cùng lúc
+        token_budget: Dừng sau trang làm tổng số token đạt ngưỡng này (tùy chọn)
+
+    Yields:
+        Văn bản của từng trang theo thứ tự
+    """
+    uploaded_file.seek(0)
+    reader = pypdf.PdfReader(uploaded_file)
+    page_count = len(reader.pages)
+    used_tokens = 0
+
+    if page_count < PDF_PARALLEL_MIN_PAGES or max_workers <= 1:
+        for page in reader.pages:
+            text = page.extract_text() or ""
+            yield text
+            if token_budget is not None:
+                used_tokens += token_counter.count_text(text)
+                if used_tokens >= token_budget:
+                    return
+        return
+
+    path = _spool_to_tempfile(uploaded_file)
+    executor = ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_worker,
+        initargs=(path,)
+    )
+    pending = deque()
+    try:
+        next_page = 0
+        while next_page < page_count or pending:
+            while next_page < page_count and len(pending) < max_in_flight:
+                pending.append(executor.submit(_extract_page, next_page))
+                next_page += 1
+
+            text = pending.popleft().result()
+            yield text
+            if token_budget is not None:
+                used_tokens += token_counter.count_text(text)
+                if used_tokens >= token_budget:
+                    return
+    finally:
+        for future in pending:
+            future.cancel()
+        executor.shutdown(wait=False, cancel_futures=True)
+        os.remove(path)
+
+
+def _trim_to_budget(pages, token_budget):
+    """Giữ các trang đầu cho đến trang làm tổng số token đạt ngưỡng"""
+    used_tokens = 0
+    for count, page in enumerate(pages, start=1):
+        used_tokens += token_counter.count_text(page)
+        if used_tokens >= token_budget:
+            return pages[:count]
+    return pages
+
+
+def extract_pdf_document(uploaded_file, token_budget: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Trích xuất văn bản PDF, dùng cache theo SHA-256 của nội dung file
+
+    Chỉ kết quả trích xuất đầy đủ mới được lưu vào cache.
+
+    Args:
+        uploaded_file: File-like object của tệp PDF
+        token_budget: Dừng sau trang làm tổng số token đạt ngưỡng này (tùy chọn)
+
+    Returns:
+        Dictionary gồm "sha256", "pages" và "offsets"
+    """
+    digest = file_sha256(uploaded_file)
+    entry = document_cache.get(digest)
+
+    if entry is not None:
+        pages = entry["pages"]
+        if token_budget is not None:
+            pages = _trim_to_budget(pages, token_budget)
+    else:
+        pages = list(iter_pdf_pages(uploaded_file, token_budget=token_budget))
+        if token_budget is None:
+            document_cache.put(digest, pages)
+
+    return {"sha256": digest, "pages": pages, "offsets": page_offsets(pages)}
+
+
+def extract_document(uploaded_file) -> Optional[Dict[str, Any]]:
+    """
+    Trích xuất tài liệu (PDF hoặc TXT) kèm SHA-256 và văn bản từng trang
+
+    Args:
+        uploaded_file: Tệp được tải lên
+
+    Returns:
+        Dictionary gồm "sha256", "pages" và "offsets", hoặc None nếu không hỗ trợ / lỗi
+    """
+    if uploaded_file is None:
+        return None
+
+    try:
+        if uploaded_file.type == "application/pdf":
+            return extract_pdf_document(uploaded_file)
+        elif uploaded_file.type == "text/plain":
+            digest = file_sha256(uploaded_file)
+            pages = [uploaded_file.read().decode("utf-8")]
+            return {"sha256": digest, "pages": pages, "offsets": [0]}
+        else:
+            return None
+    except Exception as e:
+        print(f"Lỗi khi xử lý tệp: {e}")
+        return None
+
+
+def process_uploaded_file(uploaded_file, token_budget: Optional[int] = None):
     """Đọc và trích xuất văn bản từ tệp được tải lên."""
     if uploaded_file is None:
         return None
@@ -10,13 +176,11 @@ def process_uploaded_file(uploaded_file):
 
     try:
         if file_type == "application/pdf":
-            pdf_reader = pypdf.PdfReader(io.BytesIO(uploaded_file.read()))
-            text = "".join(page.extract_text() for page in pdf_reader.pages)
-            return text
+            return "".join(extract_pdf_document(uploaded_file, token_budget)["pages"])
         elif file_type == "text/plain":
             return uploaded_file.read().decode("utf-8")
         else:
             return None # Không hỗ trợ loại tệp này
     except Exception as e:
         print(f"Lỗi khi xử lý tệp: {e}")
-        return None 
\ No newline at end of file
+        return None
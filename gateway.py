@@ -0,0 +1,598 @@
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import re
+from collections import OrderedDict
+from typing import Any, AsyncGenerator, Callable, Dict, List, Optional, Tuple
+
+import anthropic
+
+from config import (
+    ANTHROPIC_API_KEY, DEFAULT_MODEL, DEFAULT_MAX_TOKENS, DEFAULT_BUDGET_TOKENS, DEFAULT_TEMPERATURE,
+    GATEWAY_HOST, GATEWAY_PORT, GATEWAY_MAX_ACTIVE, GATEWAY_QUEUE_TIMEOUT, GATEWAY_KEY_CONCURRENCY,
+    GATEWAY_MAX_KEYS, GATEWAY_MAX_BODY_BYTES, GATEWAY_HEADER_TIMEOUT, GATEWAY_WRITE_BUFFER_BYTES,
+    GATEWAY_STUB_TOKEN_DELAY
+)
+from client_pool import hash_api_key
+from llm_handler_anthropic import AsyncAnthropicHandler, MODELS
+from request_scheduler import PRIORITY_INTERACTIVE
+from response_buffer import ResponseAccumulator, TEXT
+from stream_events import ERROR
+
+logger = logging.getLogger(__name__)
+
+_REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    401: "Unauthorized",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    411: "Length Required",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+    502: "Bad Gateway",
+    503: "Service Unavailable"
+}
+
+_WORD_RE = re.compile(r"\S+\s*|\s+")
+
+
+class HTTPError(Exception):
+    """Lỗi được trả về cho client dưới dạng {"error": ...}"""
+
+    def __init__(self, status: int, message: str, headers: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+
+class Request:
+    """Một HTTP request đã được đọc xong"""
+
+    __slots__ = ("method", "path", "headers", "body", "keep_alive", "headers_sent")
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], body: bytes, keep_alive: bool):
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.body = body
+        self.keep_alive = keep_alive
+        # True khi status line và header đã được gửi (không thể trả về status khác nữa)
+        self.headers_sent = False
+
+
+class StubHandler(AsyncAnthropicHandler):
+    """Upstream giả lập cho gateway: lặp lại tin nhắn cuối của user, không gọi API
+
+    Dùng chung phần validate với AsyncAnthropicHandler; mọi API key đều được chấp nhận.
+    """
+
+    def __init__(self, api_key: str = None, token_delay: float = GATEWAY_STUB_TOKEN_DELAY):
+        """
+        Khởi tạo
+
+        Args:
+            api_key: API key bất kỳ
+            token_delay: Số giây giữa 2 token
+        """
+        self.token_delay = token_delay
+        super().__init__(api_key)
+
+    def _initialize_client(self):
+        self.client = None
+
+    def is_ready(self) -> bool:
+        return self.api_key is not None
+
+    def _reply(self, messages: List[Dict[str, Any]], accumulator: ResponseAccumulator, model: str) -> List[str]:
+        """Tạo các token của câu trả lời và ghi usage vào accumulator"""
+        content = messages[-1]["content"] if messages else ""
+        if isinstance(content, list):
+            content = " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+        tokens = _WORD_RE.findall(f"Echo: {content}")
+        accumulator.model = model
+        accumulator.usage.update({
+            "input_tokens": sum(self.estimate_tokens(str(message["content"])) for message in messages),
+            "output_tokens": len(tokens)
+        })
+        accumulator.stop_reason = "end_turn"
+        return tokens
+
+    async def get_response(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> str:
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        tokens = self._reply(messages, accumulator, model)
+        await asyncio.sleep(self.token_delay * len(tokens))
+        accumulator.append_text("".join(tokens))
+        return accumulator.text
+
+    async def stream_channels(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> AsyncGenerator[Tuple[str, str], None]:
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        for token in self._reply(messages, accumulator, model):
+            await asyncio.sleep(self.token_delay)
+            accumulator.append_text(token)
+            yield TEXT, token
+
+
+class Gateway:
+    """HTTP server bất đồng bộ đưa AsyncAnthropicHandler ra thành service
+
+    Endpoints:
+        GET  /v1/models       Danh sách model trong MODELS
+        POST /v1/chat         Response hoàn chỉnh dạng JSON
+        POST /v1/chat/stream  Response dạng Server-Sent Events (event "text" và "thinking" riêng)
+        GET  /health          Trạng thái và thống kê
+
+    Số request được xử lý đồng thời bị giới hạn (request vượt quá chờ tối đa
+    queue_timeout giây rồi nhận 503), mỗi API key có giới hạn riêng (429).
+    Khi client đọc stream chậm, gateway ngừng đọc từ upstream cho đến khi bộ
+    đệm ghi được giải phóng.
+    """
+
+    def __init__(
+        self,
+        handler_factory: Callable[[str], AsyncAnthropicHandler] = AsyncAnthropicHandler,
+        max_active: int = GATEWAY_MAX_ACTIVE,
+        queue_timeout: float = GATEWAY_QUEUE_TIMEOUT,
+        key_concurrency: int = GATEWAY_KEY_CONCURRENCY,
+        max_keys: int = GATEWAY_MAX_KEYS,
+        max_body_bytes: int = GATEWAY_MAX_BODY_BYTES,
+        header_timeout: float = GATEWAY_HEADER_TIMEOUT,
+        write_buffer_bytes: int = GATEWAY_WRITE_BUFFER_BYTES,
+        fallback_api_key: Optional[str] = None
+    ):
+        """
+        Khởi tạo
+
+        Args:
+            handler_factory: Hàm tạo handler từ API key (ví dụ StubHandler)
+            max_active: Số request được xử lý đồng thời tối đa
+            queue_timeout: Số giây chờ chỗ trống trước khi trả về 503
+            key_concurrency: Số request đồng thời tối đa của mỗi API key
+            max_keys: Số handler (theo API key) tối đa được giữ lại
+            max_body_bytes: Kích thước body tối đa
+            header_timeout: Số giây chờ tối đa để nhận xong request
+            write_buffer_bytes: Ngưỡng bộ đệm ghi của mỗi kết nối
+            fallback_api_key: API key dùng cho request không gửi key (None = trả về 401)
+        """
+        self.handler_factory = handler_factory
+        self.max_active = max_active
+        self.queue_timeout = queue_timeout
+        self.key_concurrency = key_concurrency
+        self.max_keys = max_keys
+        self.max_body_bytes = max_body_bytes
+        self.header_timeout = header_timeout
+        self.write_buffer_bytes = write_buffer_bytes
+        self.fallback_api_key = fallback_api_key
+        self._slots = asyncio.Semaphore(max_active)
+        self._handlers: "OrderedDict[str, AsyncAnthropicHandler]" = OrderedDict()
+        self._key_active: Dict[str, int] = {}
+        self._routes = {
+            "/v1/models": ("GET", self._models),
+            "/v1/chat": ("POST", self._chat),
+            "/v1/chat/stream": ("POST", self._chat_stream),
+            "/health": ("GET", self._health)
+        }
+        self.requests = 0
+        self.rejected = 0
+        self.errors = 0
+        self.active = 0
+
+    async def start(self, host: str = GATEWAY_HOST, port: int = GATEWAY_PORT) -> asyncio.AbstractServer:
+        """
+        Mở cổng lắng nghe
+
+        Args:
+            host: Địa chỉ lắng nghe
+            port: Cổng (0 để chọn cổng trống)
+
+        Returns:
+            asyncio server
+        """
+        server = await asyncio.start_server(self._handle_connection, host, port)
+        logger.info(f"Gateway lắng nghe tại {', '.join(str(s.getsockname()) for s in server.sockets)}")
+        return server
+
+    async def serve(self, host: str = GATEWAY_HOST, port: int = GATEWAY_PORT) -> None:
+        """Chạy gateway cho đến khi bị dừng"""
+        server = await self.start(host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """Xử lý các request trên một kết nối (HTTP/1.1 keep-alive)"""
+        writer.transport.set_write_buffer_limits(high=self.write_buffer_bytes)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), self.header_timeout)
+                except HTTPError as e:
+                    await self._send_json(writer, e.status, {"error": e.message}, keep_alive=False)
+                    break
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                if request is None or not await self._dispatch(request, writer):
+                    break
+        except ConnectionError:
+            # Client đóng kết nối giữa chừng
+            pass
+        finally:
+            writer.close()
+            with contextlib.suppress(ConnectionError):
+                await writer.wait_closed()
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[Request]:
+        """Đọc một request; trả về None nếu client đóng kết nối trước khi gửi"""
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, "Header quá lớn")
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise
+
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, version = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Request line không hợp lệ")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(":")
+            if sep:
+                headers[name.strip().lower()] = value.strip()
+
+        # Body chỉ được đọc theo Content-Length; body chunked sẽ bị đọc nhầm thành request tiếp theo,
+        # nên bị từ chối (kết nối được đóng sau khi trả lỗi)
+        if "transfer-encoding" in headers:
+            raise HTTPError(501, "Transfer-Encoding không được hỗ trợ, hãy gửi Content-Length")
+        if method in ("POST", "PUT", "PATCH") and "content-length" not in headers:
+            raise HTTPError(411, "Cần header Content-Length")
+        try:
+            length = int(headers.get("content-length", "0"))
+        except ValueError:
+            raise HTTPError(400, "Content-Length không hợp lệ")
+        if length > self.max_body_bytes:
+            raise HTTPError(413, f"Body vượt quá {self.max_body_bytes} bytes")
+        body = await reader.readexactly(length) if length > 0 else b""
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        return Request(method, target.split("?", 1)[0], headers, body, keep_alive)
+
+    async def _dispatch(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        """Chuyển request tới endpoint; trả về True nếu giữ kết nối cho request tiếp theo"""
+        self.requests += 1
+        try:
+            route = self._routes.get(request.path)
+            if route is None:
+                raise HTTPError(404, f"Không có endpoint {request.path}")
+            method, endpoint = route
+            if request.method != method:
+                raise HTTPError(405, f"{request.path} chỉ hỗ trợ {method}", {"Allow": method})
+            return await endpoint(request, writer)
+        except HTTPError as e:
+            if request.headers_sent:
+                await self._send_event(writer, "error", {"error": e.message})
+                return False
+            await self._send_json(writer, e.status, {"error": e.message}, request.keep_alive, e.headers)
+            return request.keep_alive
+        except ConnectionError:
+            # Client đã ngắt kết nối, không còn gì để trả về
+            raise
+        except Exception:
+            # Lỗi ngoài dự kiến của endpoint: ghi log và trả lỗi thay vì đóng kết nối im lặng
+            self.errors += 1
+            logger.exception(f"Lỗi khi xử lý {request.method} {request.path}")
+            if request.headers_sent:
+                # Stream đã bắt đầu với status 200, chỉ có thể báo lỗi bằng SSE event
+                await self._send_event(writer, "error", {"error": "Lỗi nội bộ của gateway"})
+            else:
+                await self._send_json(writer, 500, {"error": "Lỗi nội bộ của gateway"}, keep_alive=False)
+            return False
+
+    def _handler_for(self, request: Request) -> Tuple[str, AsyncAnthropicHandler]:
+        """Lấy handler theo API key của request (x-api-key hoặc Authorization: Bearer)
+
+        Request không gửi key chỉ dùng key của server khi fallback_api_key được bật.
+        """
+        api_key = request.headers.get("x-api-key")
+        if not api_key:
+            scheme, _, token = request.headers.get("authorization", "").partition(" ")
+            api_key = token.strip() if scheme.lower() == "bearer" else None
+        api_key = api_key or self.fallback_api_key
+        if not api_key:
+            raise HTTPError(401, "Thiếu API key (header x-api-key)")
+
+        key_id = hash_api_key(api_key)
+        handler = self._handlers.get(key_id)
+        if handler is not None:
+            self._handlers.move_to_end(key_id)
+            return key_id, handler
+
+        handler = self.handler_factory(api_key)
+        if not handler.is_ready():
+            raise HTTPError(401, "API key không hợp lệ")
+        self._handlers[key_id] = handler
+        while len(self._handlers) > self.max_keys:
+            _, evicted = self._handlers.popitem(last=False)
+            evicted.ledger.forget_session(evicted.session_id)
+        return key_id, handler
+
+    @contextlib.asynccontextmanager
+    async def _slot(self, key_id: str):
+        """Giữ một chỗ xử lý cho request (429 khi API key vượt giới hạn, 503 khi hết chỗ)"""
+        if self._key_active.get(key_id, 0) >= self.key_concurrency:
+            self.rejected += 1
+            raise HTTPError(429, f"API key đã có {self.key_concurrency} request đang chạy", {"Retry-After": "1"})
+        self._key_active[key_id] = self._key_active.get(key_id, 0) + 1
+        try:
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                raise HTTPError(503, "Gateway đang quá tải", {"Retry-After": "1"})
+            self.active += 1
+            try:
+                yield
+            finally:
+                self.active -= 1
+                self._slots.release()
+        finally:
+            self._key_active[key_id] -= 1
+            if not self._key_active[key_id]:
+                del self._key_active[key_id]
+
+    def _parse_chat(self, request: Request, handler: AsyncAnthropicHandler) -> Tuple[Dict[str, Any], List[str]]:
+        """Đọc và validate body của /v1/chat, trả về (parameters cho handler, warnings)"""
+        try:
+            body = json.loads(request.body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "Body không phải JSON hợp lệ")
+        if not isinstance(body, dict):
+            raise HTTPError(400, "Body phải là JSON object")
+
+        model = body.get("model", DEFAULT_MODEL)
+        if model not in MODELS:
+            raise HTTPError(400, f"Model không được hỗ trợ: {model}")
+        messages = body.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise HTTPError(400, "\"messages\" phải là danh sách không rỗng")
+        self._validate_messages(messages)
+        thinking = bool(body.get("thinking", False))
+        if thinking and not handler.validate_model_features(model, thinking=True):
+            raise HTTPError(400, f"Model {model} không hỗ trợ extended thinking")
+
+        try:
+            validated = handler.validate_and_fix_parameters(
+                model,
+                int(body.get("max_tokens", DEFAULT_MAX_TOKENS)),
+                int(body.get("budget_tokens", DEFAULT_BUDGET_TOKENS)),
+                float(body.get("temperature", DEFAULT_TEMPERATURE)),
+                thinking
+            )
+        except (TypeError, ValueError):
+            raise HTTPError(400, "max_tokens, budget_tokens và temperature phải là số")
+
+        params = {
+            "model": model,
+            "messages": messages,
+            "system_prompt": body.get("system"),
+            "max_tokens": validated["max_tokens"],
+            "thinking": thinking,
+            "budget_tokens": validated["budget_tokens"],
+            "temperature": validated["temperature"]
+        }
+        return params, validated["warnings"]
+
+    @staticmethod
+    def _validate_messages(messages: List[Any]) -> None:
+        """Kiểm tra dạng của từng tin nhắn để lỗi của client trả về 400 thay vì 502 từ upstream"""
+        for index, message in enumerate(messages):
+            where = f"messages[{index}]"
+            if not isinstance(message, dict):
+                raise HTTPError(400, f"{where} phải là JSON object")
+            role = message.get("role")
+            if role not in ("user", "assistant"):
+                raise HTTPError(400, f"{where}.role phải là \"user\" hoặc \"assistant\" (system prompt dùng trường \"system\")")
+            content = message.get("content")
+            if isinstance(content, str):
+                # Chỉ prefill của assistant ở cuối được phép rỗng
+                if not content.strip() and not (role == "assistant" and index == len(messages) - 1):
+                    raise HTTPError(400, f"{where}.content không được rỗng")
+            elif isinstance(content, list) and content:
+                for block in content:
+                    if not isinstance(block, dict) or not isinstance(block.get("type"), str):
+                        raise HTTPError(400, f"{where}.content phải là danh sách block có trường \"type\"")
+            else:
+                raise HTTPError(400, f"{where}.content phải là string hoặc danh sách block không rỗng")
+
+    @staticmethod
+    def _result(accumulator: ResponseAccumulator) -> Dict[str, Any]:
+        return {
+            "model": accumulator.model,
+            "content": accumulator.text,
+            "thinking": accumulator.thinking,
+            "usage": accumulator.usage,
+            "cost": accumulator.cost,
+            "stop_reason": accumulator.stop_reason,
+            "cached": accumulator.cached
+        }
+
+    async def _models(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        data = [{"id": model_id, **info} for model_id, info in MODELS.items()]
+        await self._send_json(writer, 200, {"data": data}, request.keep_alive)
+        return request.keep_alive
+
+    async def _health(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        await self._send_json(writer, 200, {"status": "ok", **self.stats()}, request.keep_alive)
+        return request.keep_alive
+
+    async def _chat(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        key_id, handler = self._handler_for(request)
+        params, warnings = self._parse_chat(request, handler)
+        accumulator = ResponseAccumulator()
+        async with self._slot(key_id):
+            await handler.get_response(accumulator=accumulator, **params)
+        if accumulator.error:
+            raise HTTPError(502, accumulator.error)
+        await self._send_json(writer, 200, {**self._result(accumulator), "warnings": warnings}, request.keep_alive)
+        return request.keep_alive
+
+    async def _chat_stream(self, request: Request, writer: asyncio.StreamWriter) -> bool:
+        key_id, handler = self._handler_for(request)
+        params, warnings = self._parse_chat(request, handler)
+        accumulator = ResponseAccumulator()
+        async with self._slot(key_id):
+            self._send_head(writer, 200, {
+                "Content-Type": "text/event-stream; charset=utf-8",
+                "Cache-Control": "no-cache",
+                "Connection": "close"
+            })
+            request.headers_sent = True
+            if warnings:
+                await self._send_event(writer, "warning", {"warnings": warnings})
+
+            chunks = handler.stream_channels(accumulator=accumulator, **params)
+            try:
+                async for channel, chunk in chunks:
+                    # Lỗi được gửi sau vòng lặp thành event "error"
+                    if channel == ERROR:
+                        break
+                    # Mỗi kênh là một loại event riêng ("text", "thinking", "tool_input")
+                    await self._send_event(writer, channel, {channel: chunk})
+            finally:
+                # Đóng stream upstream ngay cả khi client ngắt kết nối
+                await chunks.aclose()
+
+            if accumulator.error:
+                await self._send_event(writer, "error", {"error": accumulator.error})
+            else:
+                await self._send_event(writer, "done", self._result(accumulator))
+        # Stream không có Content-Length nên kết thúc bằng việc đóng kết nối
+        return False
+
+    @staticmethod
+    def _send_head(writer: asyncio.StreamWriter, status: int, headers: Dict[str, str]) -> None:
+        lines = [f"HTTP/1.1 {status} {_REASONS.get(status, '')}"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+
+    async def _send_json(
+        self,
+        writer: asyncio.StreamWriter,
+        status: int,
+        body: Dict[str, Any],
+        keep_alive: bool,
+        headers: Optional[Dict[str, str]] = None
+    ) -> None:
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self._send_head(writer, status, {
+            "Content-Type": "application/json; charset=utf-8",
+            "Content-Length": str(len(data)),
+            "Connection": "keep-alive" if keep_alive else "close",
+            **(headers or {})
+        })
+        writer.write(data)
+        await writer.drain()
+
+    @staticmethod
+    async def _send_event(writer: asyncio.StreamWriter, event: str, data: Dict[str, Any]) -> None:
+        """Ghi một SSE event và chờ nếu bộ đệm ghi vượt ngưỡng (backpressure)"""
+        writer.write(f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+        await writer.drain()
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê
+
+        Returns:
+            Dictionary gồm tổng số request, số request bị từ chối, số request lỗi nội bộ,
+            đang xử lý và số API key
+        """
+        return {
+            "requests": self.requests,
+            "rejected": self.rejected,
+            "errors": self.errors,
+            "active": self.active,
+            "keys": len(self._handlers)
+        }
+
+
+def main(argv: Optional[List[str]] = None):
+    """Chạy gateway từ dòng lệnh"""
+    parser = argparse.ArgumentParser(description="HTTP/SSE gateway cho Anthropic handler")
+    parser.add_argument("--host", default=GATEWAY_HOST)
+    parser.add_argument("--port", type=int, default=GATEWAY_PORT)
+    parser.add_argument("--max-active", type=int, default=GATEWAY_MAX_ACTIVE)
+    parser.add_argument("--key-concurrency", type=int, default=GATEWAY_KEY_CONCURRENCY)
+    parser.add_argument("--base-url", default=None, help="URL của API (ví dụ mock server cục bộ)")
+    parser.add_argument("--stub", action="store_true", help="Dùng upstream giả lập thay vì gọi API")
+    parser.add_argument("--stub-delay", type=float, default=GATEWAY_STUB_TOKEN_DELAY)
+    parser.add_argument(
+        "--allow-server-key", action="store_true",
+        help="Dùng ANTHROPIC_API_KEY của server cho request không gửi API key (mặc định trả về 401)"
+    )
+    args = parser.parse_args(argv)
+
+    fallback_api_key = None
+    if args.allow_server_key:
+        fallback_api_key = ANTHROPIC_API_KEY or os.getenv("ANTHROPIC_API_KEY")
+        if not fallback_api_key:
+            parser.error("--allow-server-key cần biến môi trường ANTHROPIC_API_KEY")
+
+    if args.stub:
+        def handler_factory(api_key):
+            return StubHandler(api_key, token_delay=args.stub_delay)
+    elif args.base_url:
+        def handler_factory(api_key):
+            handler = AsyncAnthropicHandler(api_key)
+            handler.client = anthropic.AsyncAnthropic(api_key=api_key, base_url=args.base_url)
+            return handler
+    else:
+        handler_factory = AsyncAnthropicHandler
+
+    gateway = Gateway(
+        handler_factory,
+        max_active=args.max_active,
+        key_concurrency=args.key_concurrency,
+        fallback_api_key=fallback_api_key
+    )
+    try:
+        asyncio.run(gateway.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
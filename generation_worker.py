@@ -0,0 +1,248 @@
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Tuple
+
+from config import GENERATION_MAX_WORKERS, GENERATION_BUFFER_CHUNKS, GENERATION_RETENTION
+from response_buffer import ResponseAccumulator
+
+logger = logging.getLogger(__name__)
+
+RUNNING = "running"
+DONE = "done"
+CANCELLED = "cancelled"
+FAILED = "failed"
+
+
+class RingBuffer:
+    """Bộ đệm vòng các chunk, đánh số tăng dần để nhiều reader đọc tiếp từ vị trí riêng"""
+
+    def __init__(self, capacity: int = GENERATION_BUFFER_CHUNKS):
+        """
+        Khởi tạo
+
+        Args:
+            capacity: Số chunk gần nhất được giữ lại
+        """
+        self._chunks: Deque[str] = deque(maxlen=capacity)
+        self._condition = threading.Condition()
+        self._closed = False
+        # Số thứ tự của chunk tiếp theo được ghi
+        self.next_seq = 0
+
+    def append(self, chunk: str) -> None:
+        """Ghi một chunk và đánh thức các reader"""
+        with self._condition:
+            self._chunks.append(chunk)
+            self.next_seq += 1
+            self._condition.notify_all()
+
+    def close(self) -> None:
+        """Đánh dấu không còn chunk mới"""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+    @property
+    def closed(self) -> bool:
+        return self._closed
+
+    def read(self, cursor: int) -> Tuple[List[str], int, bool]:
+        """
+        Đọc các chunk từ vị trí cursor
+
+        Args:
+            cursor: Số thứ tự chunk đầu tiên cần đọc
+
+        Returns:
+            (danh sách chunk, cursor mới, True nếu một phần chunk đã bị ghi đè
+            và reader cần lấy toàn bộ text từ accumulator)
+        """
+        with self._condition:
+            oldest = self.next_seq - len(self._chunks)
+            truncated = cursor < oldest
+            start = max(cursor, oldest) - oldest
+            return list(self._chunks)[start:], self.next_seq, truncated
+
+    def wait(self, cursor: int, timeout: Optional[float] = None) -> bool:
+        """
+        Chờ đến khi có chunk sau cursor hoặc bộ đệm được đóng
+
+        Args:
+            cursor: Vị trí đã đọc tới
+            timeout: Số giây chờ tối đa
+
+        Returns:
+            True nếu có chunk mới hoặc bộ đệm đã đóng
+        """
+        with self._condition:
+            return self._condition.wait_for(lambda: self.next_seq > cursor or self._closed, timeout=timeout)
+
+
+class Generation:
+    """Một lần tạo response chạy nền, có thể được nhiều phiên UI theo dõi"""
+
+    def __init__(self, key: str, meta: Optional[Dict[str, Any]] = None, buffer_chunks: int = GENERATION_BUFFER_CHUNKS):
+        """
+        Khởi tạo
+
+        Args:
+            key: Khóa theo dõi (ví dụ ID hội thoại)
+            meta: Thông tin kèm theo cho UI (model, route, warnings, ...)
+            buffer_chunks: Dung lượng bộ đệm vòng
+        """
+        self.id = uuid.uuid4().hex
+        self.key = key
+        self.meta = meta or {}
+        self.accumulator = ResponseAccumulator()
+        self.buffer = RingBuffer(buffer_chunks)
+        self.status = RUNNING
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self._cancelled = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self.status == RUNNING
+
+    @property
+    def finished(self) -> bool:
+        """True khi generation đã kết thúc và kết quả đã được xử lý (on_complete)"""
+        return self.buffer.closed
+
+    def cancel(self) -> None:
+        """Yêu cầu dừng (stream được đóng ở chunk tiếp theo)"""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def wait(self, cursor: int, timeout: Optional[float] = None) -> bool:
+        """Chờ chunk mới sau cursor hoặc đến khi kết thúc (xem RingBuffer.wait)"""
+        return self.buffer.wait(cursor, timeout)
+
+
+class GenerationWorker:
+    """Chạy việc tạo response trong thread pool, tách khỏi lượt chạy script của UI
+
+    Mỗi khóa (hội thoại) có tối đa một Generation đang chạy; UI ở bất kỳ lượt
+    rerun hay tab nào cũng có thể đọc tiếp từ bộ đệm mà không gọi lại API.
+    """
+
+    def __init__(self, max_workers: int = GENERATION_MAX_WORKERS, retention: float = GENERATION_RETENTION):
+        """
+        Khởi tạo
+
+        Args:
+            max_workers: Số generation chạy song song tối đa
+            retention: Số giây giữ lại generation đã xong để UI lấy kết quả
+        """
+        self.retention = retention
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="generation")
+        self._generations: Dict[str, Generation] = {}
+        self._lock = threading.Lock()
+
+    def submit(
+        self,
+        key: str,
+        produce: Callable[[ResponseAccumulator], Iterable[str]],
+        meta: Optional[Dict[str, Any]] = None,
+        on_complete: Optional[Callable[[Generation], None]] = None
+    ) -> Generation:
+        """
+        Bắt đầu một generation chạy nền
+
+        Args:
+            key: Khóa theo dõi (generation đang chạy cùng khóa sẽ bị dừng)
+            produce: Hàm nhận accumulator và trả về iterator các chunk
+                (ví dụ handler.stream_response, hoặc handler.stream_channels
+                cho các cặp (kênh, chunk))
+            meta: Thông tin kèm theo cho UI
+            on_complete: Hàm được gọi trong worker khi generation kết thúc
+                (kể cả khi lỗi hoặc bị dừng)
+
+        Returns:
+            Generation
+        """
+        generation = Generation(key, meta)
+        with self._lock:
+            self._prune()
+            previous = self._generations.get(key)
+            if previous is not None and previous.running:
+                previous.cancel()
+            self._generations[key] = generation
+        self._executor.submit(self._run, generation, produce, on_complete)
+        return generation
+
+    def _run(
+        self,
+        generation: Generation,
+        produce: Callable[[ResponseAccumulator], Iterable[str]],
+        on_complete: Optional[Callable[[Generation], None]]
+    ) -> None:
+        chunks = None
+        try:
+            chunks = produce(generation.accumulator)
+            for chunk in chunks:
+                generation.buffer.append(chunk)
+                if generation.cancelled:
+                    break
+            generation.status = CANCELLED if generation.cancelled else DONE
+        except Exception as e:
+            logger.error(f"Generation {generation.id[:8]} lỗi: {str(e)}")
+            generation.accumulator.error = generation.accumulator.error or f"❌ Lỗi khi tạo response: {str(e)}"
+            generation.status = FAILED
+        finally:
+            # Đóng generator để handler ghi metrics / giải phóng kết nối khi bị dừng giữa chừng
+            close = getattr(chunks, "close", None)
+            if close is not None:
+                close()
+            generation.finished_at = time.time()
+            if on_complete is not None:
+                try:
+                    on_complete(generation)
+                except Exception as e:
+                    logger.error(f"Xử lý kết quả generation {generation.id[:8]} lỗi: {str(e)}")
+            generation.buffer.close()
+
+    def get(self, key: str) -> Optional[Generation]:
+        """
+        Lấy generation gần nhất của khóa
+
+        Args:
+            key: Khóa theo dõi
+
+        Returns:
+            Generation, hoặc None
+        """
+        with self._lock:
+            return self._generations.get(key)
+
+    def _prune(self) -> None:
+        """Bỏ các generation đã xong quá thời gian giữ lại (gọi khi đang giữ lock)"""
+        now = time.time()
+        expired = [
+            key for key, generation in self._generations.items()
+            if generation.finished_at is not None and now - generation.finished_at > self.retention
+        ]
+        for key in expired:
+            del self._generations[key]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê
+
+        Returns:
+            Dictionary gồm số generation đang chạy và đang được giữ lại
+        """
+        with self._lock:
+            running = sum(1 for generation in self._generations.values() if generation.running)
+            return {"running": running, "retained": len(self._generations)}
+
+
+# Worker dùng chung trong process (mọi phiên Streamlit)
+generation_worker = GenerationWorker()
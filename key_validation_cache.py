@@ -0,0 +1,128 @@
+import hashlib
+import hmac
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional
+
+from config import API_KEY_VALIDATION_TTL, API_KEY_NEGATIVE_TTL, API_KEY_CACHE_MAX_ENTRIES
+
+
+class KeyValidationCache:
+    """Cache TTL cho kết quả kiểm tra API key, dùng chung giữa các session
+
+    Khóa cache là HMAC-SHA256 của API key với salt ngẫu nhiên của process,
+    API key gốc không bao giờ được lưu. Số entry bị giới hạn (LRU) và entry hết
+    hạn được dọn khi ghi, để các key chỉ thử một lần không nằm lại mãi mãi.
+    """
+
+    def __init__(
+        self,
+        ttl: float = API_KEY_VALIDATION_TTL,
+        negative_ttl: float = API_KEY_NEGATIVE_TTL,
+        max_entries: int = API_KEY_CACHE_MAX_ENTRIES,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Khởi tạo cache
+
+        Args:
+            ttl: Thời gian sống (giây) của kết quả hợp lệ
+            negative_ttl: Thời gian sống (giây) của kết quả không hợp lệ
+            max_entries: Số entry tối đa (entry ít dùng nhất bị loại trước)
+            clock: Hàm lấy thời gian (dùng để test)
+        """
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self._clock = clock
+        self._salt = secrets.token_bytes(32)
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _key(self, api_key: str) -> str:
+        return hmac.new(self._salt, api_key.encode("utf-8"), hashlib.sha256).hexdigest()
+
+    def get(self, api_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy kết quả kiểm tra đã cache
+
+        Args:
+            api_key: API key
+
+        Returns:
+            Dictionary kết quả test (có thêm "cached": True) hoặc None nếu chưa có / đã hết hạn
+        """
+        key = self._key(api_key)
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["expires_at"] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return {**entry["result"], "cached": True}
+
+    def put(self, api_key: str, result: Dict[str, Any]) -> None:
+        """
+        Lưu kết quả kiểm tra, kết quả thất bại dùng negative TTL
+
+        Args:
+            api_key: API key
+            result: Dictionary kết quả test
+        """
+        ttl = self.ttl if result.get("success") else self.negative_ttl
+        key = self._key(api_key)
+        now = self._clock()
+        with self._lock:
+            self._entries[key] = {
+                "result": dict(result),
+                "expires_at": now + ttl
+            }
+            self._entries.move_to_end(key)
+            self._prune(now)
+
+    def _prune(self, now: float) -> None:
+        """Loại entry hết hạn, sau đó entry ít dùng nhất nếu vượt max_entries (gọi khi đang giữ lock)"""
+        expired = [key for key, entry in self._entries.items() if entry["expires_at"] <= now]
+        for key in expired:
+            del self._entries[key]
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, api_key: str) -> None:
+        """
+        Xóa kết quả đã cache của API key
+
+        Args:
+            api_key: API key
+        """
+        with self._lock:
+            self._entries.pop(self._key(api_key), None)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê cache
+
+        Returns:
+            Dictionary gồm số entry, hit, miss và số entry bị loại do vượt giới hạn
+        """
+        with self._lock:
+            return {
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
+
+
+# Cache dùng chung trong process
+key_validation_cache = KeyValidationCache()
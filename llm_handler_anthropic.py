@@ -1,23 +1,43 @@
 import anthropic
-from typing import List, Dict, Any, Optional, Generator
+from typing import List, Dict, Any, Optional, Generator, AsyncGenerator, Tuple
+import asyncio
 import logging
-from config import ANTHROPIC_API_KEY, DEBUG
+import uuid
+from config import (
+    ANTHROPIC_API_KEY, DEBUG, API_KEY_PROBE, PROMPT_CACHING, STREAM_MAX_RESUMES,
+    RESPONSE_CACHE_ENABLED
+)
+from response_buffer import ResponseAccumulator, TEXT, THINKING, SIGNATURE
+from stream_events import dispatch_event, text_chunks, atext_chunks, USAGE, ERROR
+from client_pool import client_pool, async_client_pool
+from key_validation_cache import key_validation_cache
+from token_counter import token_counter, content_text
+from prompt_cache import apply_cache_breakpoints
+from request_scheduler import request_scheduler, is_retryable, PRIORITY_INTERACTIVE
+from metrics import RequestMetrics, start_request, finish_request
+from cost_ledger import cost_ledger, BudgetExceededError, CostTracker
+from context_manager import parse_token_limit
+from response_cache import response_cache, request_key, is_cacheable, replay_chunks
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG if DEBUG else logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Model definitions
+# Model definitions (giá tính theo USD / triệu token; routing_tier: 1 = nhanh/rẻ ... 3 = mạnh nhất)
 MODELS = {
     "claude-opus-4-20250514": {
         "can_reasoning": True,
         "extended_thinking": True,
         "price": {
-            "input": "$15 / MTok",
-            "output": "$75 / MTok",
+            "input": 15.00,
+            "output": 75.00,
+            "cache_write": 18.75,
+            "cache_read": 1.50
         },
         "context_window": "200K",
         "max_output": "32000 tokens",
+        "cache_min_tokens": 1024,
+        "routing_tier": 3,
         "description": "Our most capable model",
         "display_name": "Claude Opus 4"
     },
@@ -25,11 +45,15 @@ MODELS = {
         "can_reasoning": True,
         "extended_thinking": True,
         "price": {
-            "input": "$3 / MTok",
-            "output": "$15 / MTok",
+            "input": 3.00,
+            "output": 15.00,
+            "cache_write": 3.75,
+            "cache_read": 0.30
         },
         "context_window": "200K",
         "max_output": "64000 tokens",
+        "cache_min_tokens": 1024,
+        "routing_tier": 2,
         "description": "High-performance model",
         "display_name": "Claude Sonnet 4"
     },
@@ -37,11 +61,15 @@ MODELS = {
         "can_reasoning": True,
         "extended_thinking": True,
         "price": {
-            "input": "$3 / MTok",
-            "output": "$15 / MTok",
+            "input": 3.00,
+            "output": 15.00,
+            "cache_write": 3.75,
+            "cache_read": 0.30
         },
         "context_window": "200K",
         "max_output": "64000 tokens",
+        "cache_min_tokens": 1024,
+        "routing_tier": 2,
         "description": "High-performance model with early extended thinking",
         "display_name": "Claude 3.7 Sonnet"
     },
@@ -49,11 +77,15 @@ MODELS = {
         "can_reasoning": True,
         "extended_thinking": False,
         "price": {
-            "input": "$3 / MTok",
-            "output": "$15 / MTok",
+            "input": 3.00,
+            "output": 15.00,
+            "cache_write": 3.75,
+            "cache_read": 0.30
         },
         "context_window": "200K",
         "max_output": "8192 tokens",
+        "cache_min_tokens": 1024,
+        "routing_tier": 2,
         "description": "Our previous intelligent model",
         "display_name": "Claude 3.5 Sonnet"
     },
@@ -61,11 +93,15 @@ MODELS = {
         "can_reasoning": False,
         "extended_thinking": False,
         "price": {
-            "input": "$0.80 / MTok",
-            "output": "$4 / MTok",
+            "input": 0.80,
+            "output": 4.00,
+            "cache_write": 1.00,
+            "cache_read": 0.08
         },
         "context_window": "200K",
         "max_output": "8192 tokens",
+        "cache_min_tokens": 2048,
+        "routing_tier": 1,
         "description": "Our fastest model",
         "display_name": "Claude 3.5 Haiku"
     },
@@ -73,11 +109,15 @@ MODELS = {
         "can_reasoning": True,
         "extended_thinking": False,
         "price": {
-            "input": "$15 / MTok",
-            "output": "$75 / MTok",
+            "input": 15.00,
+            "output": 75.00,
+            "cache_write": 18.75,
+            "cache_read": 1.50
         },
         "context_window": "200K",
         "max_output": "4096 tokens",
+        "cache_min_tokens": 1024,
+        "routing_tier": 2,
         "description": "Powerful model for complex tasks",
         "display_name": "Claude 3 Opus"
     },
@@ -85,16 +125,27 @@ MODELS = {
         "can_reasoning": False,
         "extended_thinking": False,
         "price": {
-            "input": "$0.25 / MTok",
-            "output": "$1.25 / MTok",
+            "input": 0.25,
+            "output": 1.25,
+            "cache_write": 0.30,
+            "cache_read": 0.03
         },
         "context_window": "200K",
         "max_output": "4096 tokens",
+        "cache_min_tokens": 2048,
+        "routing_tier": 1,
         "description": "Fast and compact model for near-instant responsiveness",
         "display_name": "Claude 3 Haiku"
     }
 }
 
+def _strip_common_prefix(text: str, prefix: str) -> str:
+    """Bỏ phần đầu của text trùng với prefix (dùng khi nối tiếp stream)"""
+    i = 0
+    while i < len(text) and i < len(prefix) and text[i] == prefix[i]:
+        i += 1
+    return text[i:]
+
 class AnthropicHandler:
     """Handler cho Anthropic API với streaming support"""
     
@@ -107,13 +158,19 @@ class AnthropicHandler:
         """
         self.api_key = api_key or ANTHROPIC_API_KEY
         self.client = None
+        self.scheduler = request_scheduler
+        # Chi phí được ghi vào ledger theo phiên của handler
+        self.ledger = cost_ledger
+        self.session_id = uuid.uuid4().hex
+        # Response cache cho request có temperature = 0 (None để tắt)
+        self.response_cache = response_cache if RESPONSE_CACHE_ENABLED else None
         if self.api_key:
             self._initialize_client()
     
     def _initialize_client(self):
-        """Khởi tạo Anthropic client với API key"""
+        """Lấy Anthropic client cho API key từ pool dùng chung"""
         try:
-            self.client = anthropic.Anthropic(api_key=self.api_key)
+            self.client = client_pool.get(self.api_key)
             logger.info("Anthropic client đã được khởi tạo")
         except Exception as e:
             logger.error(f"Lỗi khởi tạo Anthropic client: {str(e)}")
@@ -145,10 +202,19 @@ class AnthropicHandler:
         """
         return self.client is not None and self.api_key is not None
     
-    def test_api_key(self) -> Dict[str, Any]:
+    def test_api_key(self, use_cache: bool = True, probe: str = API_KEY_PROBE) -> Dict[str, Any]:
         """
         Test API key bằng cách gọi một request đơn giản
         
+        Kết quả được cache theo HMAC của API key: kết quả hợp lệ và lỗi
+        AuthenticationError được dùng lại cho đến khi hết TTL, các lỗi khác
+        không được cache.
+        
+        Args:
+            use_cache: Dùng kết quả đã cache nếu có
+            probe: Cách kiểm tra - "models" (liệt kê model, không tốn token)
+                hoặc "messages" (gửi một message ngắn)
+        
         Returns:
             Dictionary chứa kết quả test
         """
@@ -158,19 +224,23 @@ class AnthropicHandler:
                 "error": "Client chưa được khởi tạo hoặc API key chưa được set"
             }
         
+        if use_cache:
+            cached = key_validation_cache.get(self.api_key)
+            if cached is not None:
+                return cached
+        
         try:
-            # Test với một request đơn giản
-            response = self.client.messages.create(
-                model="claude-3-haiku-20240307",
-                max_tokens=10,
-                messages=[{"role": "user", "content": "Hi"}]
-            )
-            return {
+            if probe == "models":
+                self.client.models.list(limit=1)
+            else:
+                # Test với một request đơn giản
+                self.client.messages.create(**self._probe_request_params())
+            result = {
                 "success": True,
                 "message": "API key hợp lệ"
             }
         except anthropic.AuthenticationError:
-            return {
+            result = {
                 "success": False,
                 "error": "API key không hợp lệ"
             }
@@ -184,6 +254,17 @@ class AnthropicHandler:
                 "success": False,
                 "error": f"Lỗi không mong muốn: {str(e)}"
             }
+        
+        key_validation_cache.put(self.api_key, result)
+        return result
+    
+    def _probe_request_params(self) -> Dict[str, Any]:
+        """Parameters của request ngắn nhất dùng để kiểm tra API key"""
+        return {
+            "model": "claude-3-haiku-20240307",
+            "max_tokens": 10,
+            "messages": [{"role": "user", "content": "Hi"}]
+        }
     
     def get_available_models(self) -> Dict[str, Dict[str, Any]]:
         """
@@ -273,6 +354,107 @@ class AnthropicHandler:
             "warnings": warnings
         }
     
+    def _apply_budget(self, model: str, max_tokens: int, thinking: bool) -> Tuple[str, int, bool]:
+        """
+        Kiểm tra ngân sách của phiên trước khi gửi request
+        
+        Args:
+            model: Model được yêu cầu
+            max_tokens: Số token tối đa
+            thinking: Có bật thinking không
+            
+        Returns:
+            (model, max_tokens, thinking) đã điều chỉnh nếu phiên bị hạ cấp model
+            
+        Raises:
+            BudgetExceededError: Phiên đã vượt ngân sách và không được hạ cấp
+        """
+        budget_model = self.ledger.check_budget(self.session_id, model)
+        if budget_model != model:
+            model_info = self.get_model_info(budget_model)
+            max_tokens = min(max_tokens, parse_token_limit(model_info.get("max_output", max_tokens)))
+            thinking = thinking and model_info.get("extended_thinking", False)
+        return budget_model, max_tokens, thinking
+    
+    def _cost_tracker(self, model: str) -> CostTracker:
+        """Tạo tracker ghi chi phí của một request vào ledger"""
+        return self.ledger.tracker(self.session_id, self.api_key, model, self.get_model_info(model).get("price", {}))
+    
+    def _cache_key(self, params: Dict[str, Any]) -> Optional[str]:
+        """Khóa response cache của request, hoặc None nếu request không được cache"""
+        if self.response_cache is None or not is_cacheable(params):
+            return None
+        return request_key(params)
+    
+    def _load_cached_response(self, cache_key: Optional[str], accumulator: ResponseAccumulator) -> Optional[str]:
+        """
+        Lấy response đã cache và ghi thinking / stop_reason vào accumulator
+        
+        Args:
+            cache_key: Khóa từ _cache_key (None thì bỏ qua)
+            accumulator: Bộ đệm nhận kết quả
+            
+        Returns:
+            Text của response đã cache (chưa được ghi vào accumulator), hoặc None
+        """
+        if cache_key is None:
+            return None
+        entry = self.response_cache.get(cache_key)
+        return self._apply_cached_entry(entry, accumulator) if entry is not None else None
+    
+    def _apply_cached_entry(self, entry: Dict[str, Any], accumulator: ResponseAccumulator) -> str:
+        """Ghi thinking / stop_reason của response đã cache vào accumulator, trả về text"""
+        accumulator.append_thinking(entry.get("thinking", ""))
+        accumulator.stop_reason = entry.get("stop_reason")
+        accumulator.cached = True
+        return entry["text"]
+    
+    @staticmethod
+    def _cache_offsets(accumulator: ResponseAccumulator) -> Tuple[int, int]:
+        """Độ dài kênh text và thinking khi bắt đầu một lần gọi (xem _cache_entry)"""
+        return accumulator.length(TEXT), accumulator.length(THINKING)
+    
+    def _cache_entry(
+        self,
+        cache_key: Optional[str],
+        accumulator: ResponseAccumulator,
+        offsets: Tuple[int, int]
+    ) -> Optional[Dict[str, Any]]:
+        """
+        Nội dung cần lưu vào response cache cho request vừa xong
+        
+        Một accumulator có thể nhận nhiều lần gọi (ví dụ router chuyển model và
+        gửi phần đã có làm prefill), nên chỉ phần do lần gọi này tạo ra được lưu.
+        
+        Args:
+            cache_key: Khóa từ _cache_key (None thì không lưu)
+            accumulator: Bộ đệm nhận kết quả
+            offsets: Kết quả của _cache_offsets() trước lần gọi
+            
+        Returns:
+            Entry cần lưu, hoặc None nếu response không được cache
+        """
+        if cache_key is None or accumulator.error or accumulator.cached:
+            return None
+        text_offset, thinking_offset = offsets
+        return {
+            "text": accumulator.text[text_offset:],
+            "thinking": accumulator.thinking[thinking_offset:],
+            "usage": accumulator.usage,
+            "stop_reason": accumulator.stop_reason
+        }
+    
+    def _store_response(
+        self,
+        cache_key: Optional[str],
+        accumulator: ResponseAccumulator,
+        offsets: Tuple[int, int]
+    ) -> None:
+        """Lưu response hoàn chỉnh (không lỗi) vào response cache"""
+        entry = self._cache_entry(cache_key, accumulator, offsets)
+        if entry is not None:
+            self.response_cache.put(cache_key, entry)
+    
     def _build_request_params(
         self,
         model: str,
@@ -281,7 +463,8 @@ class AnthropicHandler:
         max_tokens: int = 1024,
         thinking: bool = False,
         budget_tokens: int = 10000,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        prompt_caching: bool = PROMPT_CACHING
     ) -> Dict[str, Any]:
         """
         Xây dựng parameters cho API request
@@ -294,6 +477,7 @@ class AnthropicHandler:
             thinking: Bật extended thinking
             budget_tokens: Budget tokens cho thinking
             temperature: Temperature cho response
+            prompt_caching: Gắn cache_control breakpoint cho system prompt, tài liệu lớn và lịch sử
             
         Returns:
             Dictionary chứa parameters
@@ -323,6 +507,10 @@ class AnthropicHandler:
                 "budget_tokens": validated["budget_tokens"]
             }
             logger.debug(f"Extended thinking enabled với {validated['budget_tokens']} budget tokens")
+        
+        if prompt_caching:
+            min_tokens = self.get_model_info(model).get("cache_min_tokens", 1024)
+            params = apply_cache_breakpoints(params, min_tokens)
             
         return params
     
@@ -334,11 +522,17 @@ class AnthropicHandler:
         max_tokens: int = 1024,
         thinking: bool = False,
         budget_tokens: int = 10000,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
     ) -> str:
         """
         Lấy response từ Anthropic API (không streaming)
         
+        Request đi qua scheduler: chờ quota của API key, tự thử lại với lỗi
+        tạm thời (429, 529, lỗi kết nối). Lỗi cuối cùng được ghi vào
+        accumulator.error thay vì vào nội dung response.
+        
         Args:
             model: Model ID
             messages: Danh sách tin nhắn
@@ -347,40 +541,70 @@ class AnthropicHandler:
             thinking: Bật extended thinking
             budget_tokens: Budget tokens cho thinking
             temperature: Temperature
+            accumulator: Bộ đệm nhận riêng kênh text và thinking (tùy chọn)
+            priority: Độ ưu tiên trong scheduler
             
         Returns:
-            Response text
+            Response text (hoặc thông báo lỗi)
         """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        
         if not self.is_ready():
-            return "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            accumulator.error = "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            return accumulator.error
         
+        try:
+            model, max_tokens, thinking = self._apply_budget(model, max_tokens, thinking)
+        except BudgetExceededError as e:
+            accumulator.error = f"❌ {str(e)}"
+            return accumulator.error
+        accumulator.model = model
+        
+        metrics = start_request(model, streaming=False)
+        scheduler_stats: Dict[str, Any] = {}
         try:
             params = self._build_request_params(
                 model, messages, system_prompt, max_tokens, 
                 thinking, budget_tokens, temperature
             )
             
+            cache_key = self._cache_key(params)
+            cache_offsets = self._cache_offsets(accumulator)
+            cached = self._load_cached_response(cache_key, accumulator)
+            if cached is not None:
+                metrics = None
+                accumulator.append_text(cached)
+                return accumulator.text
+            
             logger.debug(f"Gọi API với model: {model}, thinking: {thinking}")
-            response = self.client.messages.create(**params)
-            
-            # Xử lý response có thinking
-            if thinking and hasattr(response, 'content'):
-                full_response = ""
-                for block in response.content:
-                    if block.type == "thinking":
-                        full_response += f"\n**🤔 Thinking:** {block.thinking}\n\n"
-                    elif block.type == "text":
-                        full_response += block.text
-                return full_response
-            else:
-                return response.content[0].text
+            client = self.client.with_options(max_retries=0)
+            response = self.scheduler.call(
+                lambda: client.messages.create(**params),
+                self.api_key,
+                token_counter.count_messages(messages, system_prompt),
+                priority,
+                stats=scheduler_stats
+            )
+            
+            # Thinking và text được tách vào 2 kênh riêng của accumulator
+            self._collect_content_blocks(response, accumulator, self._prefill_trailing(params, accumulator))
+            cost_tracker = self._cost_tracker(model)
+            cost_tracker.update(accumulator.usage)
+            accumulator.cost = cost_tracker.cost
+            self._store_response(cache_key, accumulator, cache_offsets)
+            return accumulator.text
                 
         except anthropic.APIError as e:
             logger.error(f"Anthropic API error: {str(e)}")
-            return f"❌ Lỗi API: {str(e)}"
+            accumulator.error = f"❌ Lỗi API: {str(e)}"
+            return accumulator.error
         except Exception as e:
             logger.error(f"Unexpected error: {str(e)}")
-            return f"❌ Lỗi không mong muốn: {str(e)}"
+            accumulator.error = f"❌ Lỗi không mong muốn: {str(e)}"
+            return accumulator.error
+        finally:
+            finish_request(metrics, accumulator, scheduler_stats)
     
     def stream_response(
         self,
@@ -390,10 +614,41 @@ class AnthropicHandler:
         max_tokens: int = 1024,
         thinking: bool = False,
         budget_tokens: int = 10000,
-        temperature: float = 0.7
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
     ) -> Generator[str, None, None]:
         """
-        Stream response từ Anthropic API
+        Stream response từ Anthropic API, chỉ gồm kênh text
+        
+        Tham số giống stream_channels(). Lỗi cuối cùng được ghi vào
+        accumulator.error và yield cho UI, nhưng không được ghi vào kênh text.
+        
+        Returns:
+            Generator các chunk text (thinking chỉ được ghi vào accumulator)
+        """
+        return text_chunks(self.stream_channels(
+            model, messages, system_prompt, max_tokens, thinking,
+            budget_tokens, temperature, accumulator, priority
+        ))
+    
+    def stream_channels(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> Generator[Tuple[str, str], None, None]:
+        """
+        Stream response từ Anthropic API, tách riêng kênh text và thinking
+        
+        Việc mở stream đi qua scheduler (chờ quota, thử lại với lỗi tạm thời).
+        Lỗi cuối cùng được ghi vào accumulator.error và yield với kênh ERROR.
         
         Args:
             model: Model ID
@@ -403,44 +658,279 @@ class AnthropicHandler:
             thinking: Bật extended thinking
             budget_tokens: Budget tokens cho thinking
             temperature: Temperature
+            accumulator: Bộ đệm nhận riêng kênh text và thinking (tùy chọn)
+            priority: Độ ưu tiên trong scheduler
             
         Yields:
-            Từng chunk của response
+            Cặp (kênh, chunk) với kênh là TEXT, THINKING, TOOL_INPUT hoặc ERROR
         """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        
         if not self.is_ready():
-            yield "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            accumulator.error = "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            yield ERROR, accumulator.error
             return
         
+        try:
+            model, max_tokens, thinking = self._apply_budget(model, max_tokens, thinking)
+        except BudgetExceededError as e:
+            accumulator.error = f"❌ {str(e)}"
+            yield ERROR, accumulator.error
+            return
+        accumulator.model = model
+        
+        metrics = start_request(model, streaming=True)
+        scheduler_stats: Dict[str, Any] = {}
         try:
             params = self._build_request_params(
                 model, messages, system_prompt, max_tokens, 
                 thinking, budget_tokens, temperature
             )
             
+            # Response đã cache được phát lại theo từng chunk như một stream thật
+            cache_key = self._cache_key(params)
+            cache_offsets = self._cache_offsets(accumulator)
+            cached = self._load_cached_response(cache_key, accumulator)
+            if cached is not None:
+                metrics = None
+                for chunk in replay_chunks(cached):
+                    accumulator.append_text(chunk)
+                    yield TEXT, chunk
+                return
+            
             logger.debug(f"Streaming với model: {model}, thinking: {thinking}")
             
-            with self.client.messages.stream(**params) as stream:
-                for event in stream:
-                    if event.type == "content_block_delta":
-                        if hasattr(event.delta, 'text'):
-                            yield event.delta.text
-                    elif event.type == "thinking_block_delta":
-                        if hasattr(event.delta, 'thinking'):
-                            yield f"\n**🤔 [Thinking]** {event.delta.thinking}"
-                    elif event.type == "content_block_start":
-                        if hasattr(event.content_block, 'type') and event.content_block.type == "thinking":
-                            yield "\n\n**🤔 Thinking process:**\n"
+            yield from self._stream_with_resume(
+                params,
+                accumulator,
+                token_counter.count_messages(messages, system_prompt),
+                priority,
+                metrics=metrics,
+                scheduler_stats=scheduler_stats,
+                cost_tracker=self._cost_tracker(model)
+            )
+            self._store_response(cache_key, accumulator, cache_offsets)
                             
         except anthropic.APIError as e:
             logger.error(f"Anthropic API streaming error: {str(e)}")
-            yield f"❌ Lỗi API streaming: {str(e)}"
+            accumulator.error = f"❌ Lỗi API streaming: {str(e)}"
+            yield ERROR, accumulator.error
         except Exception as e:
             logger.error(f"Unexpected streaming error: {str(e)}")
-            yield f"❌ Lỗi streaming không mong muốn: {str(e)}"
+            accumulator.error = f"❌ Lỗi streaming không mong muốn: {str(e)}"
+            yield ERROR, accumulator.error
+        finally:
+            # Cũng chạy khi UI dừng đọc stream giữa chừng (GeneratorExit)
+            finish_request(metrics, accumulator, scheduler_stats)
+    
+    def _stream_with_resume(
+        self,
+        params: Dict[str, Any],
+        accumulator: ResponseAccumulator,
+        estimated_tokens: int,
+        priority: int,
+        metrics: Optional[RequestMetrics] = None,
+        scheduler_stats: Optional[Dict[str, Any]] = None,
+        cost_tracker: Optional[CostTracker] = None
+    ) -> Generator[Tuple[str, str], None, None]:
+        """
+        Stream response, tự nối tiếp khi kết nối bị ngắt giữa chừng
+        
+        Khi gặp lỗi tạm thời sau khi đã nhận một phần text, request được gửi
+        lại với phần text đó làm prefill của assistant để model viết tiếp thay
+        vì bắt đầu lại (nối vào prefill sẵn có nếu request đã kết thúc bằng tin
+        nhắn assistant). Không áp dụng khi bật thinking (API không cho prefill).
+        
+        Args:
+            params: Parameters đã xây dựng cho request
+            accumulator: Bộ đệm nhận kết quả
+            estimated_tokens: Số input token ước tính (cho scheduler)
+            priority: Độ ưu tiên trong scheduler
+            metrics: Số đo của request (None khi metrics bị tắt)
+            scheduler_stats: Dictionary nhận queue_time / retries từ scheduler
+            cost_tracker: Tracker ghi usage vào ledger sau mỗi event có usage
+            
+        Yields:
+            Cặp (kênh, chunk) của text, thinking và tool input
+        """
+        client = self.client.with_options(max_retries=0)
+        request_params = params
+        resumes = 0
+        trailing = self._prefill_trailing(params, accumulator)
+        # Accumulator có thể đã chứa text của lần gọi trước (ví dụ prefill của router);
+        # request này viết tiếp từ cuối prefill, tức trước phần khoảng trắng trailing
+        text_offset = accumulator.length(TEXT) - len(trailing)
+        
+        while True:
+            try:
+                stream = self.scheduler.call(
+                    lambda: client.messages.create(**request_params, stream=True),
+                    self.api_key,
+                    estimated_tokens,
+                    priority,
+                    stats=scheduler_stats,
+                    retries_used=self._retries_used(scheduler_stats, resumes)
+                )
+                with stream:
+                    for event in stream:
+                        item, trailing = self._handle_stream_event(event, accumulator, trailing, metrics, cost_tracker)
+                        if item is not None:
+                            yield item
+                return
+            except Exception as e:
+                if not self._can_resume(e, params, resumes, scheduler_stats):
+                    raise
+                resumes += 1
+                request_params, trailing = self._resume_params(params, accumulator, text_offset, resumes, e)
+    
+    def _handle_stream_event(
+        self,
+        event: Any,
+        accumulator: ResponseAccumulator,
+        trailing: str,
+        metrics: Optional[RequestMetrics],
+        cost_tracker: Optional[CostTracker]
+    ) -> Tuple[Optional[Tuple[str, str]], str]:
+        """
+        Ghi một stream event vào accumulator, cập nhật chi phí và metrics
+        
+        Args:
+            event: Stream event từ API
+            accumulator: Bộ đệm nhận kết quả
+            trailing: Khoảng trắng cuối đã hiển thị trước khi nối tiếp ("" nếu không có)
+            metrics: Số đo của request (tùy chọn)
+            cost_tracker: Tracker chi phí (tùy chọn)
+            
+        Returns:
+            (cặp (kênh, chunk) cần yield hoặc None, trailing còn lại)
+        """
+        if trailing and event.type == "content_block_delta" and event.delta.type == "text_delta":
+            # Bỏ phần khoảng trắng đã được hiển thị trước khi mất kết nối
+            event.delta.text = _strip_common_prefix(event.delta.text, trailing)
+            trailing = ""
+        item = dispatch_event(event, accumulator)
+        if item is None:
+            return None, trailing
+        channel, chunk = item
+        if channel == USAGE:
+            if cost_tracker is not None:
+                cost_tracker.update(accumulator.usage, new_message=event.type == "message_start")
+                accumulator.cost = cost_tracker.cost
+            return None, trailing
+        if not chunk:
+            return None, trailing
+        if metrics is not None:
+            metrics.on_token(channel)
+        return item, trailing
+    
+    @staticmethod
+    def _prefill_trailing(params: Dict[str, Any], accumulator: ResponseAccumulator) -> str:
+        """
+        Khoảng trắng cuối accumulator mà prefill của request không có
+        
+        Prefill của assistant không được kết thúc bằng khoảng trắng nên khi
+        request viết tiếp text đã có (ví dụ router chuyển model), model thường
+        viết lại khoảng trắng đó; phần trùng được bỏ khỏi đầu câu trả lời.
+        
+        Returns:
+            Khoảng trắng cần bỏ ("" nếu request không có prefill)
+        """
+        messages = params["messages"]
+        if not messages or messages[-1]["role"] != "assistant":
+            return ""
+        text = accumulator.text
+        return text[len(text.rstrip()):]
+    
+    @staticmethod
+    def _retries_used(scheduler_stats: Optional[Dict[str, Any]], resumes: int) -> int:
+        """Số lần thử lại request đã dùng: retry của scheduler cộng số lần nối tiếp stream"""
+        return (scheduler_stats or {}).get("retries", 0) + resumes
+    
+    def _can_resume(
+        self,
+        error: Exception,
+        params: Dict[str, Any],
+        resumes: int,
+        scheduler_stats: Optional[Dict[str, Any]]
+    ) -> bool:
+        """
+        Stream bị lỗi có thể nối tiếp không
+        
+        Cần lỗi tạm thời, không bật thinking, chưa hết lượt nối tiếp và còn
+        ngân sách thử lại của scheduler (mỗi lần nối tiếp tính là một lần thử
+        lại, nên cả request gửi tối đa max_retries + 1 lần lên upstream).
+        """
+        return (
+            is_retryable(error)
+            and "thinking" not in params
+            and resumes < STREAM_MAX_RESUMES
+            and self._retries_used(scheduler_stats, resumes) < self.scheduler.max_retries
+        )
+    
+    def _resume_params(
+        self,
+        params: Dict[str, Any],
+        accumulator: ResponseAccumulator,
+        text_offset: int,
+        resumes: int,
+        error: Exception
+    ) -> Tuple[Dict[str, Any], str]:
+        """
+        Parameters của lần nối tiếp: phần text đã nhận làm prefill của assistant
+        
+        Args:
+            params: Parameters gốc của request
+            accumulator: Bộ đệm đã nhận một phần kết quả
+            text_offset: Độ dài kênh text khi bắt đầu request (phần trước đó không do request này tạo)
+            resumes: Số thứ tự lần nối tiếp
+            error: Lỗi làm ngắt stream
+            
+        Returns:
+            (parameters mới, phần khoảng trắng cuối đã hiển thị nhưng không nằm trong prefill)
+        """
+        partial = accumulator.text[text_offset:]
+        logger.warning(f"Stream bị ngắt ({str(error)}), nối tiếp lần {resumes} từ {len(partial)} ký tự")
+        
+        messages = list(params["messages"])
+        previous = ""
+        if messages and messages[-1]["role"] == "assistant":
+            # Request đã có prefill: nối vào đó thay vì thêm tin nhắn assistant thứ hai
+            previous = content_text(messages.pop()["content"])
+        combined = previous + partial
+        
+        # Prefill của assistant không được kết thúc bằng khoảng trắng
+        prefill = combined.rstrip()
+        if prefill:
+            messages.append({"role": "assistant", "content": prefill})
+        request_params = dict(params)
+        request_params["messages"] = messages
+        accumulator.resumes = resumes
+        accumulator.salvaged_tokens = token_counter.count_text(partial.rstrip())
+        return request_params, combined[len(prefill):]
+    
+    def _collect_content_blocks(self, response: Any, accumulator: ResponseAccumulator, trailing: str = "") -> None:
+        """
+        Ghi các content block của response (không streaming) vào accumulator
+        
+        Args:
+            response: Message trả về từ API
+            accumulator: Bộ đệm nhận kết quả
+            trailing: Khoảng trắng cuối accumulator không nằm trong prefill (xem _prefill_trailing)
+        """
+        for block in response.content:
+            if block.type == "thinking":
+                accumulator.append_thinking(block.thinking)
+                accumulator.append(block.signature, SIGNATURE)
+            elif block.type == "text":
+                accumulator.append_text(_strip_common_prefix(block.text, trailing) if trailing else block.text)
+                trailing = ""
+        accumulator.update_usage(getattr(response, "usage", None))
+        accumulator.stop_reason = getattr(response, "stop_reason", None)
     
     def estimate_tokens(self, text: str) -> int:
         """
-        Ước tính số tokens trong text (xấp xỉ)
+        Ước tính số tokens trong text (xấp xỉ, có cache)
         
         Args:
             text: Text cần ước tính
@@ -448,8 +938,37 @@ class AnthropicHandler:
         Returns:
             Số tokens ước tính
         """
-        # Ước tính đơn giản: 1 token ≈ 4 characters
-        return len(text) // 4
+        return token_counter.count_text(text)
+    
+    def count_tokens(
+        self,
+        model: str,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        use_server: bool = False
+    ) -> int:
+        """
+        Đếm số input tokens của một request
+        
+        Args:
+            model: Model ID
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+            use_server: Dùng endpoint count_tokens của API để có kết quả chính xác
+            
+        Returns:
+            Số input tokens
+        """
+        if use_server and self.is_ready():
+            params = {"model": model, "messages": messages}
+            if system_prompt and system_prompt.strip():
+                params["system"] = system_prompt
+            try:
+                return token_counter.count_request_server(self.client, params)
+            except anthropic.APIError as e:
+                logger.warning(f"Không đếm được token qua API, dùng ước tính cục bộ: {str(e)}")
+        
+        return token_counter.count_messages(messages, system_prompt)
     
     def format_model_display(self, model_id: str) -> str:
         """
@@ -470,5 +989,339 @@ class AnthropicHandler:
         
         return f"{display_name} - {description}"
 
+class AsyncAnthropicHandler(AnthropicHandler):
+    """Handler bất đồng bộ dựa trên anthropic.AsyncAnthropic
+    
+    Dùng chung phần validate và xây dựng parameters với AnthropicHandler, nhưng
+    các lời gọi API là coroutine / async generator để nhiều hội thoại có thể
+    chạy song song trên cùng một event loop.
+    """
+    
+    def _initialize_client(self):
+        """Lấy AsyncAnthropic client cho API key từ pool dùng chung"""
+        try:
+            self.client = async_client_pool.get(self.api_key)
+            logger.info("AsyncAnthropic client đã được khởi tạo")
+        except Exception as e:
+            logger.error(f"Lỗi khởi tạo AsyncAnthropic client: {str(e)}")
+            self.client = None
+    
+    async def test_api_key(self, use_cache: bool = True, probe: str = API_KEY_PROBE) -> Dict[str, Any]:
+        """
+        Test API key bằng cách gọi một request đơn giản (dùng chung cache với bản đồng bộ)
+        
+        Args:
+            use_cache: Dùng kết quả đã cache nếu có
+            probe: Cách kiểm tra - "models" hoặc "messages"
+        
+        Returns:
+            Dictionary chứa kết quả test
+        """
+        if not self.is_ready():
+            return {
+                "success": False,
+                "error": "Client chưa được khởi tạo hoặc API key chưa được set"
+            }
+        
+        if use_cache:
+            cached = key_validation_cache.get(self.api_key)
+            if cached is not None:
+                return cached
+        
+        try:
+            if probe == "models":
+                await self.client.models.list(limit=1)
+            else:
+                await self.client.messages.create(**self._probe_request_params())
+            result = {
+                "success": True,
+                "message": "API key hợp lệ"
+            }
+        except anthropic.AuthenticationError:
+            result = {
+                "success": False,
+                "error": "API key không hợp lệ"
+            }
+        except anthropic.APIError as e:
+            return {
+                "success": False,
+                "error": f"Lỗi API: {str(e)}"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": f"Lỗi không mong muốn: {str(e)}"
+            }
+        
+        key_validation_cache.put(self.api_key, result)
+        return result
+    
+    async def _aload_cached_response(self, cache_key: Optional[str], accumulator: ResponseAccumulator) -> Optional[str]:
+        """Bản bất đồng bộ của _load_cached_response (đọc SQLite trong thread, không chặn event loop)"""
+        if cache_key is None:
+            return None
+        entry = await asyncio.to_thread(self.response_cache.get, cache_key)
+        return self._apply_cached_entry(entry, accumulator) if entry is not None else None
+    
+    async def _astore_response(
+        self,
+        cache_key: Optional[str],
+        accumulator: ResponseAccumulator,
+        offsets: Tuple[int, int]
+    ) -> None:
+        """Bản bất đồng bộ của _store_response (ghi SQLite trong thread)"""
+        entry = self._cache_entry(cache_key, accumulator, offsets)
+        if entry is not None:
+            await asyncio.to_thread(self.response_cache.put, cache_key, entry)
+    
+    async def get_response(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> str:
+        """
+        Lấy response từ Anthropic API (không streaming, bất đồng bộ)
+        
+        Request đi qua scheduler giống bản đồng bộ (chờ quota không chặn event
+        loop, thử lại với lỗi tạm thời).
+        
+        Args:
+            model: Model ID
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+            max_tokens: Số token tối đa
+            thinking: Bật extended thinking
+            budget_tokens: Budget tokens cho thinking
+            temperature: Temperature
+            accumulator: Bộ đệm nhận riêng kênh text và thinking (tùy chọn)
+            priority: Độ ưu tiên trong scheduler
+            
+        Returns:
+            Response text (hoặc thông báo lỗi)
+        """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        
+        if not self.is_ready():
+            accumulator.error = "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            return accumulator.error
+        
+        try:
+            model, max_tokens, thinking = self._apply_budget(model, max_tokens, thinking)
+        except BudgetExceededError as e:
+            accumulator.error = f"❌ {str(e)}"
+            return accumulator.error
+        accumulator.model = model
+        
+        metrics = start_request(model, streaming=False)
+        scheduler_stats: Dict[str, Any] = {}
+        try:
+            params = self._build_request_params(
+                model, messages, system_prompt, max_tokens, 
+                thinking, budget_tokens, temperature
+            )
+            
+            cache_key = self._cache_key(params)
+            cache_offsets = self._cache_offsets(accumulator)
+            cached = await self._aload_cached_response(cache_key, accumulator)
+            if cached is not None:
+                metrics = None
+                accumulator.append_text(cached)
+                return accumulator.text
+            
+            logger.debug(f"Gọi API (async) với model: {model}, thinking: {thinking}")
+            client = self.client.with_options(max_retries=0)
+            response = await self.scheduler.call_async(
+                lambda: client.messages.create(**params),
+                self.api_key,
+                token_counter.count_messages(messages, system_prompt),
+                priority,
+                stats=scheduler_stats
+            )
+            
+            self._collect_content_blocks(response, accumulator, self._prefill_trailing(params, accumulator))
+            cost_tracker = self._cost_tracker(model)
+            cost_tracker.update(accumulator.usage)
+            accumulator.cost = cost_tracker.cost
+            await self._astore_response(cache_key, accumulator, cache_offsets)
+            return accumulator.text
+                
+        except anthropic.APIError as e:
+            logger.error(f"Anthropic API error: {str(e)}")
+            accumulator.error = f"❌ Lỗi API: {str(e)}"
+            return accumulator.error
+        except Exception as e:
+            logger.error(f"Unexpected error: {str(e)}")
+            accumulator.error = f"❌ Lỗi không mong muốn: {str(e)}"
+            return accumulator.error
+        finally:
+            finish_request(metrics, accumulator, scheduler_stats)
+    
+    def stream_response(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> AsyncGenerator[str, None]:
+        """
+        Stream response từ Anthropic API, chỉ gồm kênh text (async generator)
+        
+        Tham số giống stream_channels().
+        
+        Returns:
+            Async generator các chunk text (thinking chỉ được ghi vào accumulator)
+        """
+        return atext_chunks(self.stream_channels(
+            model, messages, system_prompt, max_tokens, thinking,
+            budget_tokens, temperature, accumulator, priority
+        ))
+    
+    async def stream_channels(
+        self,
+        model: str,
+        messages: List[Dict[str, str]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> AsyncGenerator[Tuple[str, str], None]:
+        """
+        Stream response từ Anthropic API, tách riêng kênh text và thinking (async generator)
+        
+        Giống bản đồng bộ: mở stream qua scheduler và tự nối tiếp khi stream bị
+        ngắt giữa chừng.
+        
+        Args:
+            model: Model ID
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+            max_tokens: Số token tối đa
+            thinking: Bật extended thinking
+            budget_tokens: Budget tokens cho thinking
+            temperature: Temperature
+            accumulator: Bộ đệm nhận riêng kênh text và thinking (tùy chọn)
+            priority: Độ ưu tiên trong scheduler
+            
+        Yields:
+            Cặp (kênh, chunk) với kênh là TEXT, THINKING, TOOL_INPUT hoặc ERROR
+        """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        
+        if not self.is_ready():
+            accumulator.error = "❌ Lỗi: API key chưa được cung cấp hoặc không hợp lệ. Vui lòng nhập API key trong sidebar."
+            yield ERROR, accumulator.error
+            return
+        
+        try:
+            model, max_tokens, thinking = self._apply_budget(model, max_tokens, thinking)
+        except BudgetExceededError as e:
+            accumulator.error = f"❌ {str(e)}"
+            yield ERROR, accumulator.error
+            return
+        accumulator.model = model
+        
+        metrics = start_request(model, streaming=True)
+        scheduler_stats: Dict[str, Any] = {}
+        try:
+            params = self._build_request_params(
+                model, messages, system_prompt, max_tokens, 
+                thinking, budget_tokens, temperature
+            )
+            
+            cache_key = self._cache_key(params)
+            cache_offsets = self._cache_offsets(accumulator)
+            cached = await self._aload_cached_response(cache_key, accumulator)
+            if cached is not None:
+                metrics = None
+                for chunk in replay_chunks(cached):
+                    accumulator.append_text(chunk)
+                    yield TEXT, chunk
+                return
+            
+            logger.debug(f"Streaming (async) với model: {model}, thinking: {thinking}")
+            
+            async for item in self._astream_with_resume(
+                params,
+                accumulator,
+                token_counter.count_messages(messages, system_prompt),
+                priority,
+                metrics=metrics,
+                scheduler_stats=scheduler_stats,
+                cost_tracker=self._cost_tracker(model)
+            ):
+                yield item
+            await self._astore_response(cache_key, accumulator, cache_offsets)
+                            
+        except anthropic.APIError as e:
+            logger.error(f"Anthropic API streaming error: {str(e)}")
+            accumulator.error = f"❌ Lỗi API streaming: {str(e)}"
+            yield ERROR, accumulator.error
+        except Exception as e:
+            logger.error(f"Unexpected streaming error: {str(e)}")
+            accumulator.error = f"❌ Lỗi streaming không mong muốn: {str(e)}"
+            yield ERROR, accumulator.error
+        finally:
+            # Cũng chạy khi client ngắt stream giữa chừng (aclose / hủy task)
+            finish_request(metrics, accumulator, scheduler_stats)
+    
+    async def _astream_with_resume(
+        self,
+        params: Dict[str, Any],
+        accumulator: ResponseAccumulator,
+        estimated_tokens: int,
+        priority: int,
+        metrics: Optional[RequestMetrics] = None,
+        scheduler_stats: Optional[Dict[str, Any]] = None,
+        cost_tracker: Optional[CostTracker] = None
+    ) -> AsyncGenerator[Tuple[str, str], None]:
+        """Bản bất đồng bộ của _stream_with_resume() (tham số giống nhau)"""
+        client = self.client.with_options(max_retries=0)
+        request_params = params
+        resumes = 0
+        trailing = self._prefill_trailing(params, accumulator)
+        # Accumulator có thể đã chứa text của lần gọi trước (ví dụ prefill của router);
+        # request này viết tiếp từ cuối prefill, tức trước phần khoảng trắng trailing
+        text_offset = accumulator.length(TEXT) - len(trailing)
+        
+        while True:
+            try:
+                stream = await self.scheduler.call_async(
+                    lambda: client.messages.create(**request_params, stream=True),
+                    self.api_key,
+                    estimated_tokens,
+                    priority,
+                    stats=scheduler_stats,
+                    retries_used=self._retries_used(scheduler_stats, resumes)
+                )
+                async with stream:
+                    async for event in stream:
+                        item, trailing = self._handle_stream_event(event, accumulator, trailing, metrics, cost_tracker)
+                        if item is not None:
+                            yield item
+                return
+            except Exception as e:
+                if not self._can_resume(e, params, resumes, scheduler_stats):
+                    raise
+                resumes += 1
+                request_params, trailing = self._resume_params(params, accumulator, text_offset, resumes, e)
+
 # Instance mặc định để sử dụng - không khởi tạo với API key
+# (UI tạo handler riêng cho mỗi session, client được chia sẻ qua client_pool)
 anthropic_handler = AnthropicHandler()
\ No newline at end of file
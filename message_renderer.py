@@ -0,0 +1,160 @@
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+from config import CHAT_RENDER_CACHE_SIZE, CHAT_PREVIEW_CHARS
+from token_counter import content_hash
+
+_FENCE_RE = re.compile(r"^\s*(```|~~~)", re.MULTILINE)
+_MARKUP_RE = re.compile(r"[#>*_`~\[\]()|-]+")
+
+
+def close_code_fences(text: str) -> str:
+    """
+    Đóng code block chưa được đóng (ví dụ response bị cắt do max_tokens) để
+    phần markdown phía sau không bị hiển thị như code
+
+    Args:
+        text: Markdown
+
+    Returns:
+        Markdown với số fence chẵn
+    """
+    fences = _FENCE_RE.findall(text)
+    if len(fences) % 2:
+        return text + "\n" + fences[-1]
+    return text
+
+
+def message_preview(text: str, max_chars: int = CHAT_PREVIEW_CHARS) -> str:
+    """
+    Tóm tắt một dòng của tin nhắn (bỏ ký hiệu markdown)
+
+    Args:
+        text: Nội dung tin nhắn
+        max_chars: Độ dài tối đa
+
+    Returns:
+        Dòng tóm tắt
+    """
+    plain = " ".join(_MARKUP_RE.sub(" ", text[:max_chars * 4]).split())
+    return plain if len(plain) <= max_chars else plain[:max_chars - 1] + "…"
+
+
+def render_key(message: Dict[str, Any]) -> str:
+    """
+    Khóa memo của tin nhắn: hash nội dung, tính một lần và lưu trong tin nhắn
+
+    Gọi khi tạo tin nhắn để khóa được lưu cùng tin nhắn vào conversation store;
+    tin nhắn chưa có khóa (ví dụ lưu từ phiên bản cũ) được gán ở lần dùng đầu.
+
+    Args:
+        message: Tin nhắn ("role", "content", có thể kèm "thinking", "model")
+
+    Returns:
+        Khóa memo
+    """
+    key = message.get("render_key")
+    if key is None:
+        key = content_hash([message["role"], message["content"], message.get("thinking", ""), message.get("model", "")])
+        message["render_key"] = key
+    return key
+
+
+class RenderedMessage:
+    """Nội dung đã chuẩn bị sẵn để hiển thị một tin nhắn"""
+
+    __slots__ = ("markdown", "thinking", "preview", "caption")
+
+    def __init__(self, markdown: str, thinking: str, preview: str, caption: Optional[str]):
+        self.markdown = markdown
+        self.thinking = thinking
+        self.preview = preview
+        self.caption = caption
+
+
+class MessageRenderCache:
+    """Memo nội dung hiển thị theo khóa của tin nhắn (LRU)
+
+    Tin nhắn cũ không đổi giữa các lần rerun, nên chỉ cần chuẩn bị một lần;
+    khóa được lưu sẵn trong tin nhắn (xem render_key) nên mỗi lần rerun không
+    phải hash lại nội dung.
+    """
+
+    def __init__(self, max_entries: int = CHAT_RENDER_CACHE_SIZE):
+        """
+        Khởi tạo
+
+        Args:
+            max_entries: Số tin nhắn tối đa được memo
+        """
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[str, RenderedMessage]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, message: Dict[str, Any], model_names: Optional[Dict[str, str]] = None) -> RenderedMessage:
+        """
+        Lấy nội dung hiển thị của tin nhắn (chuẩn bị nếu chưa có)
+
+        Args:
+            message: Tin nhắn trong session state
+            model_names: Model ID -> tên hiển thị (cho chú thích model)
+
+        Returns:
+            RenderedMessage
+        """
+        key = render_key(message)
+        with self._lock:
+            rendered = self._entries.get(key)
+            if rendered is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return rendered
+            self.misses += 1
+
+        content = message["content"]
+        model = message.get("model")
+        rendered = RenderedMessage(
+            markdown=close_code_fences(content),
+            thinking=message.get("thinking", ""),
+            preview=message_preview(content),
+            caption=(model_names or {}).get(model, model) if model else None
+        )
+        with self._lock:
+            self._entries[key] = rendered
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rendered
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê memo
+
+        Returns:
+            Dictionary gồm số entry, hit và miss
+        """
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+
+def window_start(total: int, window: int, extra_pages: int, page_size: int) -> int:
+    """
+    Vị trí tin nhắn đầu tiên được hiển thị đầy đủ
+
+    Args:
+        total: Tổng số tin nhắn
+        window: Số tin nhắn cuối luôn được hiển thị
+        extra_pages: Số trang tin nhắn cũ người dùng đã mở thêm
+        page_size: Số tin nhắn mỗi trang
+
+    Returns:
+        Index bắt đầu (0 nếu hiển thị toàn bộ)
+    """
+    return max(0, total - window - extra_pages * page_size)
+
+
+# Memo dùng chung trong process
+message_render_cache = MessageRenderCache()
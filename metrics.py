@@ -0,0 +1,464 @@
+import abc
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional, Tuple
+
+from config import METRICS_SINK, METRICS_MAX_SPANS
+from response_buffer import TEXT
+from token_counter import token_counter
+
+logger = logging.getLogger(__name__)
+
+# Các mốc (giây) của histogram thời gian
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Các trường usage được ghi nhận
+TOKEN_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "thinking_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens"
+)
+
+
+def percentile(sorted_values: List[float], fraction: float) -> Optional[float]:
+    """
+    Lấy percentile từ danh sách đã sắp xếp (nearest-rank)
+
+    Args:
+        sorted_values: Danh sách giá trị đã sắp xếp tăng dần
+        fraction: Percentile dạng 0..1
+
+    Returns:
+        Giá trị percentile, hoặc None nếu danh sách rỗng
+    """
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+class RequestMetrics:
+    """Số đo của một request: thời gian chờ, TTFT, độ trễ giữa các token, usage, retries
+
+    TTFT tính từ chunk đầu tiên của bất kỳ kênh nội dung nào (kể cả thinking);
+    thời điểm nhận text đầu tiên được ghi riêng (time_to_first_text).
+    """
+
+    __slots__ = (
+        "model", "streaming", "started_at", "started_at_unix", "queue_time",
+        "first_token_at", "first_text_at", "last_token_at", "token_gaps", "finished_at",
+        "tokens", "retries", "resumes", "error"
+    )
+
+    def __init__(self, model: str, streaming: bool):
+        """
+        Bắt đầu đo một request
+
+        Args:
+            model: Model ID
+            streaming: Request có streaming không
+        """
+        self.model = model
+        self.streaming = streaming
+        self.started_at = time.perf_counter()
+        self.started_at_unix = time.time()
+        self.queue_time = 0.0
+        self.first_token_at: Optional[float] = None
+        self.first_text_at: Optional[float] = None
+        self.last_token_at: Optional[float] = None
+        self.token_gaps: List[float] = []
+        self.finished_at: Optional[float] = None
+        self.tokens: Dict[str, int] = {}
+        self.retries = 0
+        self.resumes = 0
+        self.error: Optional[str] = None
+
+    def on_token(self, channel: str = TEXT) -> None:
+        """
+        Ghi nhận thời điểm nhận một chunk
+
+        Args:
+            channel: Kênh của chunk (TEXT, THINKING hoặc TOOL_INPUT)
+        """
+        now = time.perf_counter()
+        if self.first_token_at is None:
+            self.first_token_at = now
+        else:
+            self.token_gaps.append(now - self.last_token_at)
+        if channel == TEXT and self.first_text_at is None:
+            self.first_text_at = now
+        self.last_token_at = now
+
+    def finish(self, accumulator: Any = None, scheduler_stats: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Kết thúc đo, lấy usage và lỗi từ accumulator
+
+        Args:
+            accumulator: ResponseAccumulator của request (tùy chọn)
+            scheduler_stats: Thống kê queue_time / retries từ scheduler (tùy chọn)
+        """
+        self.finished_at = time.perf_counter()
+        if scheduler_stats:
+            self.queue_time = scheduler_stats.get("queue_time", 0.0)
+            self.retries = scheduler_stats.get("retries", 0)
+        if accumulator is not None:
+            self.tokens.update(accumulator.usage)
+            self.resumes = accumulator.resumes
+            self.error = accumulator.error
+            if accumulator.has_thinking():
+                # API không tách riêng số token thinking, dùng ước tính cục bộ
+                self.tokens["thinking_tokens"] = token_counter.count_text(accumulator.thinking)
+
+    @property
+    def ttft(self) -> Optional[float]:
+        """Time to first token (giây)"""
+        if self.first_token_at is None:
+            return None
+        return self.first_token_at - self.started_at
+
+    @property
+    def time_to_first_text(self) -> Optional[float]:
+        """Thời gian đến chunk text đầu tiên (giây), lớn hơn ttft khi có thinking"""
+        if self.first_text_at is None:
+            return None
+        return self.first_text_at - self.started_at
+
+    @property
+    def duration(self) -> Optional[float]:
+        """Tổng thời gian request (giây)"""
+        if self.finished_at is None:
+            return None
+        return self.finished_at - self.started_at
+
+    def inter_token_percentiles(self) -> Dict[str, Optional[float]]:
+        """
+        Percentile của độ trễ giữa các chunk
+
+        Returns:
+            Dictionary p50 / p90 / p99 (giây)
+        """
+        gaps = sorted(self.token_gaps)
+        return {
+            "p50": percentile(gaps, 0.50),
+            "p90": percentile(gaps, 0.90),
+            "p99": percentile(gaps, 0.99)
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        Chuyển số đo thành dictionary
+
+        Returns:
+            Dictionary các số đo
+        """
+        return {
+            "model": self.model,
+            "streaming": self.streaming,
+            "queue_time": self.queue_time,
+            "ttft": self.ttft,
+            "time_to_first_text": self.time_to_first_text,
+            "duration": self.duration,
+            "inter_token": self.inter_token_percentiles(),
+            "tokens": dict(self.tokens),
+            "retries": self.retries,
+            "resumes": self.resumes,
+            "error": self.error
+        }
+
+
+class MetricsSink(abc.ABC):
+    """Nơi nhận số đo của request; lớp con cài đặt record()"""
+
+    # Khi False, handler không tạo RequestMetrics (gần như không tốn chi phí)
+    enabled = True
+
+    @abc.abstractmethod
+    def record(self, metrics: RequestMetrics) -> None:
+        """
+        Ghi nhận số đo của một request đã kết thúc
+
+        Args:
+            metrics: Số đo của request
+        """
+
+
+class NullSink(MetricsSink):
+    """Sink mặc định: bỏ qua mọi số đo"""
+
+    enabled = False
+
+    def record(self, metrics: RequestMetrics) -> None:
+        pass
+
+
+class _Histogram:
+    """Histogram tích lũy theo các mốc cố định"""
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.total += value
+        self.count += 1
+
+
+class PrometheusSink(MetricsSink):
+    """Tổng hợp số đo theo model và xuất ở định dạng Prometheus text exposition"""
+
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        """
+        Khởi tạo
+
+        Args:
+            buckets: Các mốc (giây) cho histogram thời gian
+        """
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests: Dict[Tuple[str, str], int] = {}
+        self._tokens: Dict[Tuple[str, str], int] = {}
+        self._retries: Dict[str, int] = {}
+        self._histograms: Dict[Tuple[str, str], _Histogram] = {}
+
+    def _observe(self, name: str, model: str, value: Optional[float]) -> None:
+        if value is None:
+            return
+        key = (name, model)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = _Histogram(self.buckets)
+        histogram.observe(value)
+
+    def record(self, metrics: RequestMetrics) -> None:
+        status = "error" if metrics.error else "ok"
+        with self._lock:
+            key = (metrics.model, status)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._retries[metrics.model] = self._retries.get(metrics.model, 0) + metrics.retries
+            for field, value in metrics.tokens.items():
+                token_key = (metrics.model, field)
+                self._tokens[token_key] = self._tokens.get(token_key, 0) + value
+            self._observe("queue_seconds", metrics.model, metrics.queue_time)
+            self._observe("ttft_seconds", metrics.model, metrics.ttft)
+            self._observe("first_text_seconds", metrics.model, metrics.time_to_first_text)
+            self._observe("duration_seconds", metrics.model, metrics.duration)
+            for gap in metrics.token_gaps:
+                self._observe("inter_token_seconds", metrics.model, gap)
+
+    def exposition(self) -> str:
+        """
+        Xuất toàn bộ số đo ở định dạng Prometheus text
+
+        Returns:
+            Nội dung text exposition
+        """
+        lines = []
+        with self._lock:
+            lines.append("# TYPE anthropic_requests_total counter")
+            for (model, status), value in sorted(self._requests.items()):
+                lines.append(f'anthropic_requests_total{{model="{model}",status="{status}"}} {value}')
+
+            lines.append("# TYPE anthropic_retries_total counter")
+            for model, value in sorted(self._retries.items()):
+                lines.append(f'anthropic_retries_total{{model="{model}"}} {value}')
+
+            lines.append("# TYPE anthropic_tokens_total counter")
+            for (model, field), value in sorted(self._tokens.items()):
+                lines.append(f'anthropic_tokens_total{{model="{model}",type="{field}"}} {value}')
+
+            names = sorted({name for name, _ in self._histograms})
+            for name in names:
+                metric = f"anthropic_request_{name}"
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram_name, model), histogram in sorted(self._histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        lines.append(f'{metric}_bucket{{model="{model}",le="{bound}"}} {count}')
+                    lines.append(f'{metric}_bucket{{model="{model}",le="+Inf"}} {histogram.count}')
+                    lines.append(f'{metric}_sum{{model="{model}"}} {histogram.total}')
+                    lines.append(f'{metric}_count{{model="{model}"}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+
+class SpanSink(MetricsSink):
+    """Chuyển số đo thành span theo quy ước OpenTelemetry (gen_ai.*)
+
+    Span được giữ trong bộ đệm vòng và/hoặc gửi cho exporter (ví dụ hàm ghi
+    JSON hoặc adapter sang OpenTelemetry SDK).
+    """
+
+    def __init__(self, exporter: Optional[Callable[[Dict[str, Any]], None]] = None, max_spans: int = 1000):
+        """
+        Khởi tạo
+
+        Args:
+            exporter: Hàm nhận mỗi span dạng dictionary (tùy chọn)
+            max_spans: Số span gần nhất được giữ lại
+        """
+        self.exporter = exporter
+        self.spans: Deque[Dict[str, Any]] = deque(maxlen=max_spans)
+
+    def record(self, metrics: RequestMetrics) -> None:
+        start_ns = int(metrics.started_at_unix * 1e9)
+        duration = metrics.duration or 0.0
+        attributes = {
+            "gen_ai.system": "anthropic",
+            "gen_ai.request.model": metrics.model,
+            "gen_ai.request.streaming": metrics.streaming,
+            "anthropic.queue_time": metrics.queue_time,
+            "anthropic.retries": metrics.retries,
+            "anthropic.resumes": metrics.resumes
+        }
+        for field, value in metrics.tokens.items():
+            attributes[f"gen_ai.usage.{field}"] = value
+        for name, value in metrics.inter_token_percentiles().items():
+            if value is not None:
+                attributes[f"anthropic.inter_token.{name}"] = value
+
+        events = []
+        if metrics.ttft is not None:
+            events.append({"name": "first_token", "time_unix_nano": start_ns + int(metrics.ttft * 1e9)})
+        if metrics.time_to_first_text is not None and metrics.time_to_first_text != metrics.ttft:
+            events.append({
+                "name": "first_text_token",
+                "time_unix_nano": start_ns + int(metrics.time_to_first_text * 1e9)
+            })
+
+        span = {
+            "name": "anthropic.messages",
+            "trace_id": os.urandom(16).hex(),
+            "span_id": os.urandom(8).hex(),
+            "start_time_unix_nano": start_ns,
+            "end_time_unix_nano": start_ns + int(duration * 1e9),
+            "status": {"code": "ERROR", "message": metrics.error} if metrics.error else {"code": "OK"},
+            "attributes": attributes,
+            "events": events
+        }
+        self.spans.append(span)
+        if self.exporter is not None:
+            try:
+                self.exporter(span)
+            except Exception as e:
+                logger.warning(f"Exporter span lỗi: {str(e)}")
+
+
+class CompositeSink(MetricsSink):
+    """Gửi số đo tới nhiều sink cùng lúc"""
+
+    def __init__(self, *sinks: MetricsSink):
+        self.sinks = [sink for sink in sinks if sink.enabled]
+        self.enabled = bool(self.sinks)
+
+    def record(self, metrics: RequestMetrics) -> None:
+        for sink in self.sinks:
+            sink.record(metrics)
+
+
+def create_sink(spec: str = METRICS_SINK) -> MetricsSink:
+    """
+    Tạo sink từ cấu hình dạng chuỗi
+
+    Args:
+        spec: "none", "prometheus", "spans" hoặc kết hợp, phân cách bởi dấu phẩy
+
+    Returns:
+        MetricsSink tương ứng
+    """
+    sinks: List[MetricsSink] = []
+    for name in (part.strip().lower() for part in (spec or "").split(",")):
+        if name == "prometheus":
+            sinks.append(PrometheusSink())
+        elif name == "spans":
+            sinks.append(SpanSink(max_spans=METRICS_MAX_SPANS))
+        elif name and name != "none":
+            logger.warning(f"Metrics sink không hợp lệ: {name}")
+    if not sinks:
+        return NullSink()
+    return sinks[0] if len(sinks) == 1 else CompositeSink(*sinks)
+
+
+def find_sink(sink_type: type) -> Optional[MetricsSink]:
+    """
+    Tìm sink theo kiểu trong sink đang dùng (kể cả bên trong CompositeSink)
+
+    Args:
+        sink_type: Lớp sink cần tìm
+
+    Returns:
+        Sink tìm được, hoặc None
+    """
+    candidates = _sink.sinks if isinstance(_sink, CompositeSink) else [_sink]
+    for sink in candidates:
+        if isinstance(sink, sink_type):
+            return sink
+    return None
+
+
+# Sink dùng chung trong process (mặc định NullSink)
+_sink: MetricsSink = create_sink()
+
+
+def get_metrics_sink() -> MetricsSink:
+    """Lấy sink đang dùng trong process"""
+    return _sink
+
+
+def set_metrics_sink(sink: MetricsSink) -> None:
+    """
+    Thay sink dùng trong process
+
+    Args:
+        sink: Sink mới
+    """
+    global _sink
+    _sink = sink
+
+
+def start_request(model: str, streaming: bool) -> Optional[RequestMetrics]:
+    """
+    Bắt đầu đo một request nếu sink đang bật
+
+    Args:
+        model: Model ID
+        streaming: Request có streaming không
+
+    Returns:
+        RequestMetrics, hoặc None khi dùng NullSink
+    """
+    if not _sink.enabled:
+        return None
+    return RequestMetrics(model, streaming)
+
+
+def finish_request(
+    metrics: Optional[RequestMetrics],
+    accumulator: Any = None,
+    scheduler_stats: Optional[Dict[str, Any]] = None
+) -> None:
+    """
+    Kết thúc đo và gửi số đo tới sink
+
+    Args:
+        metrics: Số đo từ start_request (None thì bỏ qua)
+        accumulator: ResponseAccumulator của request
+        scheduler_stats: Thống kê từ scheduler
+    """
+    if metrics is None:
+        return
+    metrics.finish(accumulator, scheduler_stats)
+    try:
+        _sink.record(metrics)
+    except Exception as e:
+        logger.warning(f"Không ghi được metrics: {str(e)}")
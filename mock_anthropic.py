@@ -0,0 +1,655 @@
+import argparse
+import json
+import logging
+import random
+import re
+import socket
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import parse_qs, urlsplit
+
+from config import (
+    MOCK_HOST, MOCK_PORT, MOCK_TTFT, MOCK_TOKENS_PER_SECOND, MOCK_OUTPUT_TOKENS, MOCK_THINKING_TOKENS
+)
+from llm_handler_anthropic import MODELS
+
+logger = logging.getLogger(__name__)
+
+_WORDS = (
+    "lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing", "elit",
+    "sed", "do", "eiusmod", "tempor", "incididunt", "ut", "labore", "et", "dolore",
+    "magna", "aliqua"
+)
+_TOKEN_RE = re.compile(r"\s*\S+")
+# /v1/messages/batches, /v1/messages/batches/{id}, /v1/messages/batches/{id}/results
+_BATCH_PATH_RE = re.compile(r"^/v1/messages/batches(?:/([^/]+)(/results)?)?$")
+
+# Loại lỗi của API theo HTTP status
+_ERROR_TYPES = {
+    400: "invalid_request_error",
+    401: "authentication_error",
+    403: "permission_error",
+    404: "not_found_error",
+    413: "request_too_large",
+    429: "rate_limit_error",
+    500: "api_error",
+    529: "overloaded_error"
+}
+
+MOCK_SIGNATURE = "mock-signature"
+
+
+def _timestamp(seconds: float) -> str:
+    """Thời điểm theo định dạng RFC 3339 của API"""
+    return datetime.fromtimestamp(seconds, timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _tokens(count: int, offset: int = 0) -> List[str]:
+    """Tạo count token xác định (từ đầu tiên không có khoảng trắng phía trước)"""
+    return [("" if i == 0 else " ") + _WORDS[(i + offset) % len(_WORDS)] for i in range(count)]
+
+
+class MockAnthropicServer:
+    """Mock cục bộ, xác định của Anthropic Messages API
+
+    Hỗ trợ POST /v1/messages (JSON và stream SSE, kể cả thinking block và
+    prefill của assistant), POST /v1/messages/count_tokens, GET /v1/models và
+    Message Batches API (tạo, liệt kê, lấy trạng thái và kết quả JSONL).
+    TTFT, tốc độ token và lỗi (status lỗi, event error hoặc ngắt kết nối giữa
+    stream) có thể cấu hình; lỗi được chọn bằng random có seed nên mỗi lần
+    chạy giống nhau.
+
+    Dùng với SDK: anthropic.Anthropic(api_key=..., base_url=server.url)
+    """
+
+    def __init__(
+        self,
+        host: str = MOCK_HOST,
+        port: int = 0,
+        ttft: float = MOCK_TTFT,
+        tokens_per_second: float = MOCK_TOKENS_PER_SECOND,
+        output_tokens: int = MOCK_OUTPUT_TOKENS,
+        thinking_tokens: int = MOCK_THINKING_TOKENS,
+        error_rate: float = 0.0,
+        error_status: int = 529,
+        drop_rate: float = 0.0,
+        stream_error_rate: float = 0.0,
+        stream_error_type: str = "overloaded_error",
+        batch_processing_time: float = 0.0,
+        api_keys: Optional[Set[str]] = None,
+        seed: int = 0
+    ):
+        """
+        Khởi tạo (server chỉ mở cổng khi gọi start())
+
+        Args:
+            host: Địa chỉ lắng nghe
+            port: Cổng (0 để chọn cổng trống)
+            ttft: Số giây trước token đầu tiên
+            tokens_per_second: Tốc độ sinh token (0 = không chờ)
+            output_tokens: Số token text của mỗi response
+            thinking_tokens: Số token thinking khi request bật thinking
+            error_rate: Tỷ lệ request nhận lỗi error_status thay vì response
+            error_status: HTTP status của lỗi được chèn (429, 500, 529, ...)
+            drop_rate: Tỷ lệ stream bị ngắt kết nối sau một nửa số token text
+            stream_error_rate: Tỷ lệ stream nhận SSE event error (HTTP status vẫn
+                là 200) sau một nửa số token text
+            stream_error_type: Loại lỗi của event error (overloaded_error, api_error, ...)
+            batch_processing_time: Số giây từ khi tạo batch đến khi batch kết thúc
+            api_keys: Các API key được chấp nhận (None = mọi key)
+            seed: Seed của random dùng để chọn request bị lỗi
+        """
+        self.host = host
+        self.port = port
+        self.ttft = ttft
+        self.tokens_per_second = tokens_per_second
+        self.output_tokens = output_tokens
+        self.thinking_tokens = thinking_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.drop_rate = drop_rate
+        self.stream_error_rate = stream_error_rate
+        self.stream_error_type = stream_error_type
+        self.batch_processing_time = batch_processing_time
+        self.api_keys = api_keys
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+        self._thread: Optional[threading.Thread] = None
+        self.requests = 0
+        self.errors = 0
+        self.drops = 0
+        self.stream_errors = 0
+        self._batches: Dict[str, Dict[str, Any]] = {}
+
+    def configure(self, **options: Any) -> None:
+        """
+        Đổi cấu hình khi server đang chạy (ttft, tokens_per_second, error_rate, ...)
+
+        Args:
+            **options: Tên và giá trị thuộc tính cần đổi
+        """
+        for name, value in options.items():
+            if not hasattr(self, name) or name.startswith("_"):
+                raise AttributeError(f"Không có tùy chọn {name}")
+            setattr(self, name, value)
+
+    @property
+    def url(self) -> str:
+        """Base URL cho SDK"""
+        return f"http://{self.host}:{self.port}"
+
+    def start(self) -> "MockAnthropicServer":
+        """Mở cổng và phục vụ trong thread nền"""
+        server = ThreadingHTTPServer((self.host, self.port), _MockRequestHandler)
+        server.daemon_threads = True
+        server.mock = self
+        self.port = server.server_address[1]
+        self._server = server
+        self._thread = threading.Thread(target=server.serve_forever, name="mock-anthropic", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Dừng server"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self) -> "MockAnthropicServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _chance(self, rate: float) -> bool:
+        if rate <= 0:
+            return False
+        with self._lock:
+            return self._random.random() < rate
+
+    def _token_delay(self) -> float:
+        return 1.0 / self.tokens_per_second if self.tokens_per_second > 0 else 0.0
+
+    def plan(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Tính nội dung response xác định cho request
+
+        Args:
+            params: Body của POST /v1/messages
+
+        Returns:
+            Dictionary gồm "thinking" và "text" (danh sách token), "stop_reason", "input_tokens"
+        """
+        messages = params.get("messages") or []
+        max_tokens = int(params.get("max_tokens", self.output_tokens))
+        thinking = _tokens(self.thinking_tokens, offset=7) if params.get("thinking") else []
+
+        text = _tokens(min(self.output_tokens, max_tokens))
+        stop_reason = "end_turn" if self.output_tokens <= max_tokens else "max_tokens"
+
+        # Prefill của assistant: viết tiếp từ sau phần đã có
+        if messages and messages[-1].get("role") == "assistant":
+            prefill = messages[-1].get("content")
+            if isinstance(prefill, list):
+                prefill = "".join(block.get("text", "") for block in prefill if isinstance(block, dict))
+            full = "".join(_tokens(self.output_tokens))
+            if prefill and full.startswith(prefill):
+                rest = _TOKEN_RE.findall(full[len(prefill):])
+                text = rest[:max_tokens]
+                stop_reason = "end_turn" if len(rest) <= max_tokens else "max_tokens"
+
+        return {
+            "thinking": thinking,
+            "text": text,
+            "stop_reason": stop_reason,
+            "input_tokens": count_input_tokens(params)
+        }
+
+    def message(self, params: Dict[str, Any], plan: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Message hoàn chỉnh (không streaming) theo kế hoạch từ plan()
+
+        Args:
+            params: Body của request
+            plan: Kết quả của plan(params)
+
+        Returns:
+            Message theo định dạng của API
+        """
+        content = []
+        if plan["thinking"]:
+            content.append({"type": "thinking", "thinking": "".join(plan["thinking"]), "signature": MOCK_SIGNATURE})
+        content.append({"type": "text", "text": "".join(plan["text"])})
+        return {
+            "id": f"msg_mock_{uuid.uuid4().hex[:24]}",
+            "type": "message",
+            "role": "assistant",
+            "model": params.get("model"),
+            "content": content,
+            "stop_reason": plan["stop_reason"],
+            "stop_sequence": None,
+            "usage": {
+                "input_tokens": plan["input_tokens"],
+                "output_tokens": len(plan["thinking"]) + len(plan["text"]),
+                "cache_creation_input_tokens": 0,
+                "cache_read_input_tokens": 0
+            }
+        }
+
+    def create_batch(self, requests: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """
+        Tạo batch; kết quả được tính ngay (theo error_rate) và trả về sau batch_processing_time
+
+        Args:
+            requests: Danh sách {"custom_id", "params"}
+
+        Returns:
+            Trạng thái batch
+        """
+        results = []
+        for request in requests:
+            if self._chance(self.error_rate):
+                result = {"type": "errored", "error": {
+                    "type": "error",
+                    "error": {"type": _ERROR_TYPES.get(self.error_status, "api_error"), "message": "Lỗi được chèn bởi mock server"}
+                }}
+            else:
+                params = request.get("params") or {}
+                result = {"type": "succeeded", "message": self.message(params, self.plan(params))}
+            results.append({"custom_id": request.get("custom_id"), "result": result})
+
+        batch_id = f"msgbatch_mock_{uuid.uuid4().hex[:24]}"
+        with self._lock:
+            self._batches[batch_id] = {"id": batch_id, "created_at": time.time(), "results": results}
+        return self.batch_status(batch_id)
+
+    def batch_status(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Trạng thái batch theo định dạng của API
+
+        Args:
+            batch_id: ID của batch
+
+        Returns:
+            Trạng thái batch, hoặc None nếu không có batch
+        """
+        with self._lock:
+            batch = self._batches.get(batch_id)
+        if batch is None:
+            return None
+        created_at = batch["created_at"]
+        ended = time.time() >= created_at + self.batch_processing_time
+        counts = {"processing": 0, "succeeded": 0, "errored": 0, "canceled": 0, "expired": 0}
+        for entry in batch["results"]:
+            counts[entry["result"]["type"] if ended else "processing"] += 1
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": counts,
+            "created_at": _timestamp(created_at),
+            "ended_at": _timestamp(created_at + self.batch_processing_time) if ended else None,
+            "expires_at": _timestamp(created_at + 24 * 3600),
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"{self.url}/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def list_batches(self, limit: int = 20, after_id: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Một trang batch, mới nhất trước
+
+        Args:
+            limit: Số batch tối đa
+            after_id: Trả về các batch sau batch này
+
+        Returns:
+            Trang kết quả theo định dạng của API
+        """
+        with self._lock:
+            ids = sorted(self._batches, key=lambda batch_id: self._batches[batch_id]["created_at"], reverse=True)
+        if after_id in ids:
+            ids = ids[ids.index(after_id) + 1:]
+        data = [self.batch_status(batch_id) for batch_id in ids[:limit]]
+        return {
+            "data": data,
+            "has_more": len(ids) > limit,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None
+        }
+
+    def batch_results(self, batch_id: str) -> Optional[List[Dict[str, Any]]]:
+        """Kết quả của batch đã kết thúc (None nếu chưa có)"""
+        status = self.batch_status(batch_id)
+        if status is None or status["processing_status"] != "ended":
+            return None
+        with self._lock:
+            return list(self._batches[batch_id]["results"])
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê
+
+        Returns:
+            Dictionary gồm số request, số lỗi đã chèn, số stream bị ngắt, số
+            stream nhận event error và số batch đã tạo
+        """
+        with self._lock:
+            return {
+                "requests": self.requests,
+                "errors": self.errors,
+                "drops": self.drops,
+                "stream_errors": self.stream_errors,
+                "batches": len(self._batches)
+            }
+
+
+def count_input_tokens(params: Dict[str, Any]) -> int:
+    """
+    Số input token xác định của request (khoảng 4 ký tự / token)
+
+    Args:
+        params: Body request
+
+    Returns:
+        Số token
+    """
+    data = json.dumps([params.get("system"), params.get("messages")], ensure_ascii=False)
+    return max(1, len(data) // 4)
+
+
+class _MockRequestHandler(BaseHTTPRequestHandler):
+    """Xử lý HTTP request của MockAnthropicServer (HTTP/1.1 keep-alive)"""
+
+    protocol_version = "HTTP/1.1"
+
+    @property
+    def mock(self) -> MockAnthropicServer:
+        return self.server.mock
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logger.debug(format % args)
+
+    def _send_json(self, status: int, body: Dict[str, Any], headers: Optional[Dict[str, str]] = None) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("request-id", f"req_mock_{uuid.uuid4().hex[:24]}")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_error(self, status: int, message: str) -> None:
+        headers = {"retry-after": "1"} if status in (429, 529) else None
+        self._send_json(status, {
+            "type": "error",
+            "error": {"type": _ERROR_TYPES.get(status, "api_error"), "message": message}
+        }, headers)
+
+    def _read_body(self) -> Optional[Dict[str, Any]]:
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            return json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            self._send_error(400, "Body không phải JSON hợp lệ")
+            return None
+
+    def _authorize(self) -> bool:
+        api_keys = self.mock.api_keys
+        if api_keys is not None and self.headers.get("x-api-key") not in api_keys:
+            self._send_error(401, "invalid x-api-key")
+            return False
+        return True
+
+    def _send_jsonl(self, rows: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(row) + "\n" for row in rows).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/binary")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self) -> None:
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        batch_path = _BATCH_PATH_RE.match(url.path)
+        if url.path != "/v1/models" and batch_path is None:
+            self._send_error(404, f"Không có endpoint {url.path}")
+            return
+        if not self._authorize():
+            return
+        if batch_path is not None:
+            self._get_batches(batch_path.group(1), bool(batch_path.group(2)), query)
+            return
+        limit = int(query.get("limit", ["20"])[0])
+        data = [
+            {"type": "model", "id": model_id, "display_name": info["display_name"], "created_at": "2025-01-01T00:00:00Z"}
+            for model_id, info in list(MODELS.items())[:limit]
+        ]
+        self._send_json(200, {
+            "data": data,
+            "has_more": len(MODELS) > limit,
+            "first_id": data[0]["id"] if data else None,
+            "last_id": data[-1]["id"] if data else None
+        })
+
+    def _get_batches(self, batch_id: Optional[str], results: bool, query: Dict[str, List[str]]) -> None:
+        mock = self.mock
+        if batch_id is None:
+            self._send_json(200, mock.list_batches(
+                limit=int(query.get("limit", ["20"])[0]),
+                after_id=query.get("after_id", [None])[0]
+            ))
+            return
+        body = mock.batch_results(batch_id) if results else mock.batch_status(batch_id)
+        if body is None:
+            self._send_error(404, f"Không có batch {batch_id} hoặc batch chưa kết thúc")
+        elif results:
+            self._send_jsonl(body)
+        else:
+            self._send_json(200, body)
+
+    def do_POST(self) -> None:
+        path = urlsplit(self.path).path
+        if path not in ("/v1/messages", "/v1/messages/count_tokens", "/v1/messages/batches"):
+            self._send_error(404, f"Không có endpoint {path}")
+            return
+        params = self._read_body()
+        if params is None or not self._authorize():
+            return
+        if path == "/v1/messages/count_tokens":
+            self._send_json(200, {"input_tokens": count_input_tokens(params)})
+            return
+        if path == "/v1/messages/batches":
+            self._send_json(200, self.mock.create_batch(params.get("requests") or []))
+            return
+
+        mock = self.mock
+        with mock._lock:
+            mock.requests += 1
+        if mock._chance(mock.error_rate):
+            with mock._lock:
+                mock.errors += 1
+            self._send_error(mock.error_status, "Lỗi được chèn bởi mock server")
+            return
+
+        plan = mock.plan(params)
+        message_id = f"msg_mock_{uuid.uuid4().hex[:24]}"
+        if params.get("stream"):
+            self._stream(params, plan, message_id)
+        else:
+            self._respond(params, plan, message_id)
+
+    def _respond(self, params: Dict[str, Any], plan: Dict[str, Any], message_id: str) -> None:
+        mock = self.mock
+        time.sleep(mock.ttft + mock._token_delay() * (len(plan["thinking"]) + len(plan["text"])))
+        message = mock.message(params, plan)
+        message["id"] = message_id
+        self._send_json(200, message)
+
+    def _write_event(self, event: str, data: Dict[str, Any]) -> None:
+        """Ghi một SSE event thành một chunk (Transfer-Encoding: chunked)"""
+        payload = f"event: {event}\ndata: {json.dumps(data)}\n\n".encode("utf-8")
+        self.wfile.write(f"{len(payload):x}\r\n".encode("ascii") + payload + b"\r\n")
+        self.wfile.flush()
+
+    def _stream(self, params: Dict[str, Any], plan: Dict[str, Any], message_id: str) -> None:
+        mock = self.mock
+        delay = mock._token_delay()
+        drop_after = len(plan["text"]) // 2 if mock._chance(mock.drop_rate) else None
+        error_after = len(plan["text"]) // 2 if mock._chance(mock.stream_error_rate) else None
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.send_header("request-id", f"req_mock_{uuid.uuid4().hex[:24]}")
+        self.end_headers()
+
+        self._write_event("message_start", {
+            "type": "message_start",
+            "message": {
+                "id": message_id,
+                "type": "message",
+                "role": "assistant",
+                "model": params.get("model"),
+                "content": [],
+                "stop_reason": None,
+                "stop_sequence": None,
+                "usage": {
+                    "input_tokens": plan["input_tokens"],
+                    "output_tokens": 1,
+                    "cache_creation_input_tokens": 0,
+                    "cache_read_input_tokens": 0
+                }
+            }
+        })
+        self._write_event("ping", {"type": "ping"})
+        time.sleep(mock.ttft)
+
+        index = 0
+        if plan["thinking"]:
+            self._write_event("content_block_start", {
+                "type": "content_block_start",
+                "index": index,
+                "content_block": {"type": "thinking", "thinking": "", "signature": ""}
+            })
+            for token in plan["thinking"]:
+                self._write_event("content_block_delta", {
+                    "type": "content_block_delta",
+                    "index": index,
+                    "delta": {"type": "thinking_delta", "thinking": token}
+                })
+                time.sleep(delay)
+            self._write_event("content_block_delta", {
+                "type": "content_block_delta",
+                "index": index,
+                "delta": {"type": "signature_delta", "signature": MOCK_SIGNATURE}
+            })
+            self._write_event("content_block_stop", {"type": "content_block_stop", "index": index})
+            index += 1
+
+        self._write_event("content_block_start", {
+            "type": "content_block_start",
+            "index": index,
+            "content_block": {"type": "text", "text": ""}
+        })
+        for position, token in enumerate(plan["text"]):
+            if position == drop_after:
+                self._drop()
+                return
+            if position == error_after:
+                self._stream_error()
+                return
+            self._write_event("content_block_delta", {
+                "type": "content_block_delta",
+                "index": index,
+                "delta": {"type": "text_delta", "text": token}
+            })
+            time.sleep(delay)
+        self._write_event("content_block_stop", {"type": "content_block_stop", "index": index})
+
+        self._write_event("message_delta", {
+            "type": "message_delta",
+            "delta": {"stop_reason": plan["stop_reason"], "stop_sequence": None},
+            "usage": {"output_tokens": len(plan["thinking"]) + len(plan["text"])}
+        })
+        self._write_event("message_stop", {"type": "message_stop"})
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+
+    def _stream_error(self) -> None:
+        """Gửi SSE event error giữa stream rồi kết thúc response (như API khi bị quá tải)"""
+        mock = self.mock
+        with mock._lock:
+            mock.stream_errors += 1
+        self._write_event("error", {
+            "type": "error",
+            "error": {"type": mock.stream_error_type, "message": "Lỗi giữa stream được chèn bởi mock server"}
+        })
+        self.wfile.write(b"0\r\n\r\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+    def _drop(self) -> None:
+        """Ngắt kết nối giữa stream (client thấy chunked body chưa kết thúc)"""
+        with self.mock._lock:
+            self.mock.drops += 1
+        self.close_connection = True
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+def main(argv: Optional[List[str]] = None):
+    """Chạy mock server từ dòng lệnh"""
+    parser = argparse.ArgumentParser(description="Mock cục bộ của Anthropic Messages API")
+    parser.add_argument("--host", default=MOCK_HOST)
+    parser.add_argument("--port", type=int, default=MOCK_PORT)
+    parser.add_argument("--ttft", type=float, default=MOCK_TTFT)
+    parser.add_argument("--tokens-per-second", type=float, default=MOCK_TOKENS_PER_SECOND)
+    parser.add_argument("--output-tokens", type=int, default=MOCK_OUTPUT_TOKENS)
+    parser.add_argument("--thinking-tokens", type=int, default=MOCK_THINKING_TOKENS)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=529)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--stream-error-rate", type=float, default=0.0)
+    parser.add_argument("--stream-error-type", default="overloaded_error")
+    parser.add_argument("--batch-processing-time", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = MockAnthropicServer(
+        host=args.host,
+        port=args.port,
+        ttft=args.ttft,
+        tokens_per_second=args.tokens_per_second,
+        output_tokens=args.output_tokens,
+        thinking_tokens=args.thinking_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        drop_rate=args.drop_rate,
+        stream_error_rate=args.stream_error_rate,
+        stream_error_type=args.stream_error_type,
+        batch_processing_time=args.batch_processing_time,
+        seed=args.seed
+    ).start()
+    print(f"Mock Anthropic API tại {server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,410 @@
+import logging
+import re
+from typing import Any, Dict, Generator, List, Optional, Tuple
+
+from config import (
+    ROUTER_TARGET, ROUTER_LONG_CONTEXT_TOKENS, ROUTER_LONG_PROMPT_TOKENS,
+    ROUTER_EXPECTED_OUTPUT_TOKENS, ROUTER_MAX_ESCALATIONS
+)
+from context_manager import parse_token_limit
+from llm_handler_anthropic import MODELS
+from response_buffer import ResponseAccumulator
+from stream_events import text_chunks
+from token_counter import TokenCounter, token_counter, content_text
+
+logger = logging.getLogger(__name__)
+
+ROUTER_TARGETS = ("cost", "latency", "quality")
+
+MAX_TIER = 3
+
+# Câu hỏi cần suy luận nhiều bước (tiếng Anh và tiếng Việt)
+_REASONING_RE = re.compile(
+    r"\b(analy[sz]e|prove|derive|refactor|architect|optimi[sz]e|debug|step[- ]by[- ]step|"
+    r"trade-?offs?|compare|evaluate|design|phân tích|chứng minh|tối ưu|so sánh|đánh giá|"
+    r"thiết kế|giải thích chi tiết|từng bước)\b",
+    re.IGNORECASE
+)
+# Câu hỏi có code hoặc yêu cầu viết code
+_CODE_RE = re.compile(
+    r"```|\bdef |\bclass |\bfunction\b|#include|\bSELECT\b.+\bFROM\b|\bwrite (a |the )?(code|script|function)\b|viết (code|hàm|chương trình)",
+    re.IGNORECASE
+)
+
+
+class RouteDecision:
+    """Model được chọn cho một request và lý do"""
+
+    def __init__(self, model: str, max_tokens: int, thinking: bool, tier: int, reasons: List[str]):
+        """
+        Khởi tạo
+
+        Args:
+            model: Model ID được chọn
+            max_tokens: Số token tối đa (đã giới hạn theo model)
+            thinking: Có bật thinking không
+            tier: Tier tối thiểu mà câu hỏi cần
+            reasons: Các đặc điểm của câu hỏi dẫn tới tier đó
+        """
+        self.model = model
+        self.max_tokens = max_tokens
+        self.thinking = thinking
+        self.tier = tier
+        self.reasons = reasons
+        self.context_tokens = 0
+        # Các model đã thử trước khi chuyển lên model mạnh hơn
+        self.escalations: List[str] = []
+
+
+class ModelRouter:
+    """Chọn model rẻ/nhanh nhất đáp ứng được câu hỏi bằng heuristic cục bộ
+
+    Câu hỏi được phân loại thành tier 1..3 dựa trên độ dài, tài liệu đính kèm,
+    thinking và dấu hiệu cần suy luận / viết code. Khi response bị cắt do
+    max_tokens, router chuyển lên model kế tiếp và viết tiếp từ phần đã có.
+    """
+
+    def __init__(
+        self,
+        models: Dict[str, Dict[str, Any]],
+        counter: TokenCounter = token_counter,
+        target: str = ROUTER_TARGET,
+        max_escalations: int = ROUTER_MAX_ESCALATIONS
+    ):
+        """
+        Khởi tạo
+
+        Args:
+            models: Bảng model (MODELS), chỉ model có "routing_tier" được xét
+            counter: Bộ đếm token
+            target: Mục tiêu mặc định ("cost", "latency", "quality")
+            max_escalations: Số lần chuyển lên model mạnh hơn tối đa
+        """
+        self.models = {model: info for model, info in models.items() if "routing_tier" in info}
+        self.counter = counter
+        self.target = target
+        self.max_escalations = max_escalations
+
+    def classify(
+        self,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        thinking: bool = False,
+        has_attachment: bool = False
+    ) -> Tuple[int, List[str], int]:
+        """
+        Phân loại câu hỏi cuối cùng
+
+        Args:
+            messages: Danh sách tin nhắn gửi lên API
+            system_prompt: System prompt (tùy chọn)
+            thinking: Người dùng có bật thinking không
+            has_attachment: Có tài liệu đính kèm không
+
+        Returns:
+            (tier tối thiểu, danh sách lý do, số token của toàn bộ context)
+        """
+        prompt = content_text(messages[-1]["content"]) if messages else ""
+        prompt_tokens = self.counter.count_text(prompt)
+        context_tokens = self.counter.count_messages(messages, system_prompt)
+
+        tier, reasons = 1, []
+
+        def require(level: int, reason: str):
+            nonlocal tier
+            tier = max(tier, level)
+            reasons.append(reason)
+
+        if thinking:
+            require(2, "thinking")
+        if has_attachment:
+            require(2, "tài liệu đính kèm")
+        if context_tokens > ROUTER_LONG_CONTEXT_TOKENS:
+            require(2, "context dài")
+        if prompt_tokens > ROUTER_LONG_PROMPT_TOKENS:
+            require(2, "câu hỏi dài")
+
+        reasoning = bool(_REASONING_RE.search(prompt))
+        code = bool(_CODE_RE.search(prompt))
+        if reasoning and (code or prompt_tokens > ROUTER_LONG_PROMPT_TOKENS // 5):
+            require(3, "suy luận phức tạp")
+        elif reasoning or code:
+            require(2, "code" if code else "suy luận")
+        return tier, reasons, context_tokens
+
+    def _estimated_cost(self, model: str, context_tokens: int, max_tokens: int) -> float:
+        price = self.models[model].get("price", {})
+        output_tokens = min(max_tokens, ROUTER_EXPECTED_OUTPUT_TOKENS)
+        return context_tokens * price.get("input", 0.0) + output_tokens * price.get("output", 0.0)
+
+    def candidates(self, tier: int, context_tokens: int, max_tokens: int, thinking: bool, target: str) -> List[str]:
+        """
+        Các model đáp ứng được yêu cầu, sắp theo mục tiêu
+
+        Args:
+            tier: Tier tối thiểu
+            context_tokens: Số token của context
+            max_tokens: Số output token mong muốn
+            thinking: Cần extended thinking không
+            target: "cost" (rẻ nhất), "latency" (tier thấp nhất) hoặc "quality" (tier cao hơn một bậc)
+
+        Returns:
+            Danh sách model ID, model phù hợp nhất đứng đầu
+        """
+        if target == "quality":
+            tier = min(MAX_TIER, tier + 1)
+
+        eligible = []
+        for model, info in self.models.items():
+            if info["routing_tier"] < tier:
+                continue
+            if thinking and not info.get("extended_thinking", False):
+                continue
+            output_tokens = min(max_tokens, parse_token_limit(info.get("max_output", max_tokens)))
+            if context_tokens + output_tokens > parse_token_limit(info.get("context_window", 0)):
+                continue
+            eligible.append(model)
+
+        if target == "latency":
+            return sorted(eligible, key=lambda m: (self.models[m]["routing_tier"], self.models[m]["price"].get("output", 0.0)))
+        return sorted(eligible, key=lambda m: (self._estimated_cost(m, context_tokens, max_tokens), -self.models[m]["routing_tier"]))
+
+    def _decision(self, model: str, max_tokens: int, thinking: bool, tier: int, reasons: List[str]) -> RouteDecision:
+        max_output = parse_token_limit(self.models.get(model, {}).get("max_output", max_tokens))
+        return RouteDecision(model, min(max_tokens, max_output), thinking, tier, reasons)
+
+    def route(
+        self,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        max_tokens: int = 1024,
+        thinking: bool = False,
+        has_attachment: bool = False,
+        target: Optional[str] = None,
+        fallback: Optional[str] = None
+    ) -> RouteDecision:
+        """
+        Chọn model cho request
+
+        Args:
+            messages: Danh sách tin nhắn gửi lên API
+            system_prompt: System prompt (tùy chọn)
+            max_tokens: Số token tối đa người dùng chọn
+            thinking: Người dùng có bật thinking không
+            has_attachment: Có tài liệu đính kèm không
+            target: Mục tiêu (mặc định theo router)
+            fallback: Model dùng khi không có model nào phù hợp
+
+        Returns:
+            RouteDecision
+        """
+        tier, reasons, context_tokens = self.classify(messages, system_prompt, thinking, has_attachment)
+        candidates = self.candidates(tier, context_tokens, max_tokens, thinking, target or self.target)
+        model = candidates[0] if candidates else fallback
+        decision = self._decision(model, max_tokens, thinking, tier, reasons)
+        decision.context_tokens = context_tokens
+        logger.debug(f"Router chọn {model} (tier {tier}: {', '.join(reasons) or 'câu hỏi ngắn'})")
+        return decision
+
+    def escalate(self, decision: RouteDecision, requested_max_tokens: int) -> Optional[RouteDecision]:
+        """
+        Chọn model mạnh hơn (hoặc cho phép output dài hơn) khi response bị cắt
+
+        Args:
+            decision: Lựa chọn hiện tại
+            requested_max_tokens: Số token tối đa người dùng chọn
+
+        Returns:
+            RouteDecision mới, hoặc None nếu không còn model nào tốt hơn
+        """
+        if len(decision.escalations) >= self.max_escalations:
+            return None
+        current = self.models.get(decision.model, {})
+        current_tier = current.get("routing_tier", MAX_TIER)
+        current_output = parse_token_limit(current.get("max_output", decision.max_tokens))
+        # Cho phép output dài gấp đôi, nhưng không vượt quá lựa chọn của người dùng
+        max_tokens = min(requested_max_tokens, decision.max_tokens * 2)
+
+        for model in self.candidates(current_tier, decision.context_tokens, max_tokens, decision.thinking, "cost"):
+            info = self.models[model]
+            if model == decision.model:
+                continue
+            if info["routing_tier"] > current_tier or parse_token_limit(info.get("max_output", 0)) > current_output:
+                escalated = self._decision(model, max_tokens, decision.thinking, decision.tier, decision.reasons)
+                escalated.context_tokens = decision.context_tokens
+                escalated.escalations = decision.escalations + [decision.model]
+                return escalated
+        return None
+
+    def _continue_after(
+        self,
+        decision: RouteDecision,
+        accumulator: ResponseAccumulator,
+        messages: List[Dict[str, Any]],
+        requested_max_tokens: int
+    ) -> Optional[List[Dict[str, Any]]]:
+        """
+        Chuyển decision sang model mạnh hơn nếu response vừa nhận bị cắt
+
+        Returns:
+            Tin nhắn cho lần gọi tiếp theo (kèm prefill), hoặc None nếu dừng
+        """
+        if accumulator.stop_reason != "max_tokens" or accumulator.error or decision.thinking:
+            return None
+        # Response bị cắt bởi giới hạn của chính người dùng (không phải của model): dừng
+        if decision.max_tokens >= requested_max_tokens:
+            return None
+        escalated = self.escalate(decision, requested_max_tokens)
+        if escalated is None:
+            return None
+
+        logger.info(f"Response bị cắt với {decision.model}, chuyển sang {escalated.model}")
+        decision.model = escalated.model
+        decision.max_tokens = escalated.max_tokens
+        decision.escalations = escalated.escalations
+        accumulator.stop_reason = None
+        prefill = accumulator.text.rstrip()
+        if not prefill:
+            return messages
+        return list(messages) + [{"role": "assistant", "content": prefill}]
+
+    def stream(
+        self,
+        handler: Any,
+        decision: RouteDecision,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        requested_max_tokens: Optional[int] = None
+    ) -> Generator[str, None, None]:
+        """
+        Stream response (chỉ kênh text) với model đã chọn, tự chuyển lên model mạnh hơn khi bị cắt
+
+        Tham số giống stream_channels().
+
+        Returns:
+            Generator các chunk text của response
+        """
+        return text_chunks(self.stream_channels(
+            handler, decision, messages, system_prompt, budget_tokens,
+            temperature, accumulator, requested_max_tokens
+        ))
+
+    def stream_channels(
+        self,
+        handler: Any,
+        decision: RouteDecision,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        requested_max_tokens: Optional[int] = None
+    ) -> Generator[Tuple[str, str], None, None]:
+        """
+        Stream response với model đã chọn, tự chuyển lên model mạnh hơn khi bị cắt
+
+        Phần text đã nhận được gửi lại làm prefill của assistant để model mới
+        viết tiếp (không áp dụng khi bật thinking vì API không cho prefill).
+        decision được cập nhật theo model cuối cùng; usage và chi phí trong
+        accumulator là tổng của mọi lần gọi.
+
+        Args:
+            handler: AnthropicHandler
+            decision: Lựa chọn từ route()
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+            budget_tokens: Budget tokens cho thinking
+            temperature: Temperature
+            accumulator: Bộ đệm nhận kết quả (tùy chọn)
+            requested_max_tokens: Số token tối đa người dùng chọn (mặc định theo decision)
+
+        Yields:
+            Cặp (kênh, chunk) như handler.stream_channels()
+        """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        requested_max_tokens = requested_max_tokens or decision.max_tokens
+        request_messages = messages
+        usage: Dict[str, int] = {}
+        cost = 0.0
+
+        while request_messages is not None:
+            # Usage / chi phí của accumulator chỉ tính lần gọi này (tổng được cộng dồn riêng)
+            accumulator.usage = {}
+            accumulator.cost = 0.0
+            yield from handler.stream_channels(
+                model=decision.model,
+                messages=request_messages,
+                system_prompt=system_prompt,
+                max_tokens=decision.max_tokens,
+                thinking=decision.thinking,
+                budget_tokens=budget_tokens,
+                temperature=temperature,
+                accumulator=accumulator
+            )
+            usage, cost = _add_usage(usage, cost, accumulator)
+            request_messages = self._continue_after(decision, accumulator, messages, requested_max_tokens)
+
+        accumulator.usage = usage
+        accumulator.cost = cost
+
+    def respond(
+        self,
+        handler: Any,
+        decision: RouteDecision,
+        messages: List[Dict[str, Any]],
+        system_prompt: Optional[str] = None,
+        budget_tokens: int = 10000,
+        temperature: float = 0.7,
+        accumulator: Optional[ResponseAccumulator] = None,
+        requested_max_tokens: Optional[int] = None
+    ) -> str:
+        """
+        Lấy response (không streaming) với model đã chọn, tự chuyển lên model mạnh hơn khi bị cắt
+
+        Tham số giống stream().
+
+        Returns:
+            Response text (hoặc thông báo lỗi)
+        """
+        if accumulator is None:
+            accumulator = ResponseAccumulator()
+        requested_max_tokens = requested_max_tokens or decision.max_tokens
+        request_messages = messages
+        usage: Dict[str, int] = {}
+        cost = 0.0
+
+        while request_messages is not None:
+            # Usage / chi phí của accumulator chỉ tính lần gọi này (tổng được cộng dồn riêng)
+            accumulator.usage = {}
+            accumulator.cost = 0.0
+            handler.get_response(
+                model=decision.model,
+                messages=request_messages,
+                system_prompt=system_prompt,
+                max_tokens=decision.max_tokens,
+                thinking=decision.thinking,
+                budget_tokens=budget_tokens,
+                temperature=temperature,
+                accumulator=accumulator
+            )
+            usage, cost = _add_usage(usage, cost, accumulator)
+            request_messages = self._continue_after(decision, accumulator, messages, requested_max_tokens)
+
+        accumulator.usage = usage
+        accumulator.cost = cost
+        return accumulator.error or accumulator.text
+
+
+def _add_usage(usage: Dict[str, int], cost: float, accumulator: ResponseAccumulator) -> Tuple[Dict[str, int], float]:
+    """Cộng usage và chi phí của lần gọi vừa xong vào tổng"""
+    for field, value in accumulator.usage.items():
+        usage[field] = usage.get(field, 0) + value
+    return usage, cost + accumulator.cost
+
+
+# Router dùng chung trong process
+model_router = ModelRouter(MODELS)
@@ -0,0 +1,77 @@
+from typing import Any, Dict, List
+
+from config import PROMPT_CACHE_DOCUMENT_FACTOR
+from token_counter import TokenCounter, token_counter
+
+# API cho phép tối đa 4 cache breakpoint trong một request
+MAX_CACHE_BREAKPOINTS = 4
+EPHEMERAL = {"type": "ephemeral"}
+
+
+def _with_cache_control(content: Any) -> List[Dict[str, Any]]:
+    """Chuyển content sang dạng block và gắn cache_control vào block cuối cùng"""
+    if isinstance(content, str):
+        return [{"type": "text", "text": content, "cache_control": EPHEMERAL}]
+    blocks = [dict(block) for block in content]
+    blocks[-1]["cache_control"] = EPHEMERAL
+    return blocks
+
+
+def apply_cache_breakpoints(
+    params: Dict[str, Any],
+    min_tokens: int,
+    counter: TokenCounter = token_counter
+) -> Dict[str, Any]:
+    """
+    Gắn cache_control breakpoint vào system prompt, tài liệu lớn và phần lịch sử ổn định
+
+    Một breakpoint chỉ có tác dụng khi toàn bộ prefix tính đến nó đạt độ dài
+    cache tối thiểu của model, nên số token được cộng dồn theo thứ tự
+    system -> messages. Thứ tự ưu tiên:
+
+    1. System prompt
+    2. Tin nhắn lớn (tài liệu đính kèm) gần nhất
+    3. Tin nhắn cuối cùng, để lượt sau đọc lại toàn bộ lịch sử từ cache
+
+    Không thay đổi params gốc; các tin nhắn được gắn breakpoint sẽ được copy.
+
+    Args:
+        params: Parameters của request (từ _build_request_params)
+        min_tokens: Độ dài prefix tối thiểu có thể cache của model
+        counter: Token counter dùng để ước tính độ dài
+
+    Returns:
+        Parameters mới với các cache breakpoint
+    """
+    params = dict(params)
+    messages = list(params.get("messages", []))
+    prefix_tokens = 0
+    breakpoints = 0
+
+    system = params.get("system")
+    if isinstance(system, str) and system:
+        prefix_tokens += counter.count_text(system)
+        if prefix_tokens >= min_tokens:
+            params["system"] = _with_cache_control(system)
+            breakpoints += 1
+
+    # Chừa một breakpoint cho tin nhắn cuối cùng
+    document_slots = MAX_CACHE_BREAKPOINTS - breakpoints - 1
+    document_threshold = min_tokens * PROMPT_CACHE_DOCUMENT_FACTOR
+    candidates = []
+    for index, message in enumerate(messages[:-1]):
+        tokens = counter.count_message(message)
+        prefix_tokens += tokens
+        if tokens >= document_threshold and prefix_tokens >= min_tokens:
+            candidates.append(index)
+
+    for index in candidates[-document_slots:] if document_slots > 0 else []:
+        messages[index] = {**messages[index], "content": _with_cache_control(messages[index]["content"])}
+
+    if messages:
+        prefix_tokens += counter.count_message(messages[-1])
+        if prefix_tokens >= min_tokens:
+            messages[-1] = {**messages[-1], "content": _with_cache_control(messages[-1]["content"])}
+
+    params["messages"] = messages
+    return params
@@ -0,0 +1,87 @@
+import time
+from typing import Callable, Dict, Optional
+
+from config import RENDER_INTERVAL_MS, RENDER_MAX_CHARS
+
+
+class RenderScheduler:
+    """Gộp các chunk streaming và chỉ render lại khi hết ngân sách thời gian hoặc ký tự"""
+
+    def __init__(
+        self,
+        render: Callable[[str], None],
+        snapshot: Callable[[], str],
+        interval_ms: int = RENDER_INTERVAL_MS,
+        max_chars: int = RENDER_MAX_CHARS,
+        clock: Callable[[], float] = time.monotonic
+    ):
+        """
+        Khởi tạo render scheduler
+
+        Args:
+            render: Hàm render nhận toàn bộ nội dung hiện tại
+            snapshot: Hàm trả về nội dung hiện tại, chỉ được gọi khi cần render
+            interval_ms: Khoảng thời gian tối thiểu giữa 2 lần render (ms)
+            max_chars: Số ký tự tích lũy tối đa trước khi buộc render
+            clock: Hàm lấy thời gian (dùng để test)
+        """
+        self.render = render
+        self.snapshot = snapshot
+        self.interval = interval_ms / 1000.0
+        self.max_chars = max_chars
+        self._clock = clock
+        self._last_render: Optional[float] = None
+        self._pending_chars = 0
+        self.chunks = 0
+        self.renders = 0
+        self.skipped = 0
+
+    def push(self, chunk: str) -> bool:
+        """
+        Ghi nhận một chunk mới và render nếu đã hết ngân sách
+
+        Args:
+            chunk: Chunk vừa nhận được
+
+        Returns:
+            True nếu đã render lại, False nếu chunk được gộp vào lần render sau
+        """
+        self.chunks += 1
+        self._pending_chars += len(chunk)
+
+        now = self._clock()
+        # Chunk đầu tiên luôn được render ngay để không làm chậm time-to-first-token
+        if (
+            self._last_render is None
+            or self._pending_chars >= self.max_chars
+            or now - self._last_render >= self.interval
+        ):
+            self._render(now)
+            return True
+
+        self.skipped += 1
+        return False
+
+    def flush(self) -> None:
+        """Render phần nội dung còn đang chờ (nếu có)"""
+        if self._pending_chars:
+            self._render(self._clock())
+
+    def _render(self, now: float) -> None:
+        self.render(self.snapshot())
+        self.renders += 1
+        self._pending_chars = 0
+        self._last_render = now
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê số lần render
+
+        Returns:
+            Dictionary gồm số chunk, số lần render và số lần bỏ qua
+        """
+        return {
+            "chunks": self.chunks,
+            "renders": self.renders,
+            "skipped": self.skipped
+        }
@@ -0,0 +1,379 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import anthropic
+import httpx
+
+from client_pool import hash_api_key
+from config import (
+    SCHEDULER_REQUESTS_PER_MINUTE, SCHEDULER_TOKENS_PER_MINUTE,
+    SCHEDULER_MAX_RETRIES, SCHEDULER_BACKOFF_BASE, SCHEDULER_BACKOFF_MAX
+)
+
+logger = logging.getLogger(__name__)
+
+# Độ ưu tiên (số nhỏ hơn được phục vụ trước)
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+# Mã lỗi HTTP nên thử lại (rate limit, lỗi server, 529 overloaded)
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+# Loại lỗi (error.type trong body) nên thử lại; lỗi nhận qua SSE event error
+# giữa stream mang HTTP status 200 của stream nên chỉ phân loại được theo body
+RETRYABLE_ERROR_TYPES = {"overloaded_error", "api_error", "rate_limit_error"}
+
+# Chu kỳ (giây) request bất đồng bộ kiểm tra lại hàng đợi khi chưa đến lượt
+_ASYNC_POLL_INTERVAL = 0.05
+
+
+class TokenBucket:
+    """Token bucket nạp lại đều theo tốc độ mỗi phút"""
+
+    def __init__(self, per_minute: float, clock: Callable[[], float] = time.monotonic):
+        """
+        Khởi tạo bucket đầy
+
+        Args:
+            per_minute: Số đơn vị được nạp lại mỗi phút (cũng là dung lượng tối đa)
+            clock: Hàm lấy thời gian
+        """
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self._clock = clock
+        self.tokens = self.capacity
+        self.updated_at = clock()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """
+        Số giây cần chờ để có đủ amount đơn vị (0 nếu có thể dùng ngay)
+
+        Args:
+            amount: Số đơn vị cần dùng (bị giới hạn bởi dung lượng bucket)
+
+        Returns:
+            Số giây cần chờ
+        """
+        self._refill(self._clock())
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float) -> None:
+        """Trừ amount đơn vị khỏi bucket"""
+        self._refill(self._clock())
+        self.tokens -= min(amount, self.capacity)
+
+
+class _KeyState:
+    """Hàng đợi ưu tiên và các bucket của một API key"""
+
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.waiting: List[Tuple[int, int]] = []
+
+
+def retry_after_seconds(error: Exception) -> Optional[float]:
+    """
+    Đọc thời gian chờ từ header retry-after-ms / retry-after của response lỗi
+
+    Args:
+        error: Lỗi từ API
+
+    Returns:
+        Số giây cần chờ, hoặc None nếu không có header
+    """
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000.0
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except (TypeError, ValueError):
+        return None
+    return None
+
+
+def error_type(error: Exception) -> Optional[str]:
+    """
+    Đọc loại lỗi ("overloaded_error", "api_error", ...) từ body của lỗi API
+
+    Args:
+        error: Lỗi từ API
+
+    Returns:
+        Loại lỗi, hoặc None nếu body không có
+    """
+    body = getattr(error, "body", None)
+    if isinstance(body, dict) and isinstance(body.get("error"), dict):
+        return body["error"].get("type")
+    return None
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Kiểm tra lỗi có nên thử lại không (429, 5xx, 529 overloaded, lỗi kết nối,
+    kết nối bị ngắt hoặc SSE event error overloaded / api_error khi đang đọc stream)
+
+    Args:
+        error: Lỗi từ API
+
+    Returns:
+        True nếu nên thử lại
+    """
+    if isinstance(error, (anthropic.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(error, anthropic.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS_CODES or error_type(error) in RETRYABLE_ERROR_TYPES
+    return False
+
+
+class RequestScheduler:
+    """Điều phối request theo API key: giới hạn requests/phút và tokens/phút,
+    ưu tiên request tương tác, tự thử lại với exponential backoff có jitter
+
+    Request đồng bộ (call) và bất đồng bộ (call_async) dùng chung hàng đợi
+    và token bucket của mỗi API key.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = SCHEDULER_REQUESTS_PER_MINUTE,
+        tokens_per_minute: float = SCHEDULER_TOKENS_PER_MINUTE,
+        max_retries: int = SCHEDULER_MAX_RETRIES,
+        backoff_base: float = SCHEDULER_BACKOFF_BASE,
+        backoff_max: float = SCHEDULER_BACKOFF_MAX,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        """
+        Khởi tạo scheduler
+
+        Args:
+            requests_per_minute: Số request tối đa mỗi phút cho mỗi API key
+            tokens_per_minute: Số input token tối đa mỗi phút cho mỗi API key
+            max_retries: Số lần thử lại tối đa
+            backoff_base: Thời gian chờ cơ bản (giây) cho lần thử lại đầu tiên
+            backoff_max: Thời gian chờ tối đa (giây) giữa 2 lần thử
+            sleep: Hàm sleep (dùng để test)
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._sleep = sleep
+        self._keys: Dict[str, _KeyState] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+        self.retries = 0
+
+    def acquire(self, api_key: str, estimated_tokens: int = 0, priority: int = PRIORITY_INTERACTIVE) -> float:
+        """
+        Chờ đến lượt và đủ quota cho một request
+
+        Args:
+            api_key: API key
+            estimated_tokens: Số input token ước tính của request
+            priority: Độ ưu tiên (PRIORITY_INTERACTIVE / PRIORITY_BACKGROUND)
+
+        Returns:
+            Thời gian đã chờ trong hàng đợi (giây)
+        """
+        started = time.monotonic()
+        with self._condition:
+            state, ticket = self._enqueue(api_key, priority)
+            while True:
+                wait = self._try_take(state, ticket, estimated_tokens)
+                if wait == 0:
+                    return time.monotonic() - started
+                # wait là None khi chưa đứng đầu hàng đợi: chờ đến khi được báo
+                self._condition.wait(timeout=wait)
+
+    async def acquire_async(
+        self,
+        api_key: str,
+        estimated_tokens: int = 0,
+        priority: int = PRIORITY_INTERACTIVE
+    ) -> float:
+        """
+        Bản bất đồng bộ của acquire(): chờ bằng asyncio.sleep, không chặn event loop
+
+        Args:
+            api_key: API key
+            estimated_tokens: Số input token ước tính của request
+            priority: Độ ưu tiên (PRIORITY_INTERACTIVE / PRIORITY_BACKGROUND)
+
+        Returns:
+            Thời gian đã chờ trong hàng đợi (giây)
+        """
+        started = time.monotonic()
+        with self._condition:
+            state, ticket = self._enqueue(api_key, priority)
+        taken = False
+        try:
+            while True:
+                with self._condition:
+                    wait = self._try_take(state, ticket, estimated_tokens)
+                if wait == 0:
+                    taken = True
+                    return time.monotonic() - started
+                await asyncio.sleep(_ASYNC_POLL_INTERVAL if wait is None else wait)
+        finally:
+            if not taken:
+                # Task bị hủy khi đang chờ: bỏ lượt để không chặn các request sau
+                with self._condition:
+                    state.waiting.remove(ticket)
+                    heapq.heapify(state.waiting)
+                    self._condition.notify_all()
+
+    def _enqueue(self, api_key: str, priority: int) -> Tuple[_KeyState, Tuple[int, int]]:
+        """Thêm một lượt vào hàng đợi của API key (gọi khi đang giữ _condition)"""
+        key = hash_api_key(api_key)
+        state = self._keys.get(key)
+        if state is None:
+            state = self._keys[key] = _KeyState(self.requests_per_minute, self.tokens_per_minute)
+        ticket = (priority, next(self._sequence))
+        heapq.heappush(state.waiting, ticket)
+        return state, ticket
+
+    def _try_take(self, state: _KeyState, ticket: Tuple[int, int], estimated_tokens: int) -> Optional[float]:
+        """
+        Lấy quota cho lượt ticket nếu có thể (gọi khi đang giữ _condition)
+
+        Returns:
+            0 nếu đã lấy được, số giây cần chờ nếu lượt đang đứng đầu hàng đợi,
+            None nếu chưa đến lượt
+        """
+        if state.waiting[0] != ticket:
+            return None
+        wait = max(state.requests.wait_time(1), state.tokens.wait_time(estimated_tokens))
+        if wait > 0:
+            return wait
+        heapq.heappop(state.waiting)
+        state.requests.consume(1)
+        state.tokens.consume(estimated_tokens)
+        self._condition.notify_all()
+        return 0
+
+    def backoff(self, attempt: int, error: Optional[Exception] = None) -> float:
+        """
+        Thời gian chờ trước lần thử lại thứ attempt (ưu tiên header retry-after)
+
+        Args:
+            attempt: Số thứ tự lần thử lại (bắt đầu từ 0)
+            error: Lỗi vừa gặp (tùy chọn)
+
+        Returns:
+            Số giây cần chờ
+        """
+        if error is not None:
+            retry_after = retry_after_seconds(error)
+            if retry_after is not None:
+                return min(retry_after, self.backoff_max)
+        # Full jitter: ngẫu nhiên trong [0, base * 2^attempt]
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def call(
+        self,
+        fn: Callable[[], Any],
+        api_key: str,
+        estimated_tokens: int = 0,
+        priority: int = PRIORITY_INTERACTIVE,
+        stats: Optional[Dict[str, Any]] = None,
+        retries_used: int = 0
+    ) -> Any:
+        """
+        Gọi fn khi đến lượt, tự thử lại với lỗi tạm thời
+
+        Args:
+            fn: Hàm thực hiện request
+            api_key: API key
+            estimated_tokens: Số input token ước tính
+            priority: Độ ưu tiên
+            stats: Dictionary nhận "queue_time" và "retries" (tùy chọn, cộng dồn
+                qua nhiều lần gọi)
+            retries_used: Số lần thử lại đã dùng bởi các lần gọi trước của cùng
+                request (ví dụ stream được nối tiếp); max_retries là ngân sách chung
+
+        Returns:
+            Kết quả của fn
+        """
+        attempt = retries_used
+        while True:
+            queue_time = self.acquire(api_key, estimated_tokens, priority)
+            if stats is not None:
+                stats["queue_time"] = stats.get("queue_time", 0.0) + queue_time
+                stats.setdefault("retries", 0)
+            try:
+                return fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                self.retries += 1
+                if stats is not None:
+                    stats["retries"] += 1
+                logger.warning(f"Request lỗi tạm thời ({str(e)}), thử lại lần {attempt} sau {delay:.2f}s")
+                self._sleep(delay)
+
+    async def call_async(
+        self,
+        fn: Callable[[], Awaitable[Any]],
+        api_key: str,
+        estimated_tokens: int = 0,
+        priority: int = PRIORITY_INTERACTIVE,
+        stats: Optional[Dict[str, Any]] = None,
+        retries_used: int = 0
+    ) -> Any:
+        """
+        Bản bất đồng bộ của call(): fn trả về coroutine, backoff dùng asyncio.sleep
+
+        Args:
+            fn: Hàm tạo coroutine thực hiện request
+            api_key: API key
+            estimated_tokens: Số input token ước tính
+            priority: Độ ưu tiên
+            stats: Dictionary nhận "queue_time" và "retries" (tùy chọn)
+            retries_used: Số lần thử lại đã dùng trước đó (xem call())
+
+        Returns:
+            Kết quả của coroutine
+        """
+        attempt = retries_used
+        while True:
+            queue_time = await self.acquire_async(api_key, estimated_tokens, priority)
+            if stats is not None:
+                stats["queue_time"] = stats.get("queue_time", 0.0) + queue_time
+                stats.setdefault("retries", 0)
+            try:
+                return await fn()
+            except Exception as e:
+                if not is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                delay = self.backoff(attempt, e)
+                attempt += 1
+                self.retries += 1
+                if stats is not None:
+                    stats["retries"] += 1
+                logger.warning(f"Request lỗi tạm thời ({str(e)}), thử lại lần {attempt} sau {delay:.2f}s")
+                await asyncio.sleep(delay)
+
+
+# Scheduler dùng chung trong process
+request_scheduler = RequestScheduler()
@@ -0,0 +1,123 @@
+from typing import Any, Dict, List, Optional
+
+TEXT = "text"
+THINKING = "thinking"
+SIGNATURE = "signature"  # Chữ ký của thinking block
+TOOL_INPUT = "tool_input"  # JSON input của tool_use block
+CHANNELS = (TEXT, THINKING, SIGNATURE, TOOL_INPUT)
+
+# Các trường usage được ghi nhận từ response (kể cả prompt caching)
+USAGE_FIELDS = (
+    "input_tokens",
+    "output_tokens",
+    "cache_creation_input_tokens",
+    "cache_read_input_tokens"
+)
+
+
+class ResponseAccumulator:
+    """Bộ đệm tích lũy response theo từng kênh (text / thinking) với chi phí tuyến tính"""
+
+    def __init__(self):
+        """Khởi tạo bộ đệm rỗng cho mỗi kênh"""
+        self._parts: Dict[str, List[str]] = {channel: [] for channel in CHANNELS}
+        self._lengths: Dict[str, int] = {channel: 0 for channel in CHANNELS}
+        self.usage: Dict[str, int] = {}
+        # Lỗi cuối cùng của request (không được ghi vào kênh text)
+        self.error: Optional[str] = None
+        # Số lần stream được nối tiếp sau khi mất kết nối và số token đã giữ lại được
+        self.resumes = 0
+        self.salvaged_tokens = 0
+        # Model thực sự được dùng (có thể khác model yêu cầu khi bị hạ cấp) và chi phí (USD)
+        self.model: Optional[str] = None
+        self.cost = 0.0
+        # Lý do kết thúc của API ("end_turn", "max_tokens", ...)
+        self.stop_reason: Optional[str] = None
+        # Response được phát lại từ response cache (không gọi API)
+        self.cached = False
+
+    def append(self, chunk: str, channel: str = TEXT) -> None:
+        """
+        Thêm một chunk vào kênh
+
+        Args:
+            chunk: Nội dung cần thêm
+            channel: Tên kênh (TEXT, THINKING, SIGNATURE hoặc TOOL_INPUT)
+        """
+        if not chunk:
+            return
+        self._parts[channel].append(chunk)
+        self._lengths[channel] += len(chunk)
+
+    def append_text(self, chunk: str) -> None:
+        """Thêm chunk vào kênh text"""
+        self.append(chunk, TEXT)
+
+    def append_thinking(self, chunk: str) -> None:
+        """Thêm chunk vào kênh thinking"""
+        self.append(chunk, THINKING)
+
+    def update_usage(self, usage: Any) -> None:
+        """
+        Ghi nhận usage từ response hoặc stream event (chỉ các trường có giá trị)
+
+        Args:
+            usage: Đối tượng usage của API
+        """
+        if usage is None:
+            return
+        for field in USAGE_FIELDS:
+            value = getattr(usage, field, None)
+            if value is not None:
+                self.usage[field] = value
+
+    def snapshot(self, channel: str = TEXT) -> str:
+        """
+        Lấy toàn bộ nội dung hiện tại của một kênh
+
+        Các phần đã join được gộp lại thành một phần duy nhất, nên những lần
+        snapshot sau chỉ phải nối thêm các chunk mới.
+
+        Args:
+            channel: Tên kênh
+
+        Returns:
+            Nội dung của kênh
+        """
+        parts = self._parts[channel]
+        if not parts:
+            return ""
+        if len(parts) > 1:
+            parts[:] = ["".join(parts)]
+        return parts[0]
+
+    @property
+    def text(self) -> str:
+        """Nội dung kênh text"""
+        return self.snapshot(TEXT)
+
+    @property
+    def thinking(self) -> str:
+        """Nội dung kênh thinking"""
+        return self.snapshot(THINKING)
+
+    @property
+    def signature(self) -> str:
+        """Chữ ký của thinking block"""
+        return self.snapshot(SIGNATURE)
+
+    @property
+    def tool_input(self) -> str:
+        """JSON input của tool_use block"""
+        return self.snapshot(TOOL_INPUT)
+
+    def has_thinking(self) -> bool:
+        """Kiểm tra xem response có nội dung thinking không"""
+        return self._lengths[THINKING] > 0
+
+    def length(self, channel: str = TEXT) -> int:
+        """Số ký tự hiện có trong kênh"""
+        return self._lengths[channel]
+
+    def __len__(self) -> int:
+        return self._lengths[TEXT]
@@ -0,0 +1,254 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+from config import (
+    RESPONSE_CACHE_PATH, RESPONSE_CACHE_TTL, RESPONSE_CACHE_MEMORY_ENTRIES,
+    RESPONSE_CACHE_DISK_BYTES, RESPONSE_CACHE_CHUNK_CHARS
+)
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\S+\s*|\s+")
+
+
+def _canonical(value: Any) -> Any:
+    """Bỏ cache_control (chỉ ảnh hưởng prompt caching, không ảnh hưởng nội dung response)"""
+    if isinstance(value, dict):
+        return {k: _canonical(v) for k, v in value.items() if k != "cache_control"}
+    if isinstance(value, (list, tuple)):
+        return [_canonical(v) for v in value]
+    return value
+
+
+def request_key(params: Dict[str, Any]) -> str:
+    """
+    Hash chuẩn hóa của parameters request
+
+    Args:
+        params: Parameters từ _build_request_params
+
+    Returns:
+        SHA-256 hex digest
+    """
+    data = json.dumps(_canonical(params), sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+
+def is_cacheable(params: Dict[str, Any]) -> bool:
+    """
+    Request có kết quả xác định (temperature = 0, không thinking) không
+
+    Args:
+        params: Parameters request
+
+    Returns:
+        True nếu response có thể được cache
+    """
+    return params.get("temperature") == 0 and "thinking" not in params
+
+
+def replay_chunks(text: str, chunk_chars: int = RESPONSE_CACHE_CHUNK_CHARS) -> Iterator[str]:
+    """
+    Chia text thành các chunk khoảng chunk_chars ký tự theo ranh giới từ
+
+    Args:
+        text: Response đã cache
+        chunk_chars: Kích thước chunk mục tiêu
+
+    Yields:
+        Từng chunk
+    """
+    current, size = [], 0
+    for match in _WORD_RE.finditer(text):
+        word = match.group(0)
+        if current and size + len(word) > chunk_chars:
+            yield "".join(current)
+            current, size = [], 0
+        current.append(word)
+        size += len(word)
+    if current:
+        yield "".join(current)
+
+
+class ResponseCache:
+    """Cache response của request xác định, gồm tầng bộ nhớ (LRU) và tầng SQLite
+
+    Entry hết hạn sau ttl giây; tầng SQLite bị giới hạn dung lượng và loại bỏ
+    entry ít được dùng gần đây nhất.
+    """
+
+    def __init__(
+        self,
+        db_path: Optional[str] = RESPONSE_CACHE_PATH,
+        memory_entries: int = RESPONSE_CACHE_MEMORY_ENTRIES,
+        disk_bytes: int = RESPONSE_CACHE_DISK_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        clock: Callable[[], float] = time.time
+    ):
+        """
+        Khởi tạo cache
+
+        Args:
+            db_path: File SQLite của tầng đĩa (None để chỉ dùng bộ nhớ)
+            memory_entries: Số entry tối đa trong bộ nhớ
+            disk_bytes: Dung lượng tối đa của tầng SQLite (byte đã nén)
+            ttl: Thời gian sống của entry (giây)
+            clock: Hàm lấy thời gian
+        """
+        self.db_path = db_path
+        self.memory_entries = memory_entries
+        self.disk_bytes = disk_bytes
+        self.ttl = ttl
+        self._clock = clock
+        self._memory: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _connection(self) -> Optional[sqlite3.Connection]:
+        """Mở kết nối SQLite khi cần lần đầu (gọi khi đang giữ lock)"""
+        if self._db is None and self.db_path:
+            try:
+                os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+                db = sqlite3.connect(self.db_path, check_same_thread=False)
+                db.execute("PRAGMA journal_mode=WAL")
+                db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                    "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+                )
+                db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+                db.commit()
+                self._db = db
+            except sqlite3.Error as e:
+                logger.warning(f"Không mở được response cache {self.db_path}: {str(e)}")
+                self.db_path = None
+        return self._db
+
+    def _remember(self, key: str, created_at: float, entry: Dict[str, Any]) -> None:
+        self._memory[key] = (created_at, entry)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """
+        Lấy response đã cache
+
+        Args:
+            key: Khóa từ request_key()
+
+        Returns:
+            Entry gồm "text", "thinking", "usage", "stop_reason", hoặc None
+        """
+        now = self._clock()
+        with self._lock:
+            cached = self._memory.get(key)
+            if cached is not None:
+                created_at, entry = cached
+                if now - created_at <= self.ttl:
+                    self._memory.move_to_end(key)
+                    self.memory_hits += 1
+                    return entry
+                del self._memory[key]
+
+            db = self._connection()
+            if db is not None:
+                try:
+                    row = db.execute(
+                        "SELECT value, created_at FROM responses WHERE key = ?", (key,)
+                    ).fetchone()
+                    if row is not None and now - row[1] <= self.ttl:
+                        entry = json.loads(zlib.decompress(row[0]).decode("utf-8"))
+                        db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+                        db.commit()
+                        self._remember(key, row[1], entry)
+                        self.disk_hits += 1
+                        return entry
+                    if row is not None:
+                        db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                        db.commit()
+                except (sqlite3.Error, ValueError, zlib.error) as e:
+                    logger.warning(f"Không đọc được response cache {key[:12]}: {str(e)}")
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        """
+        Lưu response vào cache
+
+        Args:
+            key: Khóa từ request_key()
+            entry: Response gồm "text", "thinking", "usage", "stop_reason"
+        """
+        now = self._clock()
+        with self._lock:
+            self._remember(key, now, entry)
+            db = self._connection()
+            if db is None:
+                return
+            try:
+                value = zlib.compress(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+                db.execute(
+                    "INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), now, now)
+                )
+                self._evict_disk(db, now)
+                db.commit()
+            except sqlite3.Error as e:
+                logger.warning(f"Không ghi được response cache: {str(e)}")
+
+    def _evict_disk(self, db: sqlite3.Connection, now: float) -> None:
+        """Xóa entry hết hạn và entry dùng lâu nhất khi vượt dung lượng"""
+        db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.disk_bytes:
+            return
+        for key, size in db.execute("SELECT key, size FROM responses ORDER BY accessed_at").fetchall():
+            if total <= self.disk_bytes:
+                break
+            db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def clear(self) -> None:
+        """Xóa toàn bộ cache"""
+        with self._lock:
+            self._memory.clear()
+            db = self._connection()
+            if db is not None:
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Thống kê cache
+
+        Returns:
+            Dictionary gồm số hit từng tầng, miss và tỷ lệ hit
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                "memory_entries": len(self._memory),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0
+            }
+
+
+# Cache dùng chung trong process
+response_cache = ResponseCache()
@@ -0,0 +1,302 @@
+import json
+import logging
+import math
+import os
+import re
+import zlib
+from collections import Counter
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+from config import (
+    RETRIEVAL_INDEX_DIR, RETRIEVAL_CHUNK_TOKENS, RETRIEVAL_CHUNK_OVERLAP,
+    RETRIEVAL_TOP_K, RETRIEVAL_TOKEN_BUDGET
+)
+from token_counter import token_counter
+
+logger = logging.getLogger(__name__)
+
+_WORD_RE = re.compile(r"\w+")
+
+# Số bucket cho hashed term (unigram + bigram)
+HASH_BITS = 22
+_HASH_MASK = (1 << HASH_BITS) - 1
+
+# Tham số BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+_INDEX_ARRAYS = ("term_ids", "doc_ids", "tfs", "doc_lengths")
+
+
+def _term_ids(text: str) -> List[int]:
+    """Tách text thành các term (unigram và bigram, chữ thường) đã được hash"""
+    words = _WORD_RE.findall(text.lower())
+    terms = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    return [zlib.crc32(term.encode("utf-8")) & _HASH_MASK for term in terms]
+
+
+def _split_long_paragraph(paragraph: str, chunk_tokens: int) -> List[str]:
+    """Chia một đoạn quá dài thành các phần khoảng chunk_tokens token"""
+    pieces, current, used = [], [], 0
+    for word in paragraph.split():
+        cost = token_counter.tokenizer(word)
+        if current and used + cost > chunk_tokens:
+            pieces.append(" ".join(current))
+            current, used = [], 0
+        current.append(word)
+        used += cost
+    if current:
+        pieces.append(" ".join(current))
+    return pieces
+
+
+def chunk_pages(
+    pages: List[str],
+    chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS,
+    overlap_tokens: int = RETRIEVAL_CHUNK_OVERLAP
+) -> List[Dict[str, Any]]:
+    """
+    Chia văn bản từng trang thành các đoạn khoảng chunk_tokens token
+
+    Các đoạn văn được gộp tham lam trong phạm vi một trang; đoạn văn cuối của
+    chunk trước được lặp lại ở chunk sau nếu ngắn hơn overlap_tokens.
+
+    Args:
+        pages: Văn bản từng trang
+        chunk_tokens: Kích thước mục tiêu của mỗi chunk (token)
+        overlap_tokens: Số token tối đa được lặp lại giữa 2 chunk liên tiếp
+
+    Returns:
+        Danh sách chunk dạng {"text", "page", "tokens"}
+    """
+    chunks = []
+    for page_number, page in enumerate(pages, start=1):
+        paragraphs = []
+        for paragraph in page.split("\n"):
+            paragraph = paragraph.strip()
+            if not paragraph:
+                continue
+            tokens = token_counter.tokenizer(paragraph)
+            if tokens > chunk_tokens:
+                for piece in _split_long_paragraph(paragraph, chunk_tokens):
+                    paragraphs.append((piece, token_counter.tokenizer(piece)))
+            else:
+                paragraphs.append((paragraph, tokens))
+
+        current, used = [], 0
+        for paragraph, tokens in paragraphs:
+            if current and used + tokens > chunk_tokens:
+                chunks.append({"text": "\n".join(p for p, _ in current), "page": page_number, "tokens": used})
+                last = current[-1]
+                current, used = ([last], last[1]) if last[1] <= overlap_tokens else ([], 0)
+            current.append((paragraph, tokens))
+            used += tokens
+        if current:
+            chunks.append({"text": "\n".join(p for p, _ in current), "page": page_number, "tokens": used})
+    return chunks
+
+
+class RetrievalIndex:
+    """Chỉ mục BM25 trên hashed n-gram, lưu dạng mảng NumPy (CSR theo term)
+
+    Các mảng được lưu bằng np.save và nạp lại bằng memory mapping, nên mở
+    một chỉ mục đã có gần như không tốn thời gian.
+    """
+
+    def __init__(self, chunks: List[Dict[str, Any]], arrays: Dict[str, np.ndarray]):
+        """
+        Khởi tạo từ các chunk và mảng đã xây dựng
+
+        Args:
+            chunks: Danh sách chunk
+            arrays: Các mảng term_ids, doc_ids, tfs, doc_lengths
+        """
+        self.chunks = chunks
+        self.term_ids = arrays["term_ids"]
+        self.doc_ids = arrays["doc_ids"]
+        self.tfs = arrays["tfs"]
+        self.doc_lengths = arrays["doc_lengths"]
+        self.avg_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, chunks: List[Dict[str, Any]]) -> "RetrievalIndex":
+        """
+        Xây dựng chỉ mục từ danh sách chunk
+
+        Args:
+            chunks: Danh sách chunk (từ chunk_pages)
+
+        Returns:
+            RetrievalIndex
+        """
+        term_parts, doc_parts, tf_parts, lengths = [], [], [], []
+        for doc_id, chunk in enumerate(chunks):
+            counts = Counter(_term_ids(chunk["text"]))
+            lengths.append(sum(counts.values()))
+            term_parts.append(np.fromiter(counts.keys(), dtype=np.int32, count=len(counts)))
+            tf_parts.append(np.fromiter(counts.values(), dtype=np.float32, count=len(counts)))
+            doc_parts.append(np.full(len(counts), doc_id, dtype=np.int32))
+
+        if term_parts:
+            term_ids = np.concatenate(term_parts)
+            order = np.argsort(term_ids, kind="stable")
+            arrays = {
+                "term_ids": term_ids[order],
+                "doc_ids": np.concatenate(doc_parts)[order],
+                "tfs": np.concatenate(tf_parts)[order],
+                "doc_lengths": np.asarray(lengths, dtype=np.float32)
+            }
+        else:
+            arrays = {
+                "term_ids": np.zeros(0, dtype=np.int32),
+                "doc_ids": np.zeros(0, dtype=np.int32),
+                "tfs": np.zeros(0, dtype=np.float32),
+                "doc_lengths": np.zeros(0, dtype=np.float32)
+            }
+        return cls(chunks, arrays)
+
+    def save(self, path: str) -> None:
+        """
+        Lưu chỉ mục vào thư mục
+
+        Args:
+            path: Thư mục đích
+        """
+        os.makedirs(path, exist_ok=True)
+        for name in _INDEX_ARRAYS:
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(path, "chunks.json"), "w", encoding="utf-8") as f:
+            json.dump(self.chunks, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, path: str) -> "RetrievalIndex":
+        """
+        Nạp chỉ mục đã lưu, các mảng được memory-map (chỉ đọc)
+
+        Args:
+            path: Thư mục chứa chỉ mục
+
+        Returns:
+            RetrievalIndex
+        """
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in _INDEX_ARRAYS
+        }
+        with open(os.path.join(path, "chunks.json"), encoding="utf-8") as f:
+            chunks = json.load(f)
+        return cls(chunks, arrays)
+
+    def scores(self, query: str) -> np.ndarray:
+        """
+        Tính điểm BM25 của mọi chunk với câu hỏi
+
+        Args:
+            query: Câu hỏi
+
+        Returns:
+            Mảng điểm theo thứ tự chunk
+        """
+        scores = np.zeros(len(self.chunks), dtype=np.float32)
+        terms = np.unique(np.asarray(_term_ids(query), dtype=np.int32))
+        if not len(terms) or not len(self.chunks):
+            return scores
+
+        starts = np.searchsorted(self.term_ids, terms, side="left")
+        ends = np.searchsorted(self.term_ids, terms, side="right")
+        doc_count = len(self.chunks)
+        norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths / max(self.avg_length, 1e-9))
+
+        for start, end in zip(starts, ends):
+            df = end - start
+            if not df:
+                continue
+            idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += idf * tf * (BM25_K1 + 1) / (tf + norm[docs])
+        return scores
+
+    def search(
+        self,
+        query: str,
+        top_k: int = RETRIEVAL_TOP_K,
+        token_budget: int = RETRIEVAL_TOKEN_BUDGET
+    ) -> List[Dict[str, Any]]:
+        """
+        Lấy các chunk liên quan nhất trong giới hạn token
+
+        Args:
+            query: Câu hỏi
+            top_k: Số chunk tối đa
+            token_budget: Tổng số token tối đa của các chunk được chọn
+
+        Returns:
+            Danh sách chunk (kèm "score"), sắp theo thứ tự trong tài liệu
+        """
+        scores = self.scores(query)
+        if not len(scores):
+            return []
+
+        k = min(top_k, len(scores))
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+
+        selected, used = [], 0
+        for doc_id in candidates:
+            if scores[doc_id] <= 0:
+                break
+            chunk = self.chunks[int(doc_id)]
+            if used + chunk["tokens"] > token_budget:
+                continue
+            selected.append({**chunk, "id": int(doc_id), "score": float(scores[doc_id])})
+            used += chunk["tokens"]
+        return sorted(selected, key=lambda c: c["id"])
+
+
+def get_or_build_index(digest: str, pages: List[str], index_dir: Optional[str] = RETRIEVAL_INDEX_DIR) -> RetrievalIndex:
+    """
+    Nạp chỉ mục của tài liệu từ đĩa hoặc xây dựng mới
+
+    Args:
+        digest: SHA-256 của tài liệu
+        pages: Văn bản từng trang
+        index_dir: Thư mục lưu chỉ mục (None để không lưu)
+
+    Returns:
+        RetrievalIndex
+    """
+    path = os.path.join(index_dir, digest) if index_dir else None
+    if path and os.path.exists(os.path.join(path, "chunks.json")):
+        try:
+            return RetrievalIndex.load(path)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Không nạp được chỉ mục {digest[:12]}, xây dựng lại: {str(e)}")
+
+    index = RetrievalIndex.build(chunk_pages(pages))
+    if path:
+        try:
+            index.save(path)
+        except OSError as e:
+            logger.warning(f"Không lưu được chỉ mục: {str(e)}")
+    return index
+
+
+def format_passages(passages: List[Dict[str, Any]], document_name: str) -> str:
+    """
+    Định dạng các đoạn trích để chèn vào tin nhắn gửi lên API
+
+    Args:
+        passages: Các chunk được chọn
+        document_name: Tên tài liệu
+
+    Returns:
+        Nội dung dạng <document> ... </document>
+    """
+    parts = [f'<document name="{document_name}">']
+    for passage in passages:
+        parts.append(f'<passage page="{passage["page"]}">\n{passage["text"]}\n</passage>')
+    parts.append("</document>")
+    return "\n".join(parts)
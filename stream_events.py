@@ -0,0 +1,114 @@
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional, Tuple
+
+from response_buffer import ResponseAccumulator, TEXT, THINKING, SIGNATURE, TOOL_INPUT
+
+# Loại kết quả của dispatch_event ngoài các kênh nội dung
+USAGE = "usage"  # Event có usage mới (message_start / message_delta)
+ERROR = "error"  # Thông báo lỗi cuối cùng của stream_channels
+
+# Kết quả của một event: (kênh hoặc USAGE, chunk), hoặc None nếu không có gì cho UI
+StreamItem = Optional[Tuple[str, str]]
+
+
+def _text_delta(delta: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    accumulator.append(delta.text, TEXT)
+    return TEXT, delta.text
+
+
+def _thinking_delta(delta: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    accumulator.append(delta.thinking, THINKING)
+    return THINKING, delta.thinking
+
+
+def _signature_delta(delta: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    # Chữ ký của thinking block chỉ cần lưu lại, không hiển thị
+    accumulator.append(delta.signature, SIGNATURE)
+    return None
+
+
+def _input_json_delta(delta: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    accumulator.append(delta.partial_json, TOOL_INPUT)
+    return TOOL_INPUT, delta.partial_json
+
+
+_DELTA_HANDLERS: Dict[str, Callable[[Any, ResponseAccumulator], StreamItem]] = {
+    "text_delta": _text_delta,
+    "thinking_delta": _thinking_delta,
+    "signature_delta": _signature_delta,
+    "input_json_delta": _input_json_delta
+}
+
+
+def _content_block_delta(event: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    handler = _DELTA_HANDLERS.get(event.delta.type)
+    return handler(event.delta, accumulator) if handler is not None else None
+
+
+def _message_start(event: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    accumulator.update_usage(event.message.usage)
+    return USAGE, ""
+
+
+def _message_delta(event: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    accumulator.update_usage(event.usage)
+    if event.delta.stop_reason:
+        accumulator.stop_reason = event.delta.stop_reason
+    return USAGE, ""
+
+
+# Các event khác (ping, content_block_start/stop, message_stop và các event
+# tổng hợp của MessageStream như "text") không cần xử lý
+_EVENT_HANDLERS: Dict[str, Callable[[Any, ResponseAccumulator], StreamItem]] = {
+    "content_block_delta": _content_block_delta,
+    "message_start": _message_start,
+    "message_delta": _message_delta
+}
+
+
+def dispatch_event(event: Any, accumulator: ResponseAccumulator) -> StreamItem:
+    """
+    Ghi một stream event vào accumulator theo bảng (event type, delta type)
+
+    Args:
+        event: Stream event từ API
+        accumulator: Bộ đệm nhận kết quả
+
+    Returns:
+        (TEXT / THINKING / TOOL_INPUT, chunk) cho nội dung mới, (USAGE, "")
+        khi usage thay đổi, hoặc None
+    """
+    handler = _EVENT_HANDLERS.get(event.type)
+    return handler(event, accumulator) if handler is not None else None
+
+
+def text_chunks(items: Iterator[Tuple[str, str]]) -> Iterator[str]:
+    """
+    Chỉ lấy chunk text (và thông báo lỗi) từ một stream theo kênh
+
+    Args:
+        items: Iterator các cặp (kênh, chunk), ví dụ từ stream_channels
+
+    Yields:
+        Từng chunk text
+    """
+    try:
+        for channel, chunk in items:
+            if channel == TEXT or channel == ERROR:
+                yield chunk
+    finally:
+        # Đóng stream gốc ngay khi người đọc dừng giữa chừng
+        close = getattr(items, "close", None)
+        if close is not None:
+            close()
+
+
+async def atext_chunks(items: AsyncIterator[Tuple[str, str]]) -> AsyncIterator[str]:
+    """Bản bất đồng bộ của text_chunks"""
+    try:
+        async for channel, chunk in items:
+            if channel == TEXT or channel == ERROR:
+                yield chunk
+    finally:
+        aclose = getattr(items, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,208 @@
+import hashlib
+import json
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Union
+
+from config import TOKEN_COUNT_CACHE_SIZE
+
+# Số token phụ cho mỗi tin nhắn (role, phân tách giữa các lượt)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+_PIECE_RE = re.compile(r"\w+|[^\w\s]")
+
+
+def approximate_tokens(text: str) -> int:
+    """
+    Ước tính số token bằng cách tách từ, gần với tokenizer của Claude hơn len // 4
+
+    - Từ ASCII: khoảng 4 ký tự / token
+    - Từ có dấu (tiếng Việt) hoặc ký tự không phải ASCII: khoảng 3 byte UTF-8 / token
+    - Mỗi dấu câu / ký hiệu: 1 token
+
+    Args:
+        text: Text cần ước tính
+
+    Returns:
+        Số tokens ước tính
+    """
+    total = 0
+    for piece in _PIECE_RE.findall(text):
+        if piece.isascii():
+            total += math.ceil(len(piece) / 4)
+        else:
+            total += math.ceil(len(piece.encode("utf-8")) / 3)
+    return total
+
+
+def content_hash(content: Any) -> str:
+    """
+    Tạo hash cho nội dung tin nhắn (string hoặc danh sách content block)
+
+    Args:
+        content: Nội dung tin nhắn
+
+    Returns:
+        Hex digest của nội dung
+    """
+    if not isinstance(content, str):
+        content = json.dumps(content, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(content.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def content_text(content: Union[str, List[Dict[str, Any]]]) -> str:
+    """
+    Lấy phần text của nội dung tin nhắn
+
+    Args:
+        content: String hoặc danh sách content block
+
+    Returns:
+        Text được nối từ các block có text
+    """
+    if isinstance(content, str):
+        return content
+    return "\n".join(
+        block.get("text", "") for block in content if isinstance(block, dict)
+    )
+
+
+class TokenCounter:
+    """Đếm token với tokenizer xấp xỉ có thể thay thế và LRU cache theo hash nội dung"""
+
+    def __init__(
+        self,
+        tokenizer: Callable[[str], int] = approximate_tokens,
+        cache_size: int = TOKEN_COUNT_CACHE_SIZE
+    ):
+        """
+        Khởi tạo token counter
+
+        Args:
+            tokenizer: Hàm đếm token cục bộ cho một đoạn text
+            cache_size: Số kết quả tối đa giữ trong LRU cache
+        """
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key: str) -> Optional[int]:
+        with self._lock:
+            value = self._cache.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def _store(self, key: str, value: int) -> None:
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def count_text(self, text: str) -> int:
+        """
+        Đếm token của một đoạn text (có cache)
+
+        Args:
+            text: Text cần đếm
+
+        Returns:
+            Số token
+        """
+        if not text:
+            return 0
+        key = content_hash(text)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+        value = self.tokenizer(text)
+        self._store(key, value)
+        return value
+
+    def count_message(self, message: Dict[str, Any]) -> int:
+        """
+        Đếm token của một tin nhắn, kể cả phần overhead của role
+
+        Args:
+            message: Tin nhắn dạng {"role": ..., "content": ...}
+
+        Returns:
+            Số token
+        """
+        content = message.get("content", "")
+        key = content_hash(content)
+        cached = self._lookup(key)
+        if cached is None:
+            cached = self.tokenizer(content_text(content))
+            self._store(key, cached)
+        return cached + MESSAGE_TOKEN_OVERHEAD
+
+    def count_messages(self, messages: List[Dict[str, Any]], system_prompt: Optional[str] = None) -> int:
+        """
+        Đếm tổng token của lịch sử hội thoại
+
+        Nhờ cache theo hash nội dung, mỗi lượt mới chỉ tốn công tokenize các
+        tin nhắn chưa từng gặp.
+
+        Args:
+            messages: Danh sách tin nhắn
+            system_prompt: System prompt (tùy chọn)
+
+        Returns:
+            Tổng số token
+        """
+        total = sum(self.count_message(message) for message in messages)
+        if system_prompt:
+            total += self.count_text(system_prompt)
+        return total
+
+    def count_request_server(self, client: Any, params: Dict[str, Any]) -> int:
+        """
+        Đếm token chính xác bằng endpoint count_tokens của API (có cache theo request)
+
+        Args:
+            client: Anthropic client
+            params: Parameters của request (model, messages, system, thinking...)
+
+        Returns:
+            Số input token do server trả về
+        """
+        count_params = {
+            key: params[key]
+            for key in ("model", "messages", "system", "thinking", "tools")
+            if key in params
+        }
+        key = "server:" + content_hash(count_params)
+        cached = self._lookup(key)
+        if cached is not None:
+            return cached
+        value = client.messages.count_tokens(**count_params).input_tokens
+        self._store(key, value)
+        return value
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Thống kê cache
+
+        Returns:
+            Dictionary gồm số entry, hit và miss
+        """
+        with self._lock:
+            return {
+                "size": len(self._cache),
+                "hits": self.hits,
+                "misses": self.misses
+            }
+
+
+# Token counter dùng chung trong process
+token_counter = TokenCounter()